@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+"""
+strippers.facebook のインポート時間を測定するベンチマークです。
+
+    python benchmarks/bench_import.py [--runs N] [--max-ms MS] [--max-ratio RATIO]
+
+それぞれ新しいプロセスで、次の 2 つの時間を測ります。
+
+    light -- パッケージをインポートして get_auth_url と parse_signed_request を使えるようになるまで
+    full  -- FacebookGraphAPI を使えるようになるまで
+
+親パッケージ strippers(名前空間パッケージの pkg_resources の読み込み)の時間は含みません。
+次のいずれかの場合は、インポート時間が悪化したとみなして終了コード 1 で終了します。
+
+    - light で graphapi や urllib2 などの重いモジュールが読み込まれた
+    - light の中央値が --max-ms を超えた(指定した場合のみ)
+    - light の中央値が full の中央値の --max-ratio 倍を超えた
+"""
+import optparse
+import os
+import subprocess
+import sys
+
+__author__ = 'otsuka'
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+HEAVY_MODULES = ('strippers.facebook.graphapi', 'strippers.facebook.graphobject',
+                 'strippers.facebook.MultipartPostHandler', 'strippers.facebook.rest',
+                 'urllib2', 'mimetools', 'xml.etree.ElementTree')
+
+SCRIPTS = {
+    'light': 'from strippers.facebook import get_auth_url, parse_signed_request',
+    'full' : 'from strippers.facebook import FacebookGraphAPI',
+}
+
+TEMPLATE = '''
+import sys, time
+sys.path.insert(0, %(src)r)
+import strippers
+start = time.time()
+%(script)s
+elapsed = time.time() - start
+print elapsed * 1000, ','.join(name for name in %(heavy)r if name in sys.modules)
+'''
+
+
+def measure(kind):
+    code = TEMPLATE % { 'src': SRC_DIR, 'script': SCRIPTS[kind], 'heavy': HEAVY_MODULES }
+    out = subprocess.check_output([sys.executable, '-c', code]).split(None, 1)
+    heavy = out[1].strip() if len(out) > 1 else ''
+    return float(out[0]), [ name for name in heavy.split(',') if name ]
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--runs', type='int', default=15, help='number of processes for each measurement')
+    parser.add_option('--max-ms', type='float', default=None, help='fail if the light import takes longer (ms)')
+    parser.add_option('--max-ratio', type='float', default=0.5,
+                      help='fail if the light import takes longer than this ratio of the full import')
+    options, args = parser.parse_args()
+
+    results = {}
+    heavy = set()
+    for kind in ('light', 'full'):
+        times = []
+        for i in xrange(options.runs):
+            elapsed, loaded = measure(kind)
+            times.append(elapsed)
+            if kind == 'light':
+                heavy.update(loaded)
+        results[kind] = median(times)
+        print '%-6s median %7.2f ms  min %7.2f ms  max %7.2f ms' % (kind, results[kind], min(times), max(times))
+
+    ratio = results['light'] / results['full']
+    print 'ratio  %.2f' % ratio
+
+    failures = []
+    if heavy:
+        failures.append('the light import loaded heavy modules: %s' % ', '.join(sorted(heavy)))
+    if options.max_ms is not None and results['light'] > options.max_ms:
+        failures.append('the light import took %.2f ms (> %.2f ms)' % (results['light'], options.max_ms))
+    if ratio > options.max_ratio:
+        failures.append('the light import took %.2f of the full import (> %.2f)' % (ratio, options.max_ratio))
+    for failure in failures:
+        print >>sys.stderr, 'FAIL:', failure
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+"""
+大量の Graph オブジェクトを保持した場合のメモリ使用量を比較するベンチマークです。
+
+    python benchmarks/bench_memory.py [オブジェクト数]
+
+以下の表現で、友達リストのページを JSON からデコードしてオブジェクトを作り、増えた RSS を測ります。
+各表現は別のプロセスで測定します。
+
+    legacy  -- 以前の FbUser と同じ、インスタンス属性を __dict__ に持つ dict のサブクラス
+    slots   -- __slots__ とキーの intern を使う現在の FbUser
+    compact -- CompactObjectList
+"""
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+__author__ = 'otsuka'
+
+PAGE_SIZE = 5000
+SCENARIOS = ('legacy', 'slots', 'compact')
+
+
+class LegacyUser(dict):
+    def __init__(self, api, data):
+        super(LegacyUser, self).__init__()
+        self.api = api
+        self.loaded = False
+        self._by_fql = False
+        self._fetched_fields = set()
+        self.update(data)
+
+
+def rss():
+    """
+    現在のプロセスの RSS をバイト数で返します。
+    """
+    try:
+        f = open('/proc/self/statm')
+        try:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        finally:
+            f.close()
+    except IOError:
+        import resource
+        # /proc がない環境では最大 RSS で代用する(Mac OS X はバイト、それ以外は KB)
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def pages(count):
+    """
+    友達リストのページの JSON 文字列を返すジェネレーター。
+    """
+    for start in xrange(0, count, PAGE_SIZE):
+        data = [ { 'id': unicode(100000000000000 + i), 'name': u'Friend %d' % i }
+                 for i in xrange(start, min(count, start + PAGE_SIZE)) ]
+        yield json.dumps({ 'data': data })
+
+
+def run(scenario, count):
+    from strippers.facebook.graphobject import FbUser, CompactObjectList
+
+    def rows():
+        for page in pages(count):
+            for row in json.loads(page)['data']:
+                yield row
+
+    before = rss()
+    if scenario == 'legacy':
+        objects = [ LegacyUser(None, row) for row in rows() ]
+    elif scenario == 'slots':
+        objects = [ FbUser(None, row) for row in rows() ]
+    else:
+        objects = CompactObjectList(None, FbUser, rows())
+    used = rss() - before
+    assert len(objects) == count and objects[count - 1]['name'] == u'Friend %d' % (count - 1)
+    return used
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    if len(sys.argv) > 2:
+        # 子プロセスとして 1 つの表現を測定する
+        print run(sys.argv[2], count)
+        return
+
+    results = {}
+    for scenario in SCENARIOS:
+        out = subprocess.check_output([sys.executable, __file__, str(count), scenario])
+        results[scenario] = int(out.strip())
+
+    print '%d objects' % count
+    for scenario in SCENARIOS:
+        used = results[scenario]
+        print '%-8s %8.1f MB %6d bytes/object %5.1f%%' % (
+            scenario, used / 1048576.0, used // count, used * 100.0 / results['legacy'])
+
+
+if __name__ == '__main__':
+    main()
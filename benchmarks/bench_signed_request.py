@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+"""
+signed_request の検証速度を測定するベンチマークです。
+
+    python benchmarks/bench_signed_request.py [--count N] [--payload BYTES] [--repeat RATIO]
+
+1 スレッド(1 コア)あたりの 1 秒間の検証数を、次の方法で比較します。
+
+    legacy      -- 以前の parse_signed_request(毎回 hmac を作成し、JSON をデコードしてから署名を検証)
+    function    -- parse_signed_request()(App Secret 毎に共有する SignedRequestVerifier を使用)
+    verifier    -- キャッシュなしの SignedRequestVerifier.verify()
+    cached      -- キャッシュありの SignedRequestVerifier.verify()。--repeat の割合の signed_request が再送されたもの
+                   (legacy との比較には、legacy で同じワークロードを検証した場合の値を使います)
+    verify_many -- キャッシュありの SignedRequestVerifier.verify_many()
+    forged      -- 署名が一致しない signed_request の検証(JSON をデコードせずに拒否する)
+"""
+import base64
+import hashlib
+import hmac
+import optparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from strippers.facebook import oauth
+from strippers.facebook.oauth import SignedRequestVerifier, parse_signed_request
+
+__author__ = 'otsuka'
+
+APP_SECRET = 'e8c3b3f3a54d4e0c9a1b2c3d4e5f6a7b'
+
+
+def legacy_parse_signed_request(signed_request, app_secret):
+    try:
+        l = signed_request.split('.', 2)
+        encoded_sig = str(l[0])
+        payload = str(l[1])
+        sig = base64.urlsafe_b64decode(encoded_sig + "=" * ((4 - len(encoded_sig) % 4) % 4))
+        data = base64.urlsafe_b64decode(payload + "=" * ((4 - len(payload) % 4) % 4))
+    except IndexError:
+        return False
+    except TypeError:
+        return False
+
+    data = json.loads(data)
+    if data.get('algorithm', '').upper() != 'HMAC-SHA256':
+        return False
+
+    expected_sig = hmac.new(str(app_secret), msg=payload, digestmod=hashlib.sha256).digest()
+    if sig != expected_sig:
+        return False
+
+    return data
+
+
+def make_signed_request(user_id, payload_size, secret=APP_SECRET):
+    data = {
+        'algorithm'  : 'HMAC-SHA256',
+        'issued_at'  : int(time.time()),
+        'user_id'    : str(user_id),
+        'oauth_token': 'AAAB' + 'x' * 100,
+        'expires'    : int(time.time()) + 3600,
+        'user'       : { 'country': 'jp', 'locale': 'ja_JP', 'age': { 'min': 21 } },
+        'app_data'   : 'd' * payload_size,
+    }
+    payload = base64.urlsafe_b64encode(json.dumps(data)).rstrip('=')
+    sig = hmac.new(secret, msg=payload, digestmod=hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(sig).rstrip('=') + '.' + payload
+
+
+def workload(count, payload_size, repeat, recent=200):
+    """
+    repeat の割合で、直近の recent 件のいずれかの signed_request を再び送るワークロードを作成します。
+    キャンバスページ内の遷移などで、同じユーザーの signed_request が続けて送られる状況を想定しています。
+    """
+    requests = []
+    for i in xrange(count):
+        if requests and random.random() < repeat:
+            requests.append(random.choice(requests[-recent:]))
+        else:
+            requests.append(make_signed_request(100000 + i, payload_size))
+    return requests
+
+
+def measure(factory, requests, runs, expected=True):
+    """
+    factory() が返す関数で requests を検証し、runs 回のうち最も速かった 1 秒あたりの検証数を返します。
+    キャッシュの効果が前の回から持ち越されないように、毎回 factory() で新しい関数を作成します。
+    """
+    best = 0
+    for i in xrange(runs):
+        func = factory()
+        start = time.time()
+        results = func(requests)
+        rate = len(requests) / (time.time() - start)
+        if any(bool(result) != expected for result in results):
+            raise AssertionError('unexpected verification result.')
+        best = max(best, rate)
+    return best
+
+
+def each(verify):
+    return lambda requests: [ verify(signed_request) for signed_request in requests ]
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--count', type='int', default=20000, help='signed requests for each method')
+    parser.add_option('--payload', type='int', default=200, help='bytes of app_data in each signed request')
+    parser.add_option('--repeat', type='float', default=0.5, help='ratio of signed requests sent more than once')
+    parser.add_option('--runs', type='int', default=5, help='runs for each method; the fastest one is reported')
+    options, args = parser.parse_args()
+
+    random.seed(1)
+    unique = [ make_signed_request(100000 + i, options.payload) for i in xrange(options.count) ]
+    repeated = workload(options.count, options.payload, options.repeat)
+    forged = [ make_signed_request(100000 + i, options.payload, 'wrong secret') for i in xrange(options.count) ]
+
+    def shared_verifier():
+        oauth._verifiers.clear()
+        return each(lambda signed_request: parse_signed_request(signed_request, APP_SECRET))
+
+    results = [
+        ('legacy', measure(lambda: each(lambda s: legacy_parse_signed_request(s, APP_SECRET)), unique, options.runs)),
+        ('function', measure(shared_verifier, unique, options.runs)),
+        ('verifier', measure(lambda: each(SignedRequestVerifier(APP_SECRET, cache_size=0).verify),
+                             unique, options.runs)),
+        ('cached', measure(lambda: each(SignedRequestVerifier(APP_SECRET, max_age=3600).verify),
+                           repeated, options.runs)),
+        ('verify_many', measure(lambda: SignedRequestVerifier(APP_SECRET, max_age=3600).verify_many,
+                                repeated, options.runs)),
+        ('forged', measure(lambda: SignedRequestVerifier(APP_SECRET).verify_many, forged, options.runs, False)),
+    ]
+
+    print 'count=%d payload=%d repeat=%.2f' % (options.count, options.payload, options.repeat)
+    baseline = results[0][1]
+    baseline_repeated = measure(lambda: each(lambda s: legacy_parse_signed_request(s, APP_SECRET)),
+                                repeated, options.runs)
+    for name, rate in results:
+        base = baseline_repeated if name in ('cached', 'verify_many') else baseline
+        print '%-12s %10.0f verifications/s  x%.2f' % (name, rate, rate / base)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+"""
+ローカルの fakegraph サーバーに対して FacebookGraphAPI、FbUser、FbAlbum を動かすベンチマークです。
+
+    python benchmarks/bench_suite.py [--latency 0.01] [--requests 200] [--concurrency 8]
+                                     [--only get,posts] [--json result.json] [--compare previous.json]
+
+シナリオ毎に別のプロセスで実行し、次の値を表示します。
+
+    req/s   -- サーバーが受け付けた HTTP リクエスト数 / 経過時間
+    items/s -- シナリオで処理した要素(オブジェクト、投稿、写真など)の数 / 経過時間
+    p50/p99 -- HTTP リクエスト 1 回あたりのレイテンシ(ミリ秒)
+    KB in/out -- サーバーが受信・送信したバイト数
+    peak MB -- ベンチマークのプロセスの最大 RSS
+
+--json で結果を保存し、次回の実行で --compare に指定すると、前回からの変化率を表示します。
+"""
+import optparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'src'))
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+__author__ = 'otsuka'
+
+
+# 子プロセスで実行するシナリオ
+
+def timed_api_class():
+    from strippers.facebook.graphapi import FacebookGraphAPI
+
+    class TimedGraphAPI(FacebookGraphAPI):
+        """
+        HTTP リクエスト 1 回毎の時間(レスポンスボディの読み込みを含む)を記録する FacebookGraphAPI。
+        """
+
+        def __init__(self, *args, **kwargs):
+            FacebookGraphAPI.__init__(self, *args, **kwargs)
+            self.latencies = []
+
+        def _send_request(self, req, content_type=None):
+            start = time.time()
+            try:
+                return FacebookGraphAPI._send_request(self, req, content_type)
+            finally:
+                self.latencies.append(time.time() - start)
+
+    return TimedGraphAPI
+
+
+def scenario_get(api, options):
+    for i in xrange(options.requests):
+        api.get(api.BASE_URL + 'me')
+    return options.requests
+
+
+def scenario_get_concurrent(api, options):
+    from strippers.facebook.future import WorkerPool
+    pool = WorkerPool(options.concurrency)
+    try:
+        pool.map(lambda i: api.get(api.BASE_URL + str(i)), xrange(options.requests))
+    finally:
+        pool.shutdown()
+    return options.requests
+
+
+def scenario_user_load(api, options):
+    from strippers.facebook.graphobject import FbUser
+    for i in xrange(options.requests):
+        FbUser(api, { 'id': str(i) }).load()
+    return options.requests
+
+
+def scenario_load_all(api, options):
+    from strippers.facebook.graphobject import FbUser, load_all
+    users = [ FbUser(api, { 'id': str(i) }) for i in xrange(options.requests * 10) ]
+    load_all(users, concurrency=options.concurrency)
+    return len(users)
+
+
+def scenario_posts(api, options):
+    from strippers.facebook.graphobject import FbUser
+    return len(list(FbUser(api, { 'id': 'me' }).posts(prefetch=0)))
+
+
+def scenario_posts_prefetch(api, options):
+    from strippers.facebook.graphobject import FbUser
+    return len(list(FbUser(api, { 'id': 'me' }).posts(prefetch=2)))
+
+
+def scenario_posts_parallel(api, options):
+    from strippers.facebook.graphobject import FbUser
+    import fakegraph
+    until = fakegraph.EPOCH + (options.total + 1) * 60
+    posts = FbUser(api, { 'id': 'me' }).posts_parallel(fakegraph.EPOCH, until, workers=options.concurrency,
+                                                        fetch=25, min_slice=60)
+    return len(list(posts))
+
+
+def scenario_friends(api, options):
+    from strippers.facebook.graphobject import FbUser
+    return len(FbUser(api, { 'id': 'me' }).friends())
+
+
+def scenario_search(api, options):
+    return len(list(api.search('place', 'cafe')))
+
+
+def scenario_fql(api, options):
+    for i in xrange(options.requests):
+        api.fql_query('SELECT friend_count FROM user WHERE uid = me()')
+        api.fql_query('SELECT uid, name FROM user WHERE uid IN (SELECT uid2 FROM friend WHERE uid1 = me())')
+        api.fql_query('SELECT uid, name FROM profile WHERE id = me()')
+    return options.requests * 3
+
+
+def scenario_fql_multiquery(api, options):
+    for i in xrange(options.requests):
+        api.fql_query({
+            'count'  : 'SELECT friend_count FROM user WHERE uid = me()',
+            'friends': 'SELECT uid, name FROM user WHERE uid IN (SELECT uid2 FROM friend WHERE uid1 = me())',
+            'profile': 'SELECT uid, name FROM profile WHERE id = me()',
+        })
+    return options.requests * 3
+
+
+def scenario_batch(api, options):
+    count = 0
+    for i in xrange(0, options.requests, 50):
+        with api.batch() as batch:
+            futures = [ batch.get(api.BASE_URL + str(j)) for j in xrange(i, min(options.requests, i + 50)) ]
+        for future in futures:
+            future.result()
+            count += 1
+    return count
+
+
+def scenario_upload(api, options):
+    from strippers.facebook.graphobject import FbAlbum
+    count = max(1, options.requests // 10)
+    fd, path = tempfile.mkstemp(suffix='.jpg')
+    try:
+        os.write(fd, os.urandom(options.photo_size))
+        os.close(fd)
+        sources = [ open(path, 'rb') for i in xrange(count) ]
+        try:
+            photos = FbAlbum(api, { 'id': 'album' }).upload_photos(sources, concurrency=options.concurrency)
+        finally:
+            for source in sources:
+                source.close()
+    finally:
+        os.remove(path)
+    return len(photos)
+
+
+def scenario_errors(api, options):
+    from strippers.facebook.error import ExpiredTokenError
+    expired = timed_api_class()('expired-token', retry_policy=api.retry_policy)
+    expired.BASE_URL = api.BASE_URL
+    expired.latencies = api.latencies
+    for i in xrange(options.requests):
+        try:
+            expired.get(api.BASE_URL + 'me')
+        except ExpiredTokenError:
+            pass
+    return options.requests
+
+
+SCENARIOS = [ (name[len('scenario_'):], func) for name, func in sorted(globals().items())
+              if name.startswith('scenario_') ]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def run_scenario(name, base_url, options):
+    from strippers.facebook.retry import RetryPolicy
+    api = timed_api_class()('bench-token', 'app', 'secret', pool_size=max(10, options.concurrency),
+                            retry_policy=RetryPolicy(max_attempts=1))
+    api.BASE_URL = base_url
+    func = dict(SCENARIOS)[name]
+    start = time.time()
+    items = func(api, options)
+    elapsed = time.time() - start
+    api.close()
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = usage if sys.platform == 'darwin' else usage * 1024
+    return {
+        'elapsed' : elapsed,
+        'items'   : items,
+        'p50'     : percentile(api.latencies, 50) * 1000,
+        'p99'     : percentile(api.latencies, 99) * 1000,
+        'peak_rss': peak,
+    }
+
+
+# 親プロセス
+
+def server_request(base_url, path):
+    return json.loads(urllib2.urlopen(base_url + path).read())
+
+
+def start_server(options):
+    args = [ sys.executable, os.path.join(BENCH_DIR, 'fakegraph.py'), '--port', '0',
+             '--latency', str(options.latency), '--total', str(options.total), '--payload', str(options.payload) ]
+    process = subprocess.Popen(args, stdout=subprocess.PIPE)
+    base_url = process.stdout.readline().strip()
+    if not base_url:
+        raise RuntimeError('fakegraph server did not start.')
+    return process, base_url
+
+
+def run_child(name, base_url, options):
+    args = [ sys.executable, os.path.abspath(__file__), '--child', name, '--base-url', base_url,
+             '--requests', str(options.requests), '--concurrency', str(options.concurrency),
+             '--total', str(options.total), '--photo-size', str(options.photo_size) ]
+    server_request(base_url, '__reset')
+    out = subprocess.check_output(args)
+    result = json.loads(out.strip().splitlines()[-1])
+    stats = server_request(base_url, '__stats')
+    result['requests'] = stats['requests'] - 1 # __stats 自体を除く
+    result['bytes_in'] = stats['bytes_in']
+    result['bytes_out'] = stats['bytes_out']
+    result['req_per_sec'] = result['requests'] / result['elapsed']
+    result['items_per_sec'] = result['items'] / result['elapsed']
+    return result
+
+
+COLUMNS = [
+    ('req/s',   'req_per_sec',   '%9.1f'),
+    ('items/s', 'items_per_sec', '%9.1f'),
+    ('p50 ms',  'p50',           '%8.2f'),
+    ('p99 ms',  'p99',           '%8.2f'),
+    ('KB in',   'bytes_in',      '%8.1f'),
+    ('KB out',  'bytes_out',     '%8.1f'),
+    ('peak MB', 'peak_rss',      '%8.1f'),
+]
+
+SCALES = { 'bytes_in': 1024.0, 'bytes_out': 1024.0, 'peak_rss': 1048576.0 }
+
+
+def print_results(results, previous=None):
+    names = [ name for name, func in SCENARIOS if name in results ]
+    width = max(len(name) for name in names)
+    print ' '.join([ 'scenario'.ljust(width), 'reqs'.rjust(6) ] + [ title.rjust(9) for title, key, format in COLUMNS ])
+    for name in names:
+        result = results[name]
+        cells = [ name.ljust(width), ('%6d' % result['requests']) ]
+        for title, key, format in COLUMNS:
+            cells.append((format % (result[key] / SCALES.get(key, 1.0))).rjust(9))
+        print ' '.join(cells)
+        if previous and name in previous:
+            cells = [ ''.ljust(width), ''.rjust(6) ]
+            for title, key, format in COLUMNS:
+                before = previous[name].get(key)
+                if before:
+                    cells.append(('%+8.1f%%' % ((result[key] - before) * 100.0 / before)).rjust(9))
+                else:
+                    cells.append(''.rjust(9))
+            print ' '.join(cells)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--latency', type='float', default=0.0, help='seconds the server waits before each response')
+    parser.add_option('--requests', type='int', default=200, help='requests for each scenario')
+    parser.add_option('--concurrency', type='int', default=8)
+    parser.add_option('--total', type='int', default=500, help='items in each list on the server')
+    parser.add_option('--payload', type='int', default=200, help='bytes of text in each object')
+    parser.add_option('--photo-size', type='int', default=256 * 1024, help='bytes of each uploaded photo')
+    parser.add_option('--only', default=None, help='comma separated scenarios to run')
+    parser.add_option('--json', default=None, help='save the results to this file')
+    parser.add_option('--compare', default=None, help='compare with results saved by --json')
+    parser.add_option('--base-url', default=None, help='use a server that is already running')
+    parser.add_option('--child', default=None, help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    if options.child:
+        sys.path.insert(0, BENCH_DIR)
+        print json.dumps(run_scenario(options.child, options.base_url, options))
+        sys.stdout.flush()
+        # 終了処理中のワーカースレッドがエラーを出力しないように、すぐに終了する
+        os._exit(0)
+
+    names = [ name for name, func in SCENARIOS ]
+    if options.only:
+        names = [ name for name in names if name in options.only.split(',') ]
+
+    process = None
+    base_url = options.base_url
+    if base_url is None:
+        process, base_url = start_server(options)
+    try:
+        results = {}
+        for name in names:
+            results[name] = run_child(name, base_url, options)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    previous = None
+    if options.compare:
+        previous = json.load(open(options.compare))
+    print 'latency=%.3fs requests=%d concurrency=%d total=%d payload=%d' % (
+        options.latency, options.requests, options.concurrency, options.total, options.payload)
+    print_results(results, previous)
+    if options.json:
+        f = open(options.json, 'w')
+        try:
+            json.dump(results, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+
+if __name__ == '__main__':
+    main()
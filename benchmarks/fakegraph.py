@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+"""
+ベンチマーク用の、Graph API を模倣するローカルの HTTP サーバーです。
+
+    python benchmarks/fakegraph.py [--port 8000] [--latency 0.02] [--payload 200]
+
+FacebookGraphAPI の BASE_URL をこのサーバーの URL に置き換えて使います。
+
+    api = FacebookGraphAPI('token', 'app_id', 'app_secret')
+    api.BASE_URL = server.base_url
+
+次のエンドポイントを模倣します。
+
+    GET  /me, /{id}                     -- オブジェクト(?fields= と ?ids= に対応)
+    GET  /{id}/posts, /friends, /albums -- offset と paging.next によるページング(?since= ?until= に対応)
+    GET  /{id}/photos
+    GET  /search
+    GET  /fql                           -- 単一のクエリと multiquery
+    GET  /me/permissions
+    POST /{id}/photos                   -- multipart の写真のアップロード
+    POST /{id}/feed, /{id}/albums ...   -- オブジェクトの作成
+    POST /                              -- バッチリクエスト
+    GET  /oauth/access_token            -- client_credentials、authorization_code、fb_exchange_token
+    GET  /__stats, /__reset             -- サーバーの統計情報(リクエスト数、送受信バイト数)
+
+アクセストークンが 'expired' または 'invalid' で始まる場合と、/error/{code} には、
+Facebook と同じ WWW-Authenticate ヘッダーや JSON のエラーを返します。
+FakeGraphServer.fail_next() で、リトライのテストのために一時的なエラーを返すこともできます。
+"""
+import BaseHTTPServer
+import SocketServer
+import gzip
+import hashlib
+import optparse
+import sys
+import threading
+import time
+import urllib
+import urlparse
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+__author__ = 'otsuka'
+
+EPOCH = 1300000000 # 投稿の created_time の基準
+
+
+def token_error(token):
+    """
+    アクセストークンが 'expired' または 'invalid' で始まる場合に、Facebook と同じエラーのボディと
+    WWW-Authenticate ヘッダーのリストのタプルを返します。それ以外の場合は None を返します。
+    """
+    if token.startswith('expired'):
+        kind, message = 'expired_token', 'Session has expired at unix time %d.' % EPOCH
+    elif token.startswith('invalid'):
+        kind, message = 'invalid_token', 'Invalid OAuth access token.'
+    else:
+        return None
+    return ({ 'error': { 'message': message, 'type': 'OAuthException' } },
+            [('WWW-Authenticate', 'OAuth "Facebook Platform" "%s" "%s"' % (kind, message))])
+
+def api_error(code, message):
+    return { 'error': { 'message': '(#%d) %s' % (code, message), 'type': 'OAuthException', 'code': code } }
+
+
+class FakeGraphHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # ヘッダーとボディを 1 回で送信し、Nagle アルゴリズムと遅延 ACK による待ちが計測に入らないようにする
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    # 応答
+
+    def send_body(self, code, body, content_type='application/json; charset=UTF-8', headers=()):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+        extra = list(headers)
+        if self.server.etag and self.command == 'GET' and code == 200:
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            extra.append(('ETag', etag))
+        if len(body) > 256 and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=1)
+            f.write(body)
+            f.close()
+            body = buf.getvalue()
+            extra.append(('Content-Encoding', 'gzip'))
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in extra:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(bytes_out=len(body))
+
+    def send_oauth_error(self, kind, message):
+        self.send_body(400, { 'error': { 'message': message, 'type': 'OAuthException' } },
+                       headers=[('WWW-Authenticate', 'OAuth "Facebook Platform" "%s" "%s"' % (kind, message))])
+
+    def send_api_error(self, code, message):
+        self.send_body(400, api_error(code, message))
+
+    # リクエストの処理
+
+    def do_GET(self):
+        self.handle_request('GET', '')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE', '')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        self.server.count(bytes_in=length)
+        self.handle_request('POST', body)
+
+    def handle_request(self, method, body):
+        self.server.count(requests=1)
+        url = urlparse.urlparse(self.path)
+        path = url.path.strip('/')
+        query = dict((k, v[-1]) for k, v in urlparse.parse_qs(url.query, True).items())
+        if path.startswith('__'):
+            return self.handle_control(path)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        code = self.server.take_fault(path)
+        if code is not None:
+            return self.send_body(code, { 'error': { 'message': 'Error injected by the test.', 'type': 'FakeGraphError' } })
+        if method == 'POST' and 'multipart/form-data' not in self.headers.get('Content-Type', ''):
+            query.update(dict((k, v[-1]) for k, v in urlparse.parse_qs(body, True).items()))
+
+        if path == 'oauth/access_token':
+            return self.handle_access_token(query)
+        error = token_error(query.get('access_token', ''))
+        if error is not None:
+            return self.send_body(400, error[0], headers=error[1])
+        if path.startswith('error/'):
+            return self.send_api_error(int(path.split('/')[1]), 'Error requested by the client.')
+
+        method = query.get('method', method).upper()
+        code, result = self.server.app.dispatch(method, path, query, self, body)
+        self.send_body(code, result, content_type='text/plain' if isinstance(result, str) else 'application/json; charset=UTF-8')
+
+    def handle_access_token(self, query):
+        grant_type = query.get('grant_type')
+        if grant_type == 'client_credentials':
+            return self.send_body(200, 'access_token=%s|fakeapptoken' % query.get('client_id'), 'text/plain')
+        if query.get('code') == 'invalid' or query.get('fb_exchange_token', '').startswith('invalid'):
+            return self.send_oauth_error('invalid_token', 'Invalid verification code format.')
+        return self.send_body(200, 'access_token=fake%d&expires=5183999' % int(time.time() * 1000), 'text/plain')
+
+    def handle_control(self, path):
+        if path == '__reset':
+            self.server.reset()
+        self.send_body(200, self.server.stats())
+
+
+class FakeGraphApp(object):
+    """
+    Graph API のデータを生成してリクエストに応答します。
+    """
+
+    MAX_BATCH_SIZE = 50 # バッチリクエストの最大件数
+
+    def __init__(self, server, page_size=25, total=500, payload=200, max_limit=None):
+        self.server = server
+        self.page_size = page_size
+        self.max_limit = max_limit
+        self.total = total
+        self.payload = payload
+        self._next_id = 1000000
+        self._lock = threading.Lock()
+
+    def new_id(self):
+        self._lock.acquire()
+        try:
+            self._next_id += 1
+            return str(self._next_id)
+        finally:
+            self._lock.release()
+
+    def user(self, id, fields=None):
+        data = {
+            'id'        : id if id != 'me' else '100001',
+            'name'      : 'User %s' % id,
+            'first_name': 'User',
+            'last_name' : str(id),
+            'gender'    : 'male',
+            'locale'    : 'ja_JP',
+            'about'     : 'x' * self.payload,
+        }
+        if fields:
+            data = dict((k, v) for k, v in data.items() if k in fields.split(',') or k == 'id')
+        return data
+
+    def item(self, kind, index):
+        base = { 'id': '%s_%d' % (kind, index) }
+        if kind in ('posts', 'feed'):
+            base.update({
+                'from'        : { 'id': str(200000 + index % 50), 'name': 'Friend %d' % (index % 50) },
+                'message'     : ('post %d ' % index) + 'x' * self.payload,
+                'created_time': time.strftime('%Y-%m-%dT%H:%M:%S+0000', time.gmtime(self.created_time(index))),
+            })
+        elif kind == 'friends':
+            base.update({ 'id': str(200000 + index), 'name': 'Friend %d' % index })
+        elif kind == 'photos':
+            base.update({ 'source': 'http://example.com/%d.jpg' % index, 'name': 'x' * self.payload })
+        else:
+            base.update({ 'name': '%s %d' % (kind, index), 'description': 'x' * self.payload })
+        return base
+
+    def created_time(self, index):
+        # 新しい順に、60 秒間隔で並んでいる
+        return EPOCH + (self.total - index) * 60
+
+    def page(self, handler, path, kind, query):
+        limit = int(query.get('limit') or self.page_size)
+        if self.max_limit:
+            # Facebook と同じく、limit が大きすぎる場合は 1 ページの件数を切り詰める
+            limit = min(limit, self.max_limit)
+        offset = int(query.get('offset') or 0)
+        indexes = range(self.total)
+        if kind in ('posts', 'feed') and ('since' in query or 'until' in query):
+            since = int(query.get('since') or 0)
+            until = int(query.get('until') or sys.maxint)
+            indexes = [ i for i in indexes if since <= self.created_time(i) <= until ]
+        indexes = indexes[offset:offset + limit]
+        data = [ self.item(kind, i) for i in indexes ]
+        paging = {}
+        if data:
+            paging['next'] = self.page_url(handler, path, query, offset + limit, limit)
+        if offset:
+            paging['previous'] = self.page_url(handler, path, query, max(0, offset - limit), limit)
+        return { 'data': data, 'paging': paging }
+
+    def page_url(self, handler, path, query, offset, limit):
+        params = sorted(dict(query, offset=offset, limit=limit).items())
+        return 'http://%s/%s?%s' % (handler.headers.get('Host'), path, urllib.urlencode(params))
+
+    def fql(self, q):
+        rows = [ { 'uid': str(200000 + i), 'name': 'Friend %d' % i, 'friend_count': self.total }
+                 for i in xrange(min(self.page_size, self.total)) ]
+        if q.lstrip().startswith('{'):
+            queries = json.loads(q)
+            return { 'data': [ { 'name': name, 'fql_result_set': rows } for name in sorted(queries) ] }
+        return { 'data': rows }
+
+    def dispatch(self, method, path, query, handler, body):
+        parts = path.split('/') if path else []
+        if method == 'POST' and not parts:
+            return self.batch(query, handler)
+        if not parts:
+            ids = query.get('ids')
+            if not ids:
+                return 400, { 'error': { 'message': 'Unsupported get request.', 'type': 'GraphMethodException' } }
+            return 200, dict((id, self.user(id, query.get('fields'))) for id in ids.split(','))
+        if parts == ['fql']:
+            return 200, self.fql(query.get('q', ''))
+        if parts == ['search']:
+            return 200, self.page(handler, path, query.get('type', 'search'), query)
+        if len(parts) == 1:
+            if method == 'DELETE':
+                return 200, 'true'
+            return 200, self.user(parts[0], query.get('fields'))
+        kind = parts[1]
+        if kind == 'permissions':
+            return 200, { 'data': [ { 'installed': 1, 'email': 1, 'publish_stream': 1, 'user_photos': 1 } ] }
+        if method == 'POST':
+            if kind == 'tags':
+                return 200, 'true'
+            if kind == 'photos' and 'multipart/form-data' in handler.headers.get('Content-Type', ''):
+                return 200, { 'id': self.new_id(), 'size': len(body) }
+            return 200, { 'id': self.new_id() }
+        return 200, self.page(handler, path, kind, query)
+
+    def batch(self, query, handler):
+        operations = json.loads(query.get('batch', '[]'))
+        if len(operations) > self.MAX_BATCH_SIZE:
+            return 400, api_error(1, 'Too many requests in batch message. Maximum batch size is %d' % self.MAX_BATCH_SIZE)
+        results = []
+        for operation in operations:
+            url = urlparse.urlparse(operation.get('relative_url', ''))
+            path = url.path.strip('/')
+            op_query = dict((k, v[-1]) for k, v in urlparse.parse_qs(url.query, True).items())
+            if operation.get('body'):
+                op_query.update(dict((k, v[-1]) for k, v in urlparse.parse_qs(operation['body'], True).items()))
+            # 単独のリクエストと同じエラーを、バッチの 1 件分として返す
+            headers = []
+            error = token_error(op_query.get('access_token', ''))
+            if error is not None:
+                code, (body, headers) = 400, error
+            elif path.startswith('error/'):
+                code, body = 400, api_error(int(path.split('/')[1]), 'Error requested by the client.')
+            else:
+                code, body = self.dispatch(operation.get('method', 'GET').upper(), path, op_query, handler, '')
+            results.append({ 'code'   : code,
+                             'headers': [ { 'name': name, 'value': value } for name, value in headers ],
+                             'body'   : body if isinstance(body, str) else json.dumps(body) })
+        return 200, results
+
+
+class FakeGraphServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Graph API を模倣するサーバー。
+
+    server = FakeGraphServer(latency=0.02).start()
+    ...
+    server.stop()
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    # 同時に接続するクライアントが多い場合に、SYN が捨てられて接続が 1 秒以上遅れないようにする
+    request_queue_size = 128
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, page_size=25, total=500, payload=200, verbose=False,
+                 max_limit=None, etag=False):
+        """
+        @param latency: 各リクエストの応答を遅らせる秒数
+        @type latency: float
+        @param page_size: ページングの 1 ページあたりのデフォルトの件数
+        @type page_size: int
+        @param total: 投稿や友達などのリストの全件数
+        @type total: int
+        @param payload: 各オブジェクトに含める本文のバイト数
+        @type payload: int
+        @param max_limit: 1 ページの最大件数。これより大きい limit は切り詰められます
+        @type max_limit: int
+        @param etag: GET のレスポンスに ETag ヘッダーを付け、If-None-Match が一致すれば 304 Not Modified を返すか否か
+        @type etag: bool
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), FakeGraphHandler)
+        self.latency = latency
+        self.verbose = verbose
+        self.etag = etag
+        self.app = FakeGraphApp(self, page_size, total, payload, max_limit)
+        self._stats_lock = threading.Lock()
+        self._faults = [] # [パスの接頭辞, ステータスコード, 残りの回数] のリスト
+        self.reset()
+
+    @property
+    def base_url(self):
+        return 'http://%s:%d/' % self.server_address
+
+    def count(self, requests=0, bytes_in=0, bytes_out=0):
+        self._stats_lock.acquire()
+        try:
+            self._stats['requests'] += requests
+            self._stats['bytes_in'] += bytes_in
+            self._stats['bytes_out'] += bytes_out
+        finally:
+            self._stats_lock.release()
+
+    def stats(self):
+        self._stats_lock.acquire()
+        try:
+            return dict(self._stats)
+        finally:
+            self._stats_lock.release()
+
+    def reset(self):
+        self._stats_lock.acquire()
+        try:
+            self._stats = { 'requests': 0, 'bytes_in': 0, 'bytes_out': 0 }
+        finally:
+            self._stats_lock.release()
+
+    def fail_next(self, count, code=500, path=''):
+        """
+        path で始まるパスへの次の count 回のリクエストに、ステータスコード code のエラーを返します。
+
+        @param count: エラーを返す回数
+        @type count: int
+        @param code: HTTP ステータスコード
+        @type code: int
+        @param path: エラーを返すパスの接頭辞('/' で始まらない)。省略した場合はすべてのパス
+        @type path: str
+        """
+        self._stats_lock.acquire()
+        try:
+            self._faults.append([path, code, count])
+        finally:
+            self._stats_lock.release()
+
+    def take_fault(self, path):
+        """
+        path へのリクエストにエラーを返す場合は、そのステータスコードを返します。
+        """
+        self._stats_lock.acquire()
+        try:
+            for fault in self._faults:
+                if path.startswith(fault[0]):
+                    fault[2] -= 1
+                    if fault[2] <= 0:
+                        self._faults.remove(fault)
+                    return fault[1]
+            return None
+        finally:
+            self._stats_lock.release()
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=8000)
+    parser.add_option('--latency', type='float', default=0.0, help='seconds to delay each response')
+    parser.add_option('--page-size', type='int', default=25)
+    parser.add_option('--total', type='int', default=500, help='number of items in each list')
+    parser.add_option('--payload', type='int', default=200, help='bytes of text in each object')
+    parser.add_option('--max-limit', type='int', default=None, help='maximum number of items in each page')
+    parser.add_option('--verbose', action='store_true', default=False)
+    options, args = parser.parse_args()
+    server = FakeGraphServer(options.host, options.port, options.latency, options.page_size,
+                             options.total, options.payload, options.verbose, options.max_limit)
+    # 呼び出し元(bench_suite.py)が URL を読み取れるように、最初の行に出力する
+    print server.base_url
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
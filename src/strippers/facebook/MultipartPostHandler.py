@@ -42,7 +42,6 @@ import urllib
 import urllib2
 import mimetools, mimetypes
 import os, stat
-from cStringIO import StringIO
 
 class Callable:
     def __init__(self, anycallable):
@@ -79,47 +78,112 @@ class MultipartPostHandler(urllib2.BaseHandler):
                    and request.get_header('Content-Type').find('multipart/form-data') != 0):
                     print "Replacing %s with %s" % (request.get_header('content-type'), 'multipart/form-data')
                 request.add_unredirected_header('Content-Type', contenttype)
+                # data is a MultipartBody streamed by httplib, so the length must be given up front
+                request.add_unredirected_header('Content-Length', str(len(data)))
 
             request.add_data(data)
         return request
 
     def multipart_encode(vars, files, boundary = None, buffer = None):
+        """Return the boundary and a MultipartBody that streams the encoded form.
+
+        The file contents are not read here: they are read in fixed-size blocks
+        while the body is sent, so memory use does not depend on the file size.
+        If a buffer is given, the whole body is written to it and returned as a
+        string instead (the old behaviour).
+        """
         if boundary is None:
             boundary = mimetools.choose_boundary()
-        if buffer is None:
-            buffer = StringIO()
+        parts = []
         for(key, value) in vars:
-            buffer.write('--%s\r\n' % boundary)
-            buffer.write('Content-Disposition: form-data; name="%s"' % key)
-            buffer.write('\r\n\r\n')
-            buffer.write(value)
-            buffer.write('\r\n')
-#            buffer += '--%s\r\n' % boundary
-#            buffer += 'Content-Disposition: form-data; name="%s"' % key
-#            buffer += '\r\n\r\n' + value + '\r\n'
+            parts.append('--%s\r\n' % boundary +
+                         'Content-Disposition: form-data; name="%s"' % key +
+                         '\r\n\r\n' + value + '\r\n')
         for(key, fd) in files:
-            file_size = os.fstat(fd.fileno())[stat.ST_SIZE]
 #            filename = fd.name.split('/')[-1]
             filename = 'filename'
             contenttype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
-            buffer.write('--%s\r\n' % boundary)
-            buffer.write('Content-Disposition: form-data; name="%s"; filename="%s"\r\n' % (key, filename))
-            buffer.write('Content-Type: %s\r\n' % contenttype)
-#            buffer += '--%s\r\n' % boundary
-#            buffer += 'Content-Disposition: form-data; name="%s"; filename="%s"\r\n' % (key, filename)
-#            buffer += 'Content-Type: %s\r\n' % contenttype
-            # buffer += 'Content-Length: %s\r\n' % file_size
-            fd.seek(0)
-            buffer.write('\r\n')
-            buffer.write(fd.read())
-            buffer.write('\r\n')
-        buffer.write('--%s--\r\n\r\n' % boundary)
-        buffer.seek(0)
-        return boundary, buffer.read()
+            parts.append('--%s\r\n' % boundary +
+                         'Content-Disposition: form-data; name="%s"; filename="%s"\r\n' % (key, filename) +
+                         'Content-Type: %s\r\n' % contenttype +
+                         '\r\n')
+            parts.append(fd)
+            parts.append('\r\n')
+        parts.append('--%s--\r\n\r\n' % boundary)
+        body = MultipartBody(parts)
+        if buffer is not None:
+            for block in iter(lambda: body.read(MultipartBody.blocksize), ''):
+                buffer.write(block)
+            buffer.seek(0)
+            return boundary, buffer.read()
+        return boundary, body
     multipart_encode = Callable(multipart_encode)
 
     https_request = http_request
 
+class MultipartBody:
+    """File-like multipart/form-data body.
+
+    parts is a list of strings and file objects. Files are read from the
+    beginning in blocks of at most blocksize bytes, and their sizes are taken
+    from fstat, so len() is known before anything is read. httplib sends
+    objects with a read() method block by block. seek(0) rewinds the body so
+    that a request can be sent again.
+    """
+    blocksize = 64 * 1024
+
+    def __init__(self, parts):
+        self._parts = []
+        self._length = 0
+        for part in parts:
+            if type(part) == str:
+                size = len(part)
+            else:
+                size = os.fstat(part.fileno())[stat.ST_SIZE]
+            self._parts.append((part, size))
+            self._length += size
+        self.seek(0)
+
+    def __len__(self):
+        return self._length
+
+    def seek(self, offset, whence=0):
+        if offset != 0 or whence != 0:
+            raise IOError("MultipartBody can only be rewound to the beginning")
+        self._index = 0
+        self._offset = 0
+
+    def tell(self):
+        return sum(size for part, size in self._parts[:self._index]) + self._offset
+
+    def read(self, size=-1):
+        chunks = []
+        remaining = size
+        while self._index < len(self._parts) and (size < 0 or remaining > 0):
+            part, part_size = self._parts[self._index]
+            if size < 0:
+                wanted = part_size - self._offset
+            else:
+                wanted = min(remaining, part_size - self._offset)
+            if type(part) == str:
+                chunk = part[self._offset:self._offset + wanted]
+            else:
+                if self._offset == 0:
+                    part.seek(0)
+                chunk = part.read(min(wanted, self.blocksize))
+                if not chunk and wanted:
+                    raise IOError("file shrank while it was being uploaded")
+            self._offset += len(chunk)
+            if self._offset >= part_size:
+                self._index += 1
+                self._offset = 0
+            chunks.append(chunk)
+            remaining -= len(chunk)
+            if size >= 0 and type(part) != str:
+                # return a block at a time for files so memory stays bounded
+                break
+        return ''.join(chunks)
+
 def main():
     import tempfile, sys
 
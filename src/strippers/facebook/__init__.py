@@ -1,7 +1,49 @@
+# vim:fileencoding=utf-8
 try:
     __import__('pkg_resources').declare_namespace(__name__)
 except ImportError:
     from pkgutil import extend_path
     __path__ = extend_path(__path__, __name__)
 
-from graphapi import *
+# graphapi は urllib2 や MultipartPostHandler などの読み込みに時間がかかるので、
+# パッケージのインポート時には読み込まず、graphapi の名前が最初に使われた時点で読み込む。
+# 認可 URL の作成と signed_request の検証は軽い oauth モジュールだけで済む。
+import sys
+from types import ModuleType
+from strippers.facebook.oauth import AUTHORIZATION_URI, TOKEN_URI, get_auth_url, parse_signed_request, SignedRequestVerifier
+
+
+class _LazyModule(ModuleType):
+    """
+    見つからない属性を graphapi モジュールから取得するパッケージモジュールです。
+    """
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name != '__all__':
+            raise AttributeError(name)
+        graphapi = __import__('strippers.facebook.graphapi', fromlist=['FacebookGraphAPI'])
+        if name == '__all__':
+            # from strippers.facebook import * では graphapi の名前をすべてインポートする
+            value = [ key for key in set(graphapi.__dict__) | set(self.__dict__) if not key.startswith('_') ]
+        else:
+            try:
+                value = getattr(graphapi, name)
+            except AttributeError:
+                raise AttributeError("'module' object has no attribute '%s'" % name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        graphapi = __import__('strippers.facebook.graphapi', fromlist=['FacebookGraphAPI'])
+        return sorted(set(self.__dict__) | set(graphapi.__dict__))
+
+
+def _install():
+    module = sys.modules[__name__]
+    lazy = _LazyModule(__name__, module.__doc__)
+    lazy.__dict__.update(module.__dict__)
+    # 元のモジュールが破棄されると、その名前空間(_LazyModule のメソッドのグローバル変数)が None で消去されるので、参照を保持しておく
+    lazy._module = module
+    sys.modules[__name__] = lazy
+
+_install()
@@ -0,0 +1,337 @@
+# vim:fileencoding=utf-8
+"""
+アプリケーションアクセストークン(app access token)を、プロセス内と、必要に応じて複数のプロセス間で共有します。
+
+FacebookGraphAPI.app_token、send_post_request_for_app()、TestUserAPI は、既定の AppTokenProvider から
+トークンを取得するので、同じアプリのトークンはプロセス内で 1 回だけ取得されます。
+複数のワーカープロセスで共有するには、ファイルのキャッシュを指定した AppTokenProvider を既定にします。
+
+from strippers.facebook import apptoken
+apptoken.set_default_provider(apptoken.AppTokenProvider(cache_file='/var/run/myapp/fb_app_token.json'))
+
+ファイルは fcntl.flock() のロックで保護されるので、デプロイ直後に多数のワーカーが同時に起動しても、
+トークンを取得するのはロックを取得した 1 つのプロセスだけで、他のプロセスはそのトークンを使います。
+/dev/shm 上のファイルを指定すると、ディスクに書き込まずに共有メモリで共有できます。
+"""
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+from urllib import urlencode
+from strippers.facebook import jsoncodec as json
+from strippers.facebook.oauth import TOKEN_URI
+from strippers.facebook.util import _Flight
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Windows ではプロセス間のロックを行わない
+
+try:
+    from urlparse import parse_qs
+except ImportError:
+    from cgi import parse_qs
+
+__author__ = 'otsuka'
+
+log = logging.getLogger(__name__)
+
+
+def fetch_app_token(app_id, app_secret, timeout=None):
+    """
+    API にアクセスして、アプリケーションアクセストークンを取得します。
+    http://developers.facebook.com/docs/authentication/#applogin
+
+    @param app_id: Facebook アプリの App ID
+    @type app_id: str, unicode
+    @param app_secret: Facebook アプリの App Secret
+    @type app_secret: str, unicode
+    @param timeout: タイムアウト秒数
+    @type timeout: int, float
+    @return: アプリケーションアクセストークンと、有効期間の秒数(期限がない場合は None)のタプル
+    @rtype: tuple
+    """
+    params = {
+        'client_id'    : app_id,
+        'client_secret': app_secret,
+        'grant_type'   : 'client_credentials',
+        }
+    params = dict((k, v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in params.items())
+    url = TOKEN_URI + '?' + urlencode(params)
+    if timeout is None:
+        res = urllib2.urlopen(url).read()
+    else:
+        res = urllib2.urlopen(url, timeout=timeout).read()
+    return parse_token_response(res)
+
+
+def parse_token_response(res):
+    """
+    /oauth/access_token のレスポンスボディから、アクセストークンと有効期間の秒数を取り出します。
+    JSON と、クエリ文字列の形式(access_token=...&expires=...)のどちらにも対応します。
+
+    @param res: レスポンスボディ
+    @type res: str
+    @return: アクセストークンと、有効期間の秒数(期限がない場合は None)のタプル
+    @rtype: tuple
+    """
+    if res.lstrip().startswith('{'):
+        data = json.loads(res)
+        expires = data.get('expires_in') or data.get('expires')
+        return str(data['access_token']), int(expires) if expires else None
+    data = parse_qs(res)
+    expires = data.get('expires', [None])[0]
+    return data['access_token'][0], int(expires) if expires else None
+
+
+class AppTokenProvider(object):
+    """
+    アプリケーションアクセストークンを取得し、有効期限までキャッシュします。
+    複数のスレッドから共有して使用することができます。
+
+    - 同じアプリのトークンを複数のスレッドが同時に要求した場合、取得は 1 回だけ行われます
+    - cache_file を指定すると、ファイルのロックで保護されたキャッシュを複数のプロセスで共有します
+    - トークンは ttl 秒、またはトークンの有効期限の refresh_margin 秒前のどちらか早い時点で取得し直します
+    """
+
+    def __init__(self, ttl=24 * 60 * 60, refresh_margin=60, cache_file=None, lock_timeout=30, fetch=None):
+        """
+        @param ttl: トークンをキャッシュする最大の秒数
+        @type ttl: int, float
+        @param refresh_margin: 有効期限のあるトークンを、期限のこの秒数前に取得し直します
+        @type refresh_margin: int, float
+        @param cache_file: プロセス間で共有するキャッシュファイルのパス。
+                           App Secret は保存しませんが、トークンを保存するのでパーミッションは 0600 で作成します
+        @type cache_file: str
+        @param lock_timeout: キャッシュファイルのロックを待つ最大の秒数。これを過ぎた場合はロックせずにトークンを取得します
+        @type lock_timeout: int, float
+        @param fetch: トークンを取得する関数。省略した場合は get() に渡された関数か、fetch_app_token
+        """
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.cache_file = cache_file
+        self.lock_timeout = lock_timeout
+        self._fetch = fetch
+        self._entries = {} # キー -> (トークン, 有効期限)
+        self._flights = {} # キー -> _Flight
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits'      : 0,
+            'file_hits' : 0,
+            'fetched'   : 0,
+        }
+
+    @staticmethod
+    def _key(app_id, app_secret):
+        # App Secret をファイルに保存しないように、ハッシュ値だけをキーに含める
+        return '%s:%s' % (app_id, hashlib.sha1(str(app_secret)).hexdigest()[:16])
+
+    def get(self, app_id, app_secret, fetch=None):
+        """
+        アプリケーションアクセストークンを返します。キャッシュにない場合や期限切れの場合は取得します。
+
+        @param app_id: Facebook アプリの App ID
+        @type app_id: str, unicode
+        @param app_secret: Facebook アプリの App Secret
+        @type app_secret: str, unicode
+        @param fetch: 生成時に fetch を指定しなかった場合に、トークンの取得に使う関数。
+                      FacebookGraphAPI は、自身のコネクションプールとリトライを使って取得する関数を渡します
+        @return: アプリケーションアクセストークン
+        @rtype: str
+        """
+        key = self._key(app_id, app_secret)
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.time():
+                self._stats['hits'] += 1
+                return entry[0]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        finally:
+            self._lock.release()
+
+        if not leader:
+            flight.event.wait()
+            if flight.exc_info is not None:
+                raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+            return flight.value
+
+        try:
+            token, expires_at = self._load(key, app_id, app_secret, fetch)
+            flight.value = token
+        except BaseException:
+            # KeyboardInterrupt などで中断された場合も、待っているスレッドに伝える
+            flight.exc_info = sys.exc_info()
+            raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._flights[key]
+                if flight.exc_info is None:
+                    self._entries[key] = (token, expires_at)
+            finally:
+                self._lock.release()
+            flight.event.set()
+        return token
+
+    def invalidate(self, app_id, app_secret, token=None):
+        """
+        キャッシュしているトークンを削除します。トークンが無効になった場合に呼び出してください。
+
+        @param app_id: Facebook アプリの App ID
+        @type app_id: str, unicode
+        @param app_secret: Facebook アプリの App Secret
+        @type app_secret: str, unicode
+        @param token: 無効だったトークン。指定した場合は、キャッシュしているトークンがこれと同じ場合だけ削除します
+                      (他のスレッドやプロセスが取得し直したトークンを削除しないように)
+        @type token: str
+        """
+        key = self._key(app_id, app_secret)
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None and (token is None or entry[0] == token):
+                del self._entries[key]
+        finally:
+            self._lock.release()
+        if self.cache_file is not None:
+            locked = self._lock_file()
+            try:
+                entries = self._read_file()
+                entry = entries.get(key)
+                if entry is not None and (token is None or entry.get('token') == token):
+                    del entries[key]
+                    self._write_file(entries)
+            finally:
+                self._unlock_file(locked)
+
+    def stats(self):
+        """
+        メモリのキャッシュにヒットした数、ファイルのキャッシュにヒットした数、API から取得した数を返します。
+
+        @rtype: dict
+        """
+        self._lock.acquire()
+        try:
+            return dict(self._stats)
+        finally:
+            self._lock.release()
+
+    def _count(self, name):
+        self._lock.acquire()
+        try:
+            self._stats[name] += 1
+        finally:
+            self._lock.release()
+
+    def _fetch_token(self, app_id, app_secret, fetch=None):
+        fetch = self._fetch or fetch or fetch_app_token
+        token, expires = fetch(app_id, app_secret)
+        self._count('fetched')
+        log.debug(u"アプリケーションアクセストークンを取得しました。[app_id=%s, expires=%s]", app_id, expires)
+        lifetime = self.ttl
+        if expires is not None:
+            lifetime = min(lifetime, max(0, expires - self.refresh_margin))
+        return token, time.time() + lifetime
+
+    def _load(self, key, app_id, app_secret, fetch=None):
+        """
+        キャッシュファイルに有効なトークンがあればそれを返し、なければ取得してキャッシュファイルに保存します。
+        """
+        if self.cache_file is None:
+            return self._fetch_token(app_id, app_secret, fetch)
+
+        locked = self._lock_file()
+        try:
+            # ロックを待っている間に、他のプロセスが取得したトークンを保存しているかもしれない
+            entries = self._read_file()
+            entry = entries.get(key)
+            if entry is not None and entry.get('expires_at', 0) > time.time():
+                self._count('file_hits')
+                return str(entry['token']), entry['expires_at']
+            token, expires_at = self._fetch_token(app_id, app_secret, fetch)
+            now = time.time()
+            entries = dict((k, v) for k, v in entries.items() if v.get('expires_at', 0) > now)
+            entries[key] = {'token': token, 'expires_at': expires_at}
+            self._write_file(entries)
+            return token, expires_at
+        finally:
+            self._unlock_file(locked)
+
+    def _lock_file(self):
+        """
+        キャッシュファイルのロックを取得し、ロックファイルを返します。
+        lock_timeout 秒以内にロックを取得できなかった場合や fcntl がない場合は None を返します。
+        """
+        if fcntl is None:
+            return None
+        f = open(self.cache_file + '.lock', 'a')
+        deadline = time.time() + self.lock_timeout
+        while True:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return f
+            except IOError:
+                if time.time() >= deadline:
+                    log.warning(u"キャッシュファイルのロックを取得できませんでした。[%s]", self.cache_file)
+                    f.close()
+                    return None
+                time.sleep(0.05)
+
+    @staticmethod
+    def _unlock_file(f):
+        if f is not None:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            finally:
+                f.close()
+
+    def _read_file(self):
+        try:
+            f = open(self.cache_file, 'rb')
+        except IOError:
+            return {}
+        try:
+            data = json.loads(f.read())
+        except ValueError:
+            log.warning(u"キャッシュファイルが壊れているので無視します。[%s]", self.cache_file)
+            return {}
+        finally:
+            f.close()
+        return data if isinstance(data, dict) else {}
+
+    def _write_file(self, entries):
+        # 書き込み中のファイルを他のプロセスが読まないように、一時ファイルに書き込んでから置き換える
+        directory = os.path.dirname(os.path.abspath(self.cache_file))
+        fd, path = tempfile.mkstemp(prefix='.apptoken', dir=directory) # mkstemp は 0600 で作成する
+        try:
+            os.write(fd, json.dumps(entries))
+        finally:
+            os.close(fd)
+        try:
+            os.rename(path, self.cache_file)
+        except OSError:
+            os.remove(path)
+            raise
+
+
+default_provider = AppTokenProvider()
+
+def set_default_provider(provider):
+    """
+    FacebookGraphAPI が app_token_provider を指定されなかった場合に使用する AppTokenProvider を設定します。
+
+    @param provider: 既定にする AppTokenProvider
+    @type provider: AppTokenProvider
+    """
+    global default_provider
+    if not hasattr(provider, 'get'):
+        raise TypeError('provider must have get(app_id, app_secret).')
+    default_provider = provider
@@ -0,0 +1,144 @@
+# vim:fileencoding=utf-8
+import logging
+from strippers.facebook.future import WorkerPool, PrefetchIterator
+from strippers.facebook.graphapi import FacebookGraphAPI
+from strippers.facebook.graphobject import FbUser, FbAlbum
+
+__author__ = 'otsuka'
+
+log = logging.getLogger(__name__)
+
+
+class AsyncFacebookGraphAPI(object):
+    """
+    API リクエストをワーカースレッドで実行し、結果を Future で返す FacebookGraphAPI です。
+    リクエストの完了を待つ間、呼び出し元のスレッドはブロックされません。
+
+    エラーは FacebookGraphAPI と同じ例外(ExpiredTokenError、InsufficientScopeError など)として、
+    Future の result() を呼び出した時点で送出されます。
+
+    api = AsyncFacebookGraphAPI(access_token, concurrency=20)
+    futures = [ api.get(api.BASE_URL + uid) for uid in uids ]
+    results = [ f.result() for f in futures ]
+    """
+
+    def __init__(self, access_token, app_id=None, app_secret=None, enable_gzip=True,
+                 concurrency=10, api=None, **kwargs):
+        """
+        @param access_token: 取得済みのアクセストークン
+        @type access_token: str
+        @param app_id: Facebook アプリの App ID
+        @type app_id: str
+        @param app_secret: Facebook アプリの App Secret
+        @type app_secret: str
+        @param enable_gzip: 通信時に Gzip 圧縮を有効にするか否か。デフォルトは True
+        @type enable_gzip: bool
+        @param concurrency: 同時に送信するリクエストの最大数
+        @type concurrency: int
+        @param api: リクエストの送信に使用する FacebookGraphAPI インスタンス。
+                    省略した場合は、他の引数から concurrency 本のコネクションを持つインスタンスを作成します
+        @type api: FacebookGraphAPI
+        @param kwargs: FacebookGraphAPI のその他の引数
+        """
+        if api is None:
+            kwargs.setdefault('pool_size', concurrency)
+            api = FacebookGraphAPI(access_token, app_id, app_secret, enable_gzip, **kwargs)
+        self.api = api
+        self.concurrency = concurrency
+        self._pool = WorkerPool(concurrency)
+
+    @property
+    def BASE_URL(self):
+        return self.api.BASE_URL
+
+    @property
+    def access_token(self):
+        return self.api.access_token
+
+    def submit(self, func, *args, **kwargs):
+        """
+        任意の関数をワーカースレッドで実行します。
+
+        @return: 関数の戻り値を表す Future
+        @rtype: strippers.facebook.future.Future
+        """
+        return self._pool.submit(func, *args, **kwargs)
+
+    def get(self, uri, params=None):
+        return self.submit(self.api.get, uri, params)
+
+    def send_get_request(self, uri, params=None):
+        return self.submit(self.api.send_get_request, uri, params)
+
+    def send_post_request(self, uri, params=None, content_type=None):
+        return self.submit(self.api.send_post_request, uri, params, content_type)
+
+    def send_post_request_for_app(self, uri, params=None, content_type=None):
+        return self.submit(self.api.send_post_request_for_app, uri, params, content_type)
+
+    def send_put_request(self, uri, params=None, content_type=None):
+        return self.submit(self.api.send_put_request, uri, params, content_type)
+
+    def send_delete_request(self, uri, params=None):
+        return self.submit(self.api.send_delete_request, uri, params)
+
+    def fql_query(self, query):
+        return self.submit(self.api.fql_query, query)
+
+    def search(self, type, q=None, limit=-1, fetch=None, **kwargs):
+        """
+        Graph オブジェクトを検索し、結果を反復するイテレータを返します。
+        次のページはワーカースレッドで取得されます。引数は FacebookGraphAPI.search() と同じです。
+
+        @rtype: strippers.facebook.future.PrefetchIterator
+        """
+        return self.iterate(self.api.search(type, q, limit, fetch, prefetch=0, **kwargs))
+
+    def search_place(self, q, latitude=None, longitude=None, distance=None, limit=-1):
+        """
+        場所を検索し、結果を反復するイテレータを返します。
+        次のページはワーカースレッドで取得されます。引数は FacebookGraphAPI.search_place() と同じです。
+
+        @rtype: strippers.facebook.future.PrefetchIterator
+        """
+        return self.iterate(self.api.search_place(q, latitude, longitude, distance, limit, prefetch=0))
+
+    def post(self, uid=u'me', message=None, link=None, picture=None, name=None, caption=None, description=None, actions=(), privacy=None, object_attachment=None):
+        return self.submit(self.api.post, uid, message, link, picture, name, caption, description, actions, privacy, object_attachment)
+
+    def iterate(self, iterable):
+        """
+        イテレータの次の要素をワーカースレッドで先に取得しながら反復するイテレータを返します。
+
+        @rtype: strippers.facebook.future.PrefetchIterator
+        """
+        return PrefetchIterator(self._pool, iterable)
+
+    def posts(self, uid=u'me', limit=-1, fetch=25, offset=0, since=None, until=None):
+        """
+        ユーザーのフィードへの投稿を反復するイテレータを返します。
+        次のページはワーカースレッドで取得されます。引数は FbUser.posts() と同じです。
+
+        @return: FbPost オブジェクトのイテレータ
+        @rtype: strippers.facebook.future.PrefetchIterator
+        """
+        user = FbUser(self.api, {'id': uid})
+        return self.iterate(user.posts(limit, fetch, offset, since, until))
+
+    def photos(self, album_id, limit=25, offset=0):
+        """
+        アルバムの写真を反復するイテレータを返します。
+        次のページはワーカースレッドで取得されます。引数は FbAlbum.photos() と同じです。
+
+        @return: FbPhoto オブジェクトのイテレータ
+        @rtype: strippers.facebook.future.PrefetchIterator
+        """
+        album = FbAlbum(self.api, {'id': album_id})
+        return self.iterate(album.photos(limit, offset))
+
+    def close(self):
+        """
+        ワーカースレッドを終了し、コネクションを閉じます。
+        """
+        self._pool.shutdown()
+        self.api.close()
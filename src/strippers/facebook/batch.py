@@ -0,0 +1,196 @@
+# vim:fileencoding=utf-8
+import httplib
+import logging
+import types
+import urllib2
+from urllib import urlencode
+from strippers.facebook.error import FacebookGraphAPIError
+from strippers.facebook.future import Future
+from strippers.facebook.graphapi import FacebookGraphAPI
+from strippers.facebook import jsoncodec as json
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+try:
+    from urlparse import parse_qs
+except ImportError:
+    from cgi import parse_qs
+
+__author__ = 'otsuka'
+
+log = logging.getLogger(__name__)
+
+
+class BatchFuture(Future):
+    """
+    バッチに追加したリクエストの結果を表す Future です。
+    バッチの送信前に result() を呼び出した場合は、その時点でバッチを送信します。
+    """
+
+    def __init__(self, batch):
+        super(BatchFuture, self).__init__()
+        self._batch = batch
+
+    def _wait(self, timeout):
+        if not self._done:
+            self._batch.execute()
+        super(BatchFuture, self)._wait(timeout)
+
+    def _chained_future(self):
+        return BatchFuture(self._batch)
+
+
+class GraphBatch(object):
+    """
+    Graph API のバッチリクエスト。
+    http://developers.facebook.com/docs/reference/api/batch/
+
+    FacebookGraphAPI と同じメソッドでリクエストを追加すると、結果の代わりに BatchFuture が返されます。
+    追加したリクエストは execute() を呼び出した時点、または with ブロックを抜けた時点で、
+    MAX_BATCH_SIZE 件ずつまとめて送信されます。
+    各リクエストの結果は、単独で送信した場合と同じ値、または同じ例外になります。
+
+    FbGraphObject の api にバッチを渡すと、そのオブジェクトのメソッドもバッチに追加されます。
+
+    with api.batch() as batch:
+        tagged = FbPhoto(batch, photo).tag(friend_id)
+        checkin = FbUser(batch, {'id': 'me'}).checkin(place, latitude, longitude)
+
+    送信後のバッチは、通常の FacebookGraphAPI と同じようにリクエストをすぐに送信します。
+    """
+
+    MAX_BATCH_SIZE = 50
+
+    def __init__(self, api):
+        """
+        @param api: FacebookGraphAPI インスタンス
+        @type api: FacebookGraphAPI
+        """
+        self.api = api
+        self._operations = []
+        self._executed = False
+
+    def __getattr__(self, name):
+        return getattr(self.api, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def __len__(self):
+        return len(self._operations)
+
+    # 送信処理を _send_api_request() に委ねている FacebookGraphAPI のメソッドは、そのままバッチで使える
+    send_post_request = FacebookGraphAPI.__dict__['send_post_request']
+    send_post_request_for_app = FacebookGraphAPI.__dict__['send_post_request_for_app']
+    send_get_request = FacebookGraphAPI.__dict__['send_get_request']
+    get = FacebookGraphAPI.__dict__['get']
+    send_put_request = FacebookGraphAPI.__dict__['send_put_request']
+    send_delete_request = FacebookGraphAPI.__dict__['send_delete_request']
+    fql_query = FacebookGraphAPI.__dict__['fql_query']
+    post = FacebookGraphAPI.__dict__['post']
+
+    def _then(self, res, callback):
+        if isinstance(res, Future):
+            return res.then(callback)
+        return callback(res)
+
+    def _send_api_request(self, uri, params=None, http_method='GET', content_type=None,
+                          access_token=None, use_app_token=False, try_count=None):
+        if self._executed:
+            return self.api._send_api_request(uri, params, http_method, content_type,
+                                              access_token, use_app_token, try_count)
+
+        if content_type == self.api.CONTENT_TYPE_MULTIPART:
+            raise TypeError('File uploads are not supported in a batch request.')
+        uri = self.api.to_utf8(uri)
+        base_url = self.api.to_utf8(self.api.BASE_URL)
+        if not uri.startswith(base_url):
+            raise TypeError('Only Graph API requests can be added to a batch request.')
+
+        if params is None:
+            data = ''
+        elif isinstance(params, types.DictType):
+            data = urlencode(self.api.encode_params(params))
+        else:
+            data = self.api.to_utf8(params)
+
+        query = {'access_token': access_token or self.api.access_token}
+        if use_app_token:
+            query['app_access_token'] = self.api.app_token
+        relative_url = uri[len(base_url):].lstrip('/') + '?' + urlencode(self.api.encode_params(query))
+
+        http_method = http_method.upper()
+        operation = {'method': http_method}
+        if http_method in ('POST', 'PUT'):
+            if data:
+                operation['body'] = data
+        elif data:
+            relative_url += '&' + data
+        operation['relative_url'] = relative_url
+
+        future = BatchFuture(self)
+        self._operations.append((operation, future))
+        return future
+
+    def execute(self):
+        """
+        追加されたリクエストを送信します。
+        一部のリクエストが失敗しても例外は送出せず、そのリクエストの BatchFuture に例外がセットされます。
+        """
+        self._executed = True
+        operations, self._operations = self._operations, []
+        for i in xrange(0, len(operations), self.MAX_BATCH_SIZE):
+            self._execute_chunk(operations[i:i + self.MAX_BATCH_SIZE])
+
+    def _execute_chunk(self, operations):
+        log.debug(u"%d 件のリクエストをバッチで送信します。", len(operations))
+        params = {'batch': json.dumps([ operation for operation, future in operations ])}
+        try:
+            res = self.api.send_post_request(self.api.BASE_URL, params)
+            results = json.loads(res)
+        except Exception:
+            for operation, future in operations:
+                future.set_exception()
+            return
+
+        for i, (operation, future) in enumerate(operations):
+            if operation['method'] != 'GET' and self.api.response_cache is not None:
+                path, query = operation['relative_url'].split('?', 1)
+                self.api._invalidate_cache(path, parse_qs(query)['access_token'][0])
+            result = results[i] if i < len(results) else None
+            if result is None:
+                # タイムアウトなどで実行されなかったリクエスト
+                future.set_exception(FacebookGraphAPIError(
+                    u"バッチ内のリクエストが実行されませんでした。[%s %s]" % (operation['method'], operation['relative_url'])))
+                continue
+            try:
+                body = self._extract_body(operation, result)
+            except Exception:
+                future.set_exception()
+            else:
+                future.set_result(body)
+
+    def _extract_body(self, operation, result):
+        """
+        バッチレスポンスの 1 件分から、単独で送信した場合と同じレスポンスボディを取り出します。
+        エラーの場合は、単独で送信した場合と同じ例外を送出します。
+        """
+        code = int(result.get('code', 200))
+        body = result.get('body') or ''
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        if 200 <= code < 300:
+            return body
+
+        header_lines = [ u'%s: %s\r\n' % (h['name'], h['value']) for h in result.get('headers') or () ]
+        headers = httplib.HTTPMessage(StringIO(self.api.to_utf8(u''.join(header_lines)) + '\r\n'))
+        e = urllib2.HTTPError(self.api.BASE_URL + operation['relative_url'], code,
+                              httplib.responses.get(code, ''), headers, StringIO(body))
+        self.api._raise_mapped_error(e)
+        raise e
@@ -0,0 +1,190 @@
+# vim:fileencoding=utf-8
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+
+__author__ = 'otsuka'
+
+log = logging.getLogger(__name__)
+
+
+class CacheEntry(object):
+
+    __slots__ = ('body', 'etag', 'expires_at', 'object_id', 'size')
+
+    def __init__(self, body, etag, expires_at, object_id):
+        self.body = body
+        self.etag = etag
+        self.expires_at = expires_at
+        self.object_id = object_id
+        self.size = len(body)
+
+    @property
+    def fresh(self):
+        return time.time() < self.expires_at
+
+
+class ResponseCache(object):
+    """
+    GET リクエストのレスポンスボディをキャッシュします。
+    エントリ数とバイト数の上限を超えた場合は、最も長く使われていないエントリから削除します(LRU)。
+
+    有効期限が切れたエントリに ETag がある場合は、If-None-Match ヘッダで再検証し、
+    304 Not Modified が返されればキャッシュしたボディを再利用します。
+
+    cache = ResponseCache(ttls=[(r'^[^/]+/picture', 3600), (r'/feed$', 0)])
+    api = FacebookGraphAPI(access_token, response_cache=cache)
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=10 * 1024 * 1024, default_ttl=300, ttls=()):
+        """
+        @param max_entries: キャッシュするエントリ数の上限
+        @type max_entries: int
+        @param max_bytes: キャッシュするレスポンスボディの合計バイト数の上限
+        @type max_bytes: int
+        @param default_ttl: キャッシュの有効期間(秒)。0 の場合はキャッシュしません
+        @type default_ttl: int, float
+        @param ttls: エンドポイント毎の有効期間。BASE_URL からの相対パスにマッチする正規表現と秒数のタプルのリスト。
+                     先にマッチしたものが使用されます
+        @type ttls: list, tuple
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._ttls = [ (re.compile(pattern), ttl) for pattern, ttl in ttls ]
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits'         : 0,
+            'misses'       : 0,
+            'revalidations': 0,
+            'evictions'    : 0,
+            'invalidations': 0,
+        }
+
+    def ttl_for(self, path):
+        """
+        エンドポイントのキャッシュ有効期間を返します。
+
+        @param path: BASE_URL からの相対パス
+        @type path: str
+        @rtype: int, float
+        """
+        for pattern, ttl in self._ttls:
+            if pattern.search(path):
+                return ttl
+        return self.default_ttl
+
+    def lookup(self, key):
+        """
+        キャッシュのエントリを返します。有効期限が切れたエントリも返すので、fresh 属性を確認してください。
+
+        @return: CacheEntry。キャッシュされていない場合は None
+        @rtype: CacheEntry
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries[key] = entry
+            if entry.fresh:
+                self._stats['hits'] += 1
+            else:
+                self._stats['misses'] += 1
+            return entry
+        finally:
+            self._lock.release()
+
+    def store(self, key, body, etag=None, ttl=None, object_id=None):
+        """
+        レスポンスボディをキャッシュします。
+
+        @param key: キャッシュのキー
+        @param body: レスポンスボディ
+        @type body: str
+        @param etag: レスポンスの ETag ヘッダの値
+        @type etag: str
+        @param ttl: 有効期間(秒)。省略した場合は default_ttl
+        @type ttl: int, float
+        @param object_id: レスポンスの Graph オブジェクトの ID。invalidate() で使用します。
+                          ハッシュ可能であれば、文字列以外(トークン毎の me を表すタプルなど)でも構いません
+        @type object_id: str, tuple
+        """
+        if ttl is None:
+            ttl = self.default_ttl
+        if ttl <= 0 or len(body) > self.max_bytes:
+            return
+        entry = CacheEntry(body, etag, time.time() + ttl, object_id)
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+            self._entries[key] = entry
+            self._bytes += entry.size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+                self._stats['evictions'] += 1
+        finally:
+            self._lock.release()
+
+    def revalidated(self, key, ttl=None):
+        """
+        304 Not Modified で再検証できたエントリの有効期限を延長します。
+        """
+        if ttl is None:
+            ttl = self.default_ttl
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.expires_at = time.time() + ttl
+                self._stats['revalidations'] += 1
+        finally:
+            self._lock.release()
+
+    def invalidate(self, object_id):
+        """
+        指定された Graph オブジェクトのエントリをすべて削除します。
+
+        @param object_id: Graph オブジェクトの ID。store() で指定したもの
+        @type object_id: str, tuple
+        """
+        self._lock.acquire()
+        try:
+            keys = [ key for key, entry in self._entries.iteritems() if entry.object_id == object_id ]
+            for key in keys:
+                self._bytes -= self._entries.pop(key).size
+            self._stats['invalidations'] += len(keys)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._bytes = 0
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        ヒット数、ミス数、削除数などの統計情報を返します。
+
+        @return: 統計情報の dict
+        @rtype: dict
+        """
+        self._lock.acquire()
+        try:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        finally:
+            self._lock.release()
+        return stats
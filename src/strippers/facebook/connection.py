@@ -0,0 +1,470 @@
+# vim:fileencoding=utf-8
+import errno
+import httplib
+import logging
+import socket
+import threading
+import time
+import urllib2
+import zlib
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+__author__ = 'otsuka'
+
+log = logging.getLogger(__name__)
+
+
+class ConnectionPool(object):
+    """
+    HTTP/1.1 の keep-alive コネクションをホスト毎にプールします。
+    複数のスレッドから共有して使用することができます。
+    """
+
+    def __init__(self, maxsize=10, idle_timeout=60, timeout=None):
+        """
+        @param maxsize: 1 ホストあたりに同時に開くコネクションの最大数
+        @type maxsize: int
+        @param idle_timeout: 未使用のコネクションを保持しておく秒数。これを過ぎたコネクションは再利用せずに閉じます
+        @type idle_timeout: int, float
+        @param timeout: ソケットのタイムアウト秒数。None の場合はリクエストのタイムアウトを使用します
+        @type timeout: int, float
+        """
+        if maxsize < 1:
+            raise ValueError('maxsize must be greater than 0.')
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = {}   # key -> [(conn, released_at), ...]
+        self._sizes = {}  # key -> 貸し出し中と未使用を合わせたコネクション数
+        self._stats = {
+            'requests' : 0,
+            'created'  : 0,
+            'reused'   : 0,
+            'expired'  : 0,
+            'discarded': 0,
+        }
+
+    def acquire(self, scheme, host, tunnel=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        """
+        指定されたホストへのコネクションを取得します。
+        プールに未使用のコネクションがあればそれを返し、なければ新しく作成します。
+        コネクション数が上限に達している場合は、他のスレッドが返却するまで待ちます。
+
+        @return: プールのキー、コネクション、再利用したコネクションか否か のタプル
+        @rtype: tuple
+        """
+        key = (scheme, host, tunnel)
+        expired = []
+        self._cond.acquire()
+        try:
+            while True:
+                idle = self._idle.get(key)
+                while idle:
+                    conn, released_at = idle.pop()
+                    if self.idle_timeout is not None and time.time() - released_at > self.idle_timeout:
+                        expired.append(conn)
+                        self._sizes[key] -= 1
+                        self._stats['expired'] += 1
+                        continue
+                    self._stats['requests'] += 1
+                    self._stats['reused'] += 1
+                    return key, conn, True
+                if self._sizes.get(key, 0) < self.maxsize:
+                    self._sizes[key] = self._sizes.get(key, 0) + 1
+                    self._stats['requests'] += 1
+                    self._stats['created'] += 1
+                    break
+                self._cond.wait()
+        finally:
+            self._cond.release()
+            for conn in expired:
+                conn.close()
+
+        try:
+            conn = self._new_connection(scheme, host, tunnel, timeout)
+        except:
+            self._forget(key)
+            raise
+        return key, conn, False
+
+    def _new_connection(self, scheme, host, tunnel, timeout):
+        if self.timeout is not None:
+            timeout = self.timeout
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, timeout=timeout)
+        else:
+            conn = httplib.HTTPConnection(host, timeout=timeout)
+        if tunnel:
+            conn.set_tunnel(*tunnel)
+        log.debug(u"新しいコネクションを作成しました。[%s://%s]", scheme, host)
+        return conn
+
+    def release(self, key, conn):
+        """
+        使用済みのコネクションをプールに返却します。
+        """
+        self._cond.acquire()
+        try:
+            self._idle.setdefault(key, []).append((conn, time.time()))
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def discard(self, key, conn):
+        """
+        再利用できなくなったコネクションを閉じて、プールから取り除きます。
+        """
+        try:
+            conn.close()
+        finally:
+            self._cond.acquire()
+            try:
+                self._stats['discarded'] += 1
+            finally:
+                self._cond.release()
+            self._forget(key)
+
+    def _forget(self, key):
+        self._cond.acquire()
+        try:
+            self._sizes[key] -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def clear(self):
+        """
+        プールにある未使用のコネクションをすべて閉じます。
+        """
+        self._cond.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+            for key, conns in idle.items():
+                self._sizes[key] -= len(conns)
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+        for conns in idle.values():
+            for conn, released_at in conns:
+                conn.close()
+
+    def stats(self):
+        """
+        コネクションの作成数、再利用数などの統計情報を返します。
+
+        @return: 統計情報の dict
+        @rtype: dict
+        """
+        self._cond.acquire()
+        try:
+            stats = dict(self._stats)
+            stats['idle'] = sum(len(conns) for conns in self._idle.values())
+            stats['open'] = sum(self._sizes.values())
+        finally:
+            self._cond.release()
+        if stats['requests']:
+            stats['reuse_ratio'] = float(stats['reused']) / stats['requests']
+        else:
+            stats['reuse_ratio'] = 0.0
+        return stats
+
+
+class PooledResponseFile(object):
+    """
+    レスポンスボディを最後まで読み込んだ時点で、コネクションをプールに返却するファイルオブジェクトです。
+    """
+
+    def __init__(self, pool, key, conn, response):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._buffer = ''
+
+    def read(self, amt=None):
+        data = self._buffer
+        self._buffer = ''
+        if self._response is None:
+            return data
+        if amt is None:
+            data += self._response.read()
+        elif amt > len(data):
+            data += self._response.read(amt - len(data))
+        else:
+            self._buffer = data[amt:]
+            data = data[:amt]
+        if self._response.isclosed():
+            self._finish()
+        return data
+
+    def readline(self, limit=-1):
+        while self._response is not None and '\n' not in self._buffer:
+            if 0 <= limit <= len(self._buffer):
+                break
+            chunk = self._response.read(8192)
+            if self._response.isclosed():
+                self._finish()
+            if not chunk:
+                break
+            self._buffer += chunk
+        end = self._buffer.find('\n') + 1 or len(self._buffer)
+        if 0 <= limit < end:
+            end = limit
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+    def readlines(self, sizehint=0):
+        return list(iter(self.readline, ''))
+
+    def _finish(self):
+        response, self._response = self._response, None
+        if response.will_close:
+            self._pool.discard(self._key, self._conn)
+        else:
+            self._pool.release(self._key, self._conn)
+
+    def close(self):
+        """
+        レスポンスボディを読み切らずに閉じた場合は、コネクションを再利用せずに破棄します。
+        """
+        response, self._response = self._response, None
+        if response is not None:
+            response.close()
+            self._pool.discard(self._key, self._conn)
+
+    def __del__(self):
+        if getattr(self, '_response', None) is not None:
+            self.close()
+
+
+class KeepAliveHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+    """
+    ConnectionPool のコネクションを使って HTTP/HTTPS リクエストを送信する urllib2 のハンドラです。
+    urllib2.build_opener() に渡すと、デフォルトの HTTPHandler と HTTPSHandler の代わりに使用されます。
+    """
+
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'DELETE')
+
+    def __init__(self, pool):
+        urllib2.HTTPHandler.__init__(self)
+        self.pool = pool
+
+    @classmethod
+    def _can_resend(cls, method, e):
+        """
+        再利用したコネクションでのエラー e の後に、新しいコネクションでリクエストを送り直してよいか否かを判定します。
+        タイムアウトの場合は、サーバーがリクエストを処理中かもしれないので送り直しません。
+        冪等でないメソッドは、レスポンスを 1 バイトも受信する前に切断された
+        (サーバーが既に閉じていたコネクションに送信した)場合だけ送り直します。
+        """
+        if isinstance(e, socket.timeout):
+            return False
+        if method in cls.IDEMPOTENT_METHODS:
+            return True
+        if isinstance(e, httplib.BadStatusLine):
+            # 何も受信しなかった場合の line は Python のバージョンによって異なる
+            return e.line in ('', "''") or e.line.startswith('No status line received')
+        return isinstance(e, socket.error) and e.errno in (errno.ECONNRESET, errno.EPIPE)
+
+    def http_open(self, req):
+        return self._open(req, 'http')
+
+    def https_open(self, req):
+        return self._open(req, 'https')
+
+    def _open(self, req, scheme):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items() if k not in headers))
+        headers['Connection'] = 'keep-alive'
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        tunnel = None
+        if req._tunnel_host:
+            tunnel_headers = {}
+            proxy_auth_hdr = 'Proxy-Authorization'
+            if proxy_auth_hdr in headers:
+                tunnel_headers[proxy_auth_hdr] = headers.pop(proxy_auth_hdr)
+            tunnel = (req._tunnel_host, None, tunnel_headers)
+
+        # FacebookGraphAPI の計測で使用する時間とバイト数をリクエストに記録しておく
+        timings = req.timings = {'connect': 0.0, 'first_byte': 0.0, 'request_bytes': int(headers.get('Content-Length', 0))}
+        while True:
+            key, conn, reused = self.pool.acquire(scheme, host, tunnel, req.timeout)
+            try:
+                start = time.time()
+                if conn.sock is None:
+                    conn.connect()
+                    timings['connect'] = time.time() - start
+                    start = time.time()
+                conn.request(req.get_method(), req.get_selector(), req.get_data(), headers)
+                response = conn.getresponse(buffering=True)
+                timings['first_byte'] = time.time() - start
+            except (socket.error, httplib.HTTPException), e:
+                self.pool.discard(key, conn)
+                data = req.get_data()
+                if reused and self._can_resend(req.get_method(), e) and \
+                        (data is None or isinstance(data, basestring) or hasattr(data, 'seek')):
+                    # サーバー側で既に閉じられていた keep-alive コネクションなので、新しいコネクションでやり直す
+                    log.debug(u"再利用したコネクションが切断されていました。[%s://%s] %s", scheme, host, e)
+                    if hasattr(data, 'seek'):
+                        data.seek(0)
+                    continue
+                raise urllib2.URLError(e)
+            break
+
+        timings['status'] = response.status
+        fp = PooledResponseFile(self.pool, key, conn, response)
+        if not 200 <= response.status < 300:
+            # エラーレスポンスのボディは読まれずに捨てられることが多いので、先に読み切ってコネクションを返却しておく
+            raw = fp.read()
+            timings['response_bytes'] = len(raw)
+            body = raw
+            encoding = response.msg.getheader('Content-Encoding')
+            if encoding:
+                # エラーの内容(スロットリングのエラーコードなど)を解析できるように、展開してから返す
+                try:
+                    body = DecodingReader(StringIO(raw), encoding).read()
+                except zlib.error, e:
+                    log.debug(u"エラーレスポンスのボディを展開できませんでした。%s", e)
+                else:
+                    del response.msg['Content-Encoding']
+            timings['decoded_bytes'] = len(body)
+            fp = StringIO(body)
+
+        resp = urllib2.addinfourl(fp, response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+
+class DecodingReader(object):
+    """
+    Content-Encoding が gzip または deflate のレスポンスボディを、読み込みながら展開するファイルオブジェクトです。
+    圧縮されたボディ全体をメモリに読み込んでから展開することはしません。
+    """
+
+    CHUNK_SIZE = 16 * 1024
+
+    def __init__(self, fp, encoding=None):
+        """
+        @param fp: レスポンス
+        @type fp: urllib2.addinfourl
+        @param encoding: Content-Encoding ヘッダの値
+        @type encoding: str
+        """
+        self._fp = fp
+        encoding = (encoding or '').strip().lower()
+        if encoding in ('gzip', 'x-gzip'):
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            # zlib 形式が正しいが、ヘッダのない raw deflate を返すサーバーもあるので最初のデータを見て判定する
+            self._decompressor = None
+        else:
+            encoding = None
+            self._decompressor = None
+        self.encoding = encoding
+        self._buffer = ''
+        self._eof = False
+        self.raw_bytes = 0     # 受信した(圧縮されたままの)バイト数
+        self.decoded_bytes = 0 # 展開後のバイト数
+
+    def info(self):
+        return self._fp.info()
+
+    def geturl(self):
+        return self._fp.geturl()
+
+    def getcode(self):
+        return self._fp.getcode()
+
+    def _decompress(self, raw):
+        if self.encoding == 'deflate' and self._decompressor is None:
+            self._decompressor = zlib.decompressobj()
+            try:
+                return self._decompressor.decompress(raw)
+            except zlib.error:
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(raw)
+
+    def _read_chunk(self, size):
+        """
+        展開済みのデータを最大 size バイト程度読み込みます。データの終わりでは '' を返します。
+        """
+        while not self._eof:
+            raw = self._fp.read(size)
+            if raw:
+                self.raw_bytes += len(raw)
+            else:
+                self._eof = True
+            if self.encoding is None:
+                data = raw
+            elif raw:
+                data = self._decompress(raw)
+            elif self._decompressor is not None:
+                data = self._decompressor.flush()
+            else:
+                data = ''
+            if data:
+                self.decoded_bytes += len(data)
+                return data
+        return ''
+
+    def read(self, size=-1):
+        """
+        展開済みのレスポンスボディを読み込みます。
+
+        @param size: 読み込む最大バイト数。負の値の場合は残りをすべて読み込みます
+        @type size: int
+        @rtype: str
+        """
+        if size is None or size < 0:
+            if not self._buffer and not self._eof and self.raw_bytes == 0:
+                return self._read_all()
+            chunks = [self._buffer]
+            self._buffer = ''
+            chunks.extend(iter(lambda: self._read_chunk(self.CHUNK_SIZE), ''))
+            return ''.join(chunks)
+
+        while len(self._buffer) < size:
+            chunk = self._read_chunk(max(size - len(self._buffer), self.CHUNK_SIZE))
+            if not chunk:
+                break
+            self._buffer += chunk
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def _read_all(self):
+        # 展開後のデータをチャンクのリストにしてから連結すると展開後のサイズの 2 倍のメモリが必要になるので、
+        # まだ何も読んでいない場合は圧縮されたボディを一度に展開する
+        raw = self._fp.read()
+        self._eof = True
+        self.raw_bytes += len(raw)
+        if self.encoding is None:
+            data = raw
+        else:
+            data = self._decompress(raw)
+            data += self._decompressor.flush()
+        self.decoded_bytes += len(data)
+        return data
+
+    def __iter__(self):
+        """
+        展開済みのデータをチャンク単位で返します。ストリーミングパーサーに渡す場合に使用します。
+        """
+        if self._buffer:
+            data, self._buffer = self._buffer, ''
+            yield data
+        for chunk in iter(lambda: self._read_chunk(self.CHUNK_SIZE), ''):
+            yield chunk
+
+    def close(self):
+        self._fp.close()
@@ -1,5 +1,9 @@
 # vim:fileencoding=utf-8
+import errno
+import httplib
 import logging
+import socket
+import urllib2
 
 __author__ = 'otsuka'
 
@@ -39,3 +43,70 @@ class ExpiredTokenError(InvalidTokenError):
         super(ExpiredTokenError, self).__init__(message)
         self.auth_url = auth_url
 
+
+class RateLimitExceededError(FacebookGraphAPIError):
+    """
+    API の呼び出し回数の制限(スロットリング)に達した場合のエラー
+    """
+
+    def __init__(self, message, code=None):
+        super(RateLimitExceededError, self).__init__(message)
+        self.code = code
+
+
+class RepeatedLazyLoadError(FacebookGraphAPIError):
+    """
+    LazyLoadDetector が、同じ呼び出し元からの暗黙のロードの繰り返し(N+1 問題)を検出した場合のエラー
+    """
+
+    def __init__(self, message, call_site=None, report=None):
+        """
+        @param call_site: 呼び出し元の (ファイル名, 行番号, 関数名) のタプルのタプル
+        @type call_site: tuple
+        @param report: 呼び出し元の記録(LazyLoadDetector.report() の要素と同じ dict)
+        @type report: dict
+        """
+        super(RepeatedLazyLoadError, self).__init__(message)
+        self.call_site = call_site
+        self.report = report
+
+
+def is_transient_error(e):
+    """
+    リトライすれば成功する可能性のある一時的なエラーか否かを判定します。
+    コネクションの切断やタイムアウト、サーバー側の 5xx エラーが該当します。
+
+    @param e: 判定する例外
+    @type e: Exception
+    @rtype: bool
+    """
+    if isinstance(e, urllib2.HTTPError):
+        return e.code >= 500
+    if isinstance(e, urllib2.URLError):
+        return isinstance(e.reason, (socket.error, httplib.HTTPException))
+    return isinstance(e, (socket.error, httplib.HTTPException))
+
+
+# 接続を確立できなかったことを示す errno。リクエストは送信されていない
+_CONNECT_ERRNOS = (errno.ECONNREFUSED, errno.ENETUNREACH, errno.EHOSTUNREACH)
+
+def is_unsent_error(e):
+    """
+    サーバーがリクエストを処理していないことが確実なエラーか否かを判定します。
+    接続の失敗(接続の拒否、名前解決の失敗、到達不能)と、呼び出し回数の制限(429 やスロットリングのエラーコード)が該当します。
+    冪等でないリクエストは、このエラーの場合だけリトライできます。
+
+    @param e: 判定する例外
+    @type e: Exception
+    @rtype: bool
+    """
+    if isinstance(e, RateLimitExceededError):
+        return True
+    if isinstance(e, urllib2.HTTPError):
+        return e.code == 429
+    if isinstance(e, urllib2.URLError):
+        e = e.reason
+    if isinstance(e, socket.gaierror):
+        return True
+    # タイムアウトは、送信後にサーバーが処理している間に起きたものかもしれない
+    return isinstance(e, socket.error) and not isinstance(e, socket.timeout) and e.errno in _CONNECT_ERRNOS
@@ -0,0 +1,292 @@
+# vim:fileencoding=utf-8
+import logging
+import Queue
+import sys
+import threading
+
+__author__ = 'otsuka'
+
+log = logging.getLogger(__name__)
+
+
+class Future(object):
+    """
+    まだ完了していない処理の結果を表すオブジェクトです。
+    結果は result() で取得します。処理中に例外が発生していた場合は、result() を呼んだ時点で送出されます。
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        """
+        @return: 処理が完了していれば True
+        @rtype: bool
+        """
+        return self._done
+
+    def _wait(self, timeout):
+        self._cond.acquire()
+        try:
+            if not self._done:
+                self._cond.wait(timeout)
+            if not self._done:
+                raise TimeoutError()
+        finally:
+            self._cond.release()
+
+    def result(self, timeout=None):
+        """
+        処理の結果を返します。処理が完了していない場合は完了するまで待ちます。
+
+        @param timeout: 待つ最大秒数。None の場合は完了するまで待ちます
+        @type timeout: int, float
+        @return: 処理の結果
+        """
+        self._wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        処理中に発生した例外を返します。例外が発生していない場合は None を返します。
+
+        @param timeout: 待つ最大秒数。None の場合は完了するまで待ちます
+        @type timeout: int, float
+        @rtype: Exception
+        """
+        self._wait(timeout)
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def set_result(self, result):
+        self._complete(result, None)
+
+    def set_exception(self, exc_info=None):
+        """
+        @param exc_info: sys.exc_info() 形式のタプル、または例外オブジェクト。省略時は sys.exc_info()
+        """
+        if exc_info is None:
+            exc_info = sys.exc_info()
+        elif isinstance(exc_info, BaseException):
+            exc_info = (exc_info.__class__, exc_info, None)
+        self._complete(None, exc_info)
+
+    def _complete(self, result, exc_info):
+        self._cond.acquire()
+        try:
+            if self._done:
+                raise RuntimeError('Future is already done.')
+            self._result = result
+            self._exc_info = exc_info
+            self._done = True
+            callbacks, self._callbacks = self._callbacks, []
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+        for callback in callbacks:
+            self._invoke(callback)
+
+    def add_done_callback(self, callback):
+        """
+        処理が完了した時に呼び出す関数を登録します。既に完了している場合はすぐに呼び出されます。
+
+        @param callback: この Future を引数にとる関数
+        """
+        self._cond.acquire()
+        try:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._cond.release()
+        self._invoke(callback)
+
+    def _invoke(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            log.exception(u"Future のコールバックで例外が発生しました。")
+
+    def then(self, func):
+        """
+        処理の結果に func を適用した結果を表す新しい Future を返します。
+        この Future が例外で完了した場合は、新しい Future も同じ例外で完了します。
+
+        @param func: 処理の結果を引数にとる関数
+        @rtype: Future
+        """
+        future = self._chained_future()
+
+        def callback(f):
+            if f._exc_info is not None:
+                future.set_exception(f._exc_info)
+                return
+            try:
+                result = func(f._result)
+            except Exception:
+                future.set_exception()
+            else:
+                future.set_result(result)
+        self.add_done_callback(callback)
+        return future
+
+    def _chained_future(self):
+        return Future()
+
+
+class TimeoutError(Exception):
+    pass
+
+
+class CancelledError(Exception):
+    pass
+
+
+class WorkerPool(object):
+    """
+    関数を決められた数のワーカースレッドで並行して実行するスレッドプールです。
+    ワーカースレッドは必要になった時点で作成されます。
+    """
+
+    def __init__(self, size):
+        """
+        @param size: ワーカースレッドの最大数。同時に実行される関数の最大数になります
+        @type size: int
+        """
+        if size < 1:
+            raise ValueError('size must be greater than 0.')
+        self.size = size
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def submit(self, func, *args, **kwargs):
+        """
+        関数の実行を予約します。
+
+        @param func: 実行する関数
+        @return: 関数の戻り値を表す Future
+        @rtype: Future
+        """
+        future = Future()
+        self._lock.acquire()
+        try:
+            if self._shutdown:
+                raise RuntimeError('WorkerPool is already shut down.')
+            self._queue.put((future, func, args, kwargs))
+            if len(self._threads) < self.size:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+        return future
+
+    def map(self, func, iterable):
+        """
+        iterable の各要素に func を並行して適用し、結果を iterable と同じ順番で返します。
+
+        @rtype: list
+        """
+        futures = [ self.submit(func, item) for item in iterable ]
+        return [ future.result() for future in futures ]
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            future, func, args, kwargs = task
+            try:
+                result = func(*args, **kwargs)
+            except BaseException:
+                future.set_exception()
+            else:
+                future.set_result(result)
+            del task, future, func, args, kwargs
+
+    def shutdown(self, wait=True, cancel=False):
+        """
+        ワーカースレッドを終了します。
+
+        @param wait: ワーカースレッドの終了を待つか否か
+        @type wait: bool
+        @param cancel: まだ実行が始まっていない関数を取り消すか否か。
+                       取り消された関数の Future は CancelledError で完了します。False の場合はすべて実行されます
+        @type cancel: bool
+        """
+        self._lock.acquire()
+        try:
+            self._shutdown = True
+            if cancel:
+                while True:
+                    try:
+                        task = self._queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                    if task is not None:
+                        task[0].set_exception(CancelledError())
+            threads = list(self._threads)
+            for thread in threads:
+                self._queue.put(None)
+        finally:
+            self._lock.release()
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+def as_completed(futures):
+    """
+    Future を完了した順番に返すジェネレーターです。
+
+    @param futures: Future のリスト
+    @type futures: list
+    @rtype: generator
+    """
+    futures = list(futures)
+    completed = Queue.Queue()
+    for future in futures:
+        future.add_done_callback(completed.put)
+    for i in xrange(len(futures)):
+        yield completed.get()
+
+
+class PrefetchIterator(object):
+    """
+    イテレータの次の要素を WorkerPool で先に取得しておくイテレータです。
+    呼び出し側が 1 つの要素を処理している間に、次の要素の取得(ページングの HTTP リクエストなど)が進みます。
+    """
+
+    def __init__(self, pool, iterable):
+        """
+        @param pool: 次の要素の取得に使用する WorkerPool
+        @type pool: WorkerPool
+        @param iterable: 元のイテラブル。要素は 1 つずつ順番に取得されます
+        """
+        self._pool = pool
+        self._iterator = iter(iterable)
+        self._next = pool.submit(self._iterator.next)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._next is None:
+            raise StopIteration
+        try:
+            item = self._next.result()
+        except Exception: # StopIteration を含む
+            self._next = None
+            raise
+        self._next = self._pool.submit(self._iterator.next)
+        return item
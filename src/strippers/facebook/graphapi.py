@@ -1,19 +1,25 @@
 # vim:fileencoding=utf-8
-import base64
 import hashlib
-import hmac
 from urllib import urlencode
 import types
 import urllib2
 import re
 import logging
-import gzip
+import threading
+import time
 from datetime import datetime, timedelta
 from strippers.facebook import MultipartPostHandler
-from strippers.facebook.error import InvalidAuthCodeError, InvalidTokenError, FacebookGraphAPIError, ExpiredTokenError, InsufficientScopeError, InvalidRequestError
-from strippers.facebook.graphobject import FbUser, FbPost
+from strippers.facebook import apptoken
+from strippers.facebook.connection import ConnectionPool, KeepAliveHandler, DecodingReader
+from strippers.facebook.future import WorkerPool
+from strippers.facebook.error import InvalidAuthCodeError, InvalidTokenError, FacebookGraphAPIError, ExpiredTokenError, InsufficientScopeError, InvalidRequestError, RateLimitExceededError
+from strippers.facebook.graphobject import FbUser, FbPost, GraphPager
+from strippers.facebook.oauth import AUTHORIZATION_URI, TOKEN_URI, get_auth_url, parse_signed_request
+from strippers.facebook import jsoncodec as json
+from strippers.facebook.metrics import RequestMetrics, normalize_endpoint
 from strippers.facebook.rest import RestAPI
-from strippers.facebook.util import memoized
+from strippers.facebook.retry import RetryPolicy
+from strippers.facebook.util import cached
 
 try:
     from cStringIO import StringIO
@@ -23,13 +29,6 @@ try:
     from urlparse import parse_qs
 except ImportError:
     from cgi import parse_qs
-try:
-    import json
-except ImportError:
-    try:
-        from django.utils import simplejson as json
-    except ImportError:
-        import simplejson as json
 
 log = logging.getLogger(__name__)
 #log_handler = logging.StreamHandler()
@@ -38,9 +37,6 @@ log = logging.getLogger(__name__)
 
 __version__ = '0.8b'
 
-AUTHORIZATION_URI = 'https://www.facebook.com/dialog/oauth'
-TOKEN_URI         = 'https://graph.facebook.com/oauth/access_token'
-
 class FacebookGraphAPI(object):
 
     CONTENT_TYPE_MULTIPART = 'multipart/form-data'
@@ -48,7 +44,17 @@ class FacebookGraphAPI(object):
 
     BASE_URL = 'https://graph.facebook.com/'
 
-    def __init__(self, access_token, app_id=None, app_secret=None, enable_gzip=False):
+    THROTTLING_ERROR_CODES = (4, 17, 32, 341, 613) # API の呼び出し回数の制限を示すエラーコード
+    INVALID_TOKEN_ERROR_CODE = 190                 # アクセストークンが無効であることを示すエラーコード
+    EXPIRED_TOKEN_ERROR_SUBCODE = 463              # 190 のうち、有効期限切れを示すサブコード
+
+    MAX_IDS_PER_REQUEST = 50   # ?ids= で 1 回に取得するオブジェクトの最大数
+    MAX_IDS_LENGTH      = 1500 # URL が長くなりすぎないように、ids パラメータの長さを制限する
+
+    def __init__(self, access_token, app_id=None, app_secret=None, enable_gzip=True,
+                 connection_pool=None, pool_size=10, idle_timeout=60, response_cache=None,
+                 rate_limiter=None, retry_policy=None, lazy_decode=False, metrics=None,
+                 app_token_provider=None):
         """
 
         @param access_token: 取得済みのアクセストークン
@@ -57,14 +63,58 @@ class FacebookGraphAPI(object):
         @type app_id: str
         @param app_secret: Facebook アプリの App Secret。特定の API メソッドを使用する場合に必要になります
         @type app_secret: str
-        @param enable_gzip: 通信時に Gzip 圧縮を有効にするか否か
+        @param enable_gzip: 通信時に Gzip 圧縮を有効にするか否か。デフォルトは True
         @type enable_gzip: bool
+        @param connection_pool: 使用するコネクションプール。複数のインスタンスでプールを共有する場合に指定します。
+                                省略した場合は pool_size と idle_timeout で新しいプールを作成します
+        @type connection_pool: strippers.facebook.connection.ConnectionPool
+        @param pool_size: 1 ホストあたりに保持する keep-alive コネクションの最大数
+        @type pool_size: int
+        @param idle_timeout: 未使用の keep-alive コネクションを保持しておく秒数
+        @type idle_timeout: int, float
+        @param response_cache: GET リクエストのレスポンスをキャッシュする場合に指定します。
+                               複数のインスタンスで共有することもできます
+        @type response_cache: strippers.facebook.cache.ResponseCache
+        @param rate_limiter: リクエストの送信ペースを制御する場合に指定します。
+                             アプリ毎の制限を有効にするには、複数のインスタンスで共有してください
+        @type rate_limiter: strippers.facebook.ratelimit.RateLimiter
+        @param retry_policy: 一時的なエラーで失敗したリクエストのリトライ方法。
+                             省略した場合は、冪等なリクエストを最大 3 回まで試行する RetryPolicy を使用します。
+                             リトライしない場合は RetryPolicy(max_attempts=1) を指定してください
+        @type retry_policy: strippers.facebook.retry.RetryPolicy
+        @param lazy_decode: True の場合、FbGraphObject.load() で読み込んだレスポンスボディをすぐにはデコードせず、
+                            最初にフィールドにアクセスした時点でデコードします。
+                            デコードしていないボディは FbGraphObject.raw で取得できます。
+                            f(**obj) は属性にアクセスせずに dict の内容を読むので、先にフィールドにアクセスしてください
+        @type lazy_decode: bool
+        @param metrics: HTTP リクエスト毎の計測値(エンドポイント、ステータス、レイテンシ、バイト数、リトライ、エラー)を受け取るシンク。
+                        集計する場合は MetricsAggregator を指定します。省略した場合は計測しません
+        @type metrics: strippers.facebook.metrics.MetricsSink
+        @param app_token_provider: アプリケーションアクセストークンを取得する AppTokenProvider。
+                                   省略した場合は、プロセス内で共有する strippers.facebook.apptoken.default_provider を使用します
+        @type app_token_provider: strippers.facebook.apptoken.AppTokenProvider
         """
         self._app_id = app_id
         self._app_secret = app_secret
         self._access_token = access_token # アクセストークンを変更されたくないため _access_token にセット
         self.enable_gzip = enable_gzip
         self.expired_at = None
+        if connection_pool is None:
+            connection_pool = ConnectionPool(pool_size, idle_timeout)
+        self.connection_pool = connection_pool
+        # MultipartPostHandler は data が dict の場合にしか働かないので、常に組み込んでおく
+        self._opener = urllib2.build_opener(KeepAliveHandler(connection_pool),
+                                            MultipartPostHandler.MultipartPostHandler)
+        self.response_cache = response_cache
+        self.rate_limiter = rate_limiter
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self.retry_policy = retry_policy
+        self.lazy_decode = lazy_decode
+        self.metrics = metrics
+        self.app_token_provider = app_token_provider
+        self._owner_id = None # アクセストークンの所有者(me)の ID。キャッシュの削除に使うので、分かった時点でセットする
+        self._local = threading.local()
 
     @property
     def access_token(self):
@@ -75,6 +125,21 @@ class FacebookGraphAPI(object):
         """
         return self._access_token
 
+    def connection_stats(self):
+        """
+        コネクションプールの統計情報(コネクションの作成数、再利用数など)を返します。
+
+        @return: 統計情報の dict
+        @rtype: dict
+        """
+        return self.connection_pool.stats()
+
+    def close(self):
+        """
+        コネクションプールに保持している keep-alive コネクションを閉じます。
+        """
+        self.connection_pool.clear()
+
     def _create_request(self, uri, http_method):
         """
         指定された HTTP メソッドの urllib2.Request インスタンスを返します。
@@ -162,7 +227,7 @@ class FacebookGraphAPI(object):
         return self._send_api_request(uri, params, 'DELETE')
 
     def _send_api_request(self, uri, params=None, http_method='GET', content_type=None,
-                          access_token=None, use_app_token=False, try_count=1):
+                          access_token=None, use_app_token=False, try_count=None):
         """
         @param uri: リクエスト URI
         @type uri: str, unicode
@@ -172,6 +237,9 @@ class FacebookGraphAPI(object):
         @type http_method: str
         @param content_type: Content-Type
         @type content_type: str
+        @param try_count: 一時的なエラーの場合にリトライする、1 回目を含めた最大の試行回数。
+                          省略した場合は retry_policy の max_attempts
+        @type try_count: int
         """
         if params is None:
             data = ''
@@ -184,106 +252,476 @@ class FacebookGraphAPI(object):
             data = self.to_utf8(params)
 
         http_method = http_method.upper()
+        path = self._graph_path(uri)
 
         if not access_token:
-            uri += '?access_token=' + self.access_token
-        else:
-            uri += '?access_token=' + access_token
+            access_token = self.access_token
+        uri += '?access_token=' + access_token
 
         if use_app_token:
             uri += '&app_access_token=' + self.app_token
 
-        if http_method in ('POST', 'PUT'):
-            req = self._build_request(uri, http_method)
-            req.add_data(data)
-        else: # GET or DELETE
-            if data:
-                uri += '&' + str(data)
+        if http_method not in ('POST', 'PUT') and data:
+            uri += '&' + str(data)
+
+        cache = self.response_cache if path is not None else None
+        if cache is not None and http_method == 'GET':
+            token_hash = self._token_hash(access_token)
+            key = (path, data, token_hash, use_app_token)
+            object_id = self._cache_object_id(path, token_hash)
+
+        def send():
+            # MultipartPostHandler はリクエストの data を書き換えるので、試行毎にリクエストを作り直す
             req = self._build_request(uri, http_method)
-        return self.send_request(req, content_type)
+            if http_method in ('POST', 'PUT'):
+                req.add_data(data)
+            if cache is not None and http_method == 'GET':
+                body = self._send_cached_request(req, key, path, object_id)
+                if path == 'me' and access_token == self.access_token:
+                    self._remember_owner_id(body)
+                return body
+            return self.send_request(req, content_type)
+
+        # GET で method=post を指定して書き込むリクエストもあるので、実際の操作でリトライの可否を判定する
+        method = http_method
+        if isinstance(params, types.DictType) and params.get('method'):
+            method = str(params['method']).upper()
+        try:
+            return self._call_with_retry(send, method, try_count)
+        except InvalidTokenError:
+            if access_token != self.access_token:
+                # 呼び出し元が指定したトークン(TestUserAPI のアプリケーションアクセストークンなど)が無効だった。
+                # use_app_token の場合はユーザーのトークンも送っていて、どちらが無効なのか分からないので何もしない
+                self._invalidate_app_token(access_token)
+            raise
+        finally:
+            if cache is not None and http_method != 'GET':
+                self._invalidate_cache(path, access_token)
+
+    def _call_with_retry(self, send, method, try_count=None):
+        """
+        send() を retry_policy に従ってリトライしながら呼び出し、その戻り値を返します。
+        試行回数は metrics の attempt と last_attempt_count に記録されます。
+
+        @param send: リクエストを 1 回送信する関数
+        @param method: リトライの可否の判定に使う HTTP メソッド
+        @type method: str
+        @param try_count: 1 回目を含めた最大の試行回数。省略した場合は retry_policy の max_attempts
+        @type try_count: int
+        """
+        attempt = [0]
+
+        def send_once():
+            attempt[0] += 1
+            self._local.attempt = attempt[0]
+            return send()
+
+        try:
+            if self.retry_policy is None:
+                res, attempts = send_once(), 1
+            else:
+                res, attempts = self.retry_policy.call(send_once, method, try_count)
+            self._local.attempts = attempts
+            return res
+        except Exception, e:
+            self._local.attempts = getattr(e, 'attempts', 1)
+            raise
+        finally:
+            self._local.attempt = 1
+
+    def _get_page(self, uri):
+        """
+        ページングされた結果の paging.next の URI のページを取得します。
+        URI にはアクセストークンとパラメータが含まれているので、そのまま送信します。
+        _send_api_request() と同じく、リトライ、呼び出し回数の制限、計測の対象になります。
+
+        @param uri: paging.next の URI
+        @type uri: str, unicode
+        @return: レスポンスボディ
+        @rtype: str
+        """
+        return self._call_with_retry(lambda: self.send_request(self._build_request(uri)), 'GET')
+
+    @property
+    def last_attempt_count(self):
+        """
+        このスレッドで最後に送信した API リクエストの試行回数を返します。リトライしなかった場合は 1 です。
+
+        @rtype: int
+        """
+        return getattr(self._local, 'attempts', 0)
+
+    def _graph_path(self, uri):
+        """
+        Graph API の URI から BASE_URL を除いた相対パスを返します。Graph API 以外の URI の場合は None を返します。
+        """
+        uri = self.to_utf8(uri)
+        base_url = self.to_utf8(self.BASE_URL)
+        if uri.startswith(base_url):
+            return uri[len(base_url):].lstrip('/')
+        return None
+
+    def _token_hash(self, access_token):
+        return hashlib.sha1(self.to_utf8(access_token)).hexdigest()
+
+    @staticmethod
+    def _cache_object_id(path, token_hash):
+        """
+        path のレスポンスをキャッシュから削除する単位になる、Graph オブジェクトの ID を返します。
+        me はアクセストークン毎に別のオブジェクトなので、トークンのハッシュとのタプルにします。
+        """
+        object_id = path.split('/', 1)[0]
+        if object_id == 'me':
+            return ('me', token_hash)
+        return object_id
+
+    def _invalidate_cache(self, path, access_token):
+        """
+        path への書き込みによって古くなった Graph オブジェクトのエントリを、レスポンスキャッシュから削除します。
+        me とトークンの所有者の ID は同じオブジェクトなので、どちらに書き込んだ場合も両方を削除します。
+
+        @param path: BASE_URL からの相対パス
+        @type path: str
+        @param access_token: 書き込みに使用したアクセストークン
+        @type access_token: str
+        """
+        token_hash = self._token_hash(access_token)
+        object_id = self._cache_object_id(path, token_hash)
+        me = ('me', token_hash)
+        owner_id = None
+        if access_token == self.access_token:
+            owner_id = self._resolve_owner_id()
+        if owner_id is None:
+            # 所有者が分からなければ、ID で書き込んだ相手が所有者である可能性があるので、me のエントリも削除する
+            stale_ids = set([object_id, me])
+        elif object_id in (me, owner_id):
+            stale_ids = set([me, owner_id])
+        else:
+            stale_ids = set([object_id])
+        for stale_id in stale_ids:
+            self.response_cache.invalidate(stale_id)
+
+    def _resolve_owner_id(self):
+        """
+        アクセストークンの所有者の ID を返します。まだ分からない場合は /me?fields=id を取得します。
+        取得できなかった場合は None を返します。
+        """
+        if self._owner_id is None:
+            try:
+                self.get(self.BASE_URL + 'me', { 'fields': 'id' })
+            except Exception, e:
+                log.debug(u'アクセストークンの所有者の ID を取得できませんでした。%s', e)
+        return self._owner_id
+
+    def _remember_owner_id(self, body):
+        try:
+            owner_id = json.loads(body).get('id')
+        except Exception:
+            return
+        if owner_id:
+            self._owner_id = str(owner_id)
+
+    def _send_cached_request(self, req, key, path, object_id):
+        cache = self.response_cache
+        entry = cache.lookup(key)
+        if entry is not None:
+            if entry.fresh:
+                return entry.body
+            if entry.etag:
+                req.add_header('If-None-Match', entry.etag)
+
+        ttl = cache.ttl_for(path)
+        try:
+            body, headers = self._send_request(req)
+        except urllib2.HTTPError, e:
+            if e.code == 304 and entry is not None:
+                cache.revalidated(key, ttl)
+                return entry.body
+            raise
+        cache.store(key, body, headers.get('ETag'), ttl, object_id)
+        return body
 
     def send_request(self, req, content_type=None):
+        return self._send_request(req, content_type)[0]
+
+    def _send_request(self, req, content_type=None):
+        """
+        リクエストを送信し、レスポンスボディとレスポンスヘッダのタプルを返します。
+
+        @rtype: tuple
+        """
+        if self.metrics is None:
+            reader = self.open_request(req, content_type)
+            return reader.read(), reader.info()
+
+        start = time.time()
+        reader = None
+        try:
+            reader = self.open_request(req, content_type)
+            body = reader.read()
+        except Exception, e:
+            self._record_metrics(req, start, reader, e)
+            raise
+        self._record_metrics(req, start, reader)
+        return body, reader.info()
+
+    def _record_metrics(self, req, start, reader, error=None):
+        """
+        送信したリクエストの計測値を metrics に渡します。
+        """
+        total_time = time.time() - start
+        timings = getattr(req, 'timings', None) or {}
+        path = self._graph_path(req.get_full_url())
+        metrics = RequestMetrics(req.get_method(), normalize_endpoint(path if path is not None else req.get_full_url()),
+                                 connect_time=timings.get('connect', 0.0),
+                                 first_byte_time=timings.get('first_byte', 0.0),
+                                 total_time=total_time,
+                                 request_bytes=timings.get('request_bytes', 0),
+                                 status=timings.get('status'),
+                                 attempt=getattr(self._local, 'attempt', 1))
+        if reader is not None:
+            metrics.response_bytes = reader.raw_bytes
+            metrics.decoded_bytes = reader.decoded_bytes
+        elif 'response_bytes' in timings:
+            # エラーレスポンスのボディは KeepAliveHandler で展開されている
+            metrics.response_bytes = timings['response_bytes']
+            metrics.decoded_bytes = timings.get('decoded_bytes', metrics.response_bytes)
+        if error is not None and not (isinstance(error, urllib2.HTTPError) and error.code == 304):
+            metrics.error = error.__class__.__name__
+        try:
+            self.metrics.record(metrics)
+        except Exception:
+            log.exception(u"計測値の記録に失敗しました。")
+
+    def open_request(self, req, content_type=None):
+        """
+        リクエストを送信し、レスポンスボディを読み込むファイルオブジェクトを返します。
+        gzip または deflate で圧縮されたレスポンスは、読み込みながら展開されます。
+        大きなレスポンスを一度にメモリに読み込まずに、ストリーミングで処理する場合に使用します。
+
+        @param req: リクエスト
+        @type req: urllib2.Request
+        @param content_type: Content-Type
+        @type content_type: str
+        @return: 展開済みのレスポンスボディを読み込むファイルオブジェクト
+        @rtype: strippers.facebook.connection.DecodingReader
+        """
         if self.enable_gzip:
             req.add_header('Accept-Encoding', 'gzip,deflate')
 
         if content_type is not None:
             if content_type == self.CONTENT_TYPE_MULTIPART:
                 log.debug(u"MultipartPostHandlerを使用します。")
-                opener = urllib2.build_opener(MultipartPostHandler.MultipartPostHandler)
             else:
-                opener = urllib2.build_opener()
                 req.add_header('Content-Type', content_type)
-        else:
-            opener = urllib2.build_opener()
+
+        limiter = self.rate_limiter
+        if limiter is not None:
+            token = self._request_access_token(req)
+            if not limiter.acquire(token, self._app_id):
+                raise RateLimitExceededError(u"送信レートの制限により、リクエストを送信できませんでした。")
 
         try:
-            f = opener.open(req)
-            if f.info().get('Content-Encoding', '') == 'gzip':
-                return gzip.GzipFile('', 'r', 0, StringIO(f.read())).read()
-            else:
-                return f.read()
+            f = self._opener.open(req)
         except urllib2.HTTPError, e:
-            if 400 <= e.code < 500:
-                error_info = self._parse_error(e)
-                error_code = error_info.get('error')
-                if error_code == 'expired_token': # アクセストークンの有効期限切れ
-                    raise ExpiredTokenError(error_info.get('message'))
-                elif error_code == 'insufficient_scope': # アクセスに必要なスコープが認可されていない
-                    raise InsufficientScopeError(error_info.get('scope'))
-                elif error_code == 'invalid_request': # 不正なリクエスト内容
-                    raise InvalidRequestError(error_info.get('message'))
-                elif error_code == 'invalid_token': # 不正なアクセストークン
-                    raise InvalidTokenError(error_info.get('message'))
-                else: # その他
-                    raise
-            else:
-                raise
+            error = self._map_error(e)
+            if limiter is not None and isinstance(error, RateLimitExceededError):
+                limiter.throttled(token, self._app_id, error.code)
+            if error is not None:
+                raise error
+            raise
+        if limiter is not None:
+            limiter.succeeded(token, self._app_id)
+        return DecodingReader(f, f.info().get('Content-Encoding'))
+
+    @staticmethod
+    def _request_access_token(req):
+        """
+        リクエストの URL に含まれるアクセストークンを返します。
+        アプリケーションアクセストークンを含む場合(send_post_request_for_app())は、そちらを返します。
+        """
+        url = req.get_full_url()
+        match = re.search(r'[?&]app_access_token=([^&#]+)', url) or re.search(r'[?&]access_token=([^&#]+)', url)
+        if match:
+            return match.group(1)
+        return None
+
+    def _raise_mapped_error(self, e):
+        """
+        HTTPError の内容に対応する FacebookGraphAPIError のサブクラスの例外を送出します。
+        対応する例外がない場合は何もしません。
+
+        @param e: API アクセスのエラーレスポンス
+        @type e: urllib2.HTTPError
+        """
+        error = self._map_error(e)
+        if error is not None:
+            raise error
+
+    def _map_error(self, e):
+        """
+        HTTPError の内容に対応する FacebookGraphAPIError のサブクラスの例外を返します。
+        対応する例外がない場合は None を返します。
+
+        @param e: API アクセスのエラーレスポンス
+        @type e: urllib2.HTTPError
+        @rtype: FacebookGraphAPIError
+        """
+        if 400 <= e.code < 500:
+            error_info = self._parse_error(e)
+            error_code = error_info.get('error')
+            if error_code == 'expired_token': # アクセストークンの有効期限切れ
+                return ExpiredTokenError(error_info.get('message'))
+            elif error_code == 'insufficient_scope': # アクセスに必要なスコープが認可されていない
+                return InsufficientScopeError(error_info.get('scope'))
+            elif error_code == 'invalid_request': # 不正なリクエスト内容
+                return InvalidRequestError(error_info.get('message'))
+            elif error_code == 'invalid_token': # 不正なアクセストークン
+                return InvalidTokenError(error_info.get('message'))
+
+            error_body = self._parse_error_body(e)
+            if error_body.get('code') in self.THROTTLING_ERROR_CODES: # API の呼び出し回数の制限
+                return RateLimitExceededError(error_body.get('message'), error_body['code'])
+            if error_body.get('code') == self.INVALID_TOKEN_ERROR_CODE:
+                # トークンの交換などでは WWW-Authenticate ヘッダがなく、ボディの OAuthException だけが返される
+                if error_body.get('error_subcode') == self.EXPIRED_TOKEN_ERROR_SUBCODE:
+                    return ExpiredTokenError(error_body.get('message'))
+                return InvalidTokenError(error_body.get('message'))
+            if e.code == 429: # エラーコードのない HTTP の Too Many Requests
+                return RateLimitExceededError(error_body.get('message') or e.msg, error_body.get('code'))
+        return None
+
+    def _parse_error_body(self, e):
+        """
+        API アクセスのエラーレスポンスのボディ({"error": {"message": ..., "code": ...}})から error の値を返します。
+        読み込んだ後も、e.read() でボディを読めるようにしておきます。
+
+        @rtype: dict
+        """
+        if getattr(e, 'read', None) is None:
+            return {}
+        body = e.read()
+        fp = StringIO(body)
+        e.fp, e.read, e.readline = fp, fp.read, fp.readline
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return {}
+        error = data.get('error') if isinstance(data, types.DictType) else None
+        return error if isinstance(error, types.DictType) else {}
+
+    def _then(self, res, callback):
+        """
+        API のレスポンスに callback を適用した結果を返します。
+        バッチリクエスト中は、レスポンスが得られた時点で callback が適用される Future を返します。
+
+        @param res: API のレスポンス
+        @param callback: レスポンスを引数にとる関数
+        """
+        return callback(res)
+
+    def batch(self):
+        """
+        複数の API リクエストを 1 回の HTTP リクエストにまとめて送信するバッチを作成します。
+
+        with api.batch() as batch:
+            me = batch.get(api.BASE_URL + 'me')
+            feed = batch.post(message=u'Hello')
+        print me.result(), feed.result()
+
+        @return: GraphBatch オブジェクト
+        @rtype: strippers.facebook.batch.GraphBatch
+        """
+        from strippers.facebook.batch import GraphBatch
+        return GraphBatch(self)
 
     def fql_query(self, query):
+        """
+        FQL クエリを実行します。
+
+        query に クエリ名をキー、クエリを値とする dict を指定した場合は、すべてのクエリを 1 回のリクエストで実行します(multiquery)。
+        クエリの中では、他のクエリの結果を '#クエリ名' で参照できます。
+
+        api.fql_query({
+            'friends': 'SELECT uid2 FROM friend WHERE uid1 = me()',
+            'names'  : 'SELECT uid, name FROM user WHERE uid IN (SELECT uid2 FROM #friends)',
+        })
+
+        @param query: FQL クエリ、またはクエリ名とクエリの dict
+        @type query: str, unicode, dict
+        @return: 結果のリスト。query が dict の場合は、クエリ名をキー、結果のリストを値とする dict
+        @rtype: list, dict
+        """
         uri = self.BASE_URL + 'fql'
+        if isinstance(query, types.DictType):
+            res = self.get(uri, {'format': 'json', 'q': json.dumps(query)})
+            return self._then(res, self._parse_fql_multiquery_result)
         res = self.get(uri, {'format': 'json', 'q': query})
+        return self._then(res, self._parse_fql_result)
+
+    def _parse_fql_result(self, res):
         result = json.loads(res)
+        self._check_fql_error(result)
+        return result['data']
+
+    def _parse_fql_multiquery_result(self, res):
+        result = json.loads(res)
+        self._check_fql_error(result)
+        results = {}
+        for query_result in result['data']:
+            self._check_fql_error(query_result)
+            results[query_result['name']] = query_result['fql_result_set']
+        return results
+
+    @staticmethod
+    def _check_fql_error(result):
         if 'error_code' in result and 'error_msg' in result:
             error_code = result['error_code']
             if error_code == 190:
                 raise InvalidTokenError(result['error_msg'])
             else:
                 raise FacebookGraphAPIError(unicode(error_code) + u': ' + result['error_msg'])
-        return result['data']
 
     AVAILABLE_SEARCH_TYPES = (u'post', u'user', u'page', u'event', u'group', u'place', u'checkin')
 
-    def search(self, type, q=None, **kwargs):
+    def search(self, type, q=None, limit=-1, fetch=None, prefetch=0, **kwargs):
         """
         Graph オブジェクトを検索します。
 
-        @todo: 結果のページング
+        結果はすべてのページをたどるイテレータで返します。ページは反復に合わせて取得されるので、
+        反復をやめた時点でそれ以降のページは取得しません。
 
         @param type: Graph オブジェクトの種類。'post','user','page','event','group','place','checkin'のいずれか。
         @type type: str, unicode
         @param q: 検索キーワード
         @type q: str, unicode
-        @param kwargs:
-        @return: 検索結果の dict リスト
-        @rtype: list
+        @param limit: 取得する検索結果の件数。デフォルトの -1 の場合は、上限なしとなります
+        @type limit: int
+        @param fetch: 一度に取得する検索結果の件数。API には limit パラメータとして渡される値
+        @type fetch: int
+        @param prefetch: バックグラウンドで先に取得しておくページ数。0 の場合は必要になった時点で取得します
+        @type prefetch: int
+        @param kwargs: その他の検索パラメータ
+        @return: 検索結果の dict のイテレータ
+        @rtype: strippers.facebook.graphobject.GraphPager
         """
         if type not in self.AVAILABLE_SEARCH_TYPES:
             raise TypeError
 
-        uri = self.BASE_URL + u'/search'
+        uri = self.BASE_URL + u'search'
         params = {'type': type}
         if q:
             params['q'] = q
+        if fetch:
+            params['limit'] = fetch
         params.update(kwargs)
-        res = self.get(uri, params)
-        data = json.loads(res)
-        return data['data']
+        return GraphPager(self, uri, params, limit=limit, prefetch=prefetch)
 
-    def search_place(self, q, latitude=None, longitude=None, distance=None):
+    def search_place(self, q, latitude=None, longitude=None, distance=None, limit=-1, prefetch=0):
         """
         場所を検索します。
 
-        結果は次のような dict のリストです。
+        結果は次のような dict のイテレータです。
         {u'category': u'Train station',
          u'id': u'204173452939599',
          u'location': {u'city': u'Setagaya-ku',
@@ -292,15 +730,17 @@ class FacebookGraphAPI(object):
                        u'longitude': 139.66127502838},
          u'name': u'Komazawa-daigaku Station'}
 
-        @todo: 結果のページング
-
         @param q: 検索キーワード
         @type q: str, unicode
         @param latitude: 中心地の緯度
         @param longitude: 中心地の経度
         @param distance: 中心地からの距離。単位はメートル
-        @return: 検索結果の dict リスト
-        @rtype: list
+        @param limit: 取得する検索結果の件数。デフォルトの -1 の場合は、上限なしとなります
+        @type limit: int
+        @param prefetch: バックグラウンドで先に取得しておくページ数。0 の場合は必要になった時点で取得します
+        @type prefetch: int
+        @return: 検索結果の dict のイテレータ
+        @rtype: strippers.facebook.graphobject.GraphPager
         """
         if (latitude is None and longitude is not None) or (latitude is not None and longitude is None):
             raise TypeError
@@ -312,19 +752,54 @@ class FacebookGraphAPI(object):
             params['center'] = unicode(latitude) + u',' + unicode(longitude)
         if distance:
             params['distance'] = distance
-        return self.search('place', q, **params)
+        return self.search('place', q, limit=limit, prefetch=prefetch, **params)
 
     @property
-    @memoized
     def app_token(self):
         """
         アプリケーションアクセストークン(app access token)を取得します。
         http://developers.facebook.com/docs/authentication/#applogin
 
+        トークンは app_token_provider にキャッシュされ、同じアプリの他のインスタンスと共有されます。
+        取得する場合は、このインスタンスのコネクションプールを使い、リトライ、送信レートの制限、計測の対象になります。
+
         @return: アプリケーションアクセストークン
         @rtype: str
         """
-        return get_app_token(self._app_id, self._app_secret)
+        provider = self._app_token_provider()
+        if isinstance(provider, apptoken.AppTokenProvider):
+            return provider.get(self._app_id, self._app_secret, self._fetch_app_token)
+        return provider.get(self._app_id, self._app_secret)
+
+    def _fetch_app_token(self, app_id, app_secret):
+        """
+        app_token_provider がアプリケーションアクセストークンを取得するために呼び出します。
+
+        @return: アプリケーションアクセストークンと、有効期間の秒数(期限がない場合は None)のタプル
+        @rtype: tuple
+        """
+        params = {
+            'client_id'    : app_id,
+            'client_secret': app_secret,
+            'grant_type'   : 'client_credentials',
+            }
+        url = self._token_uri() + '?' + urlencode(self.encode_params(params))
+        res = self._call_with_retry(lambda: self.send_request(self._build_request(url)), 'GET')
+        return apptoken.parse_token_response(res)
+
+    def _token_uri(self):
+        # BASE_URL を置き換えた場合(テスト用のサーバーなど)は、そのサーバーからトークンを取得する
+        return self.BASE_URL + 'oauth/access_token'
+
+    def _app_token_provider(self):
+        return self.app_token_provider or apptoken.default_provider
+
+    def _invalidate_app_token(self, token):
+        """
+        token が共有しているアプリケーションアクセストークンであれば、キャッシュから削除して次回は取得し直すようにします。
+        """
+        if self._app_id and self._app_secret:
+            self._app_token_provider().invalidate(self._app_id, self._app_secret, token)
 
     @property
     def rest_api(self):
@@ -334,16 +809,80 @@ class FacebookGraphAPI(object):
         """
         return RestAPI(self)
 
-    def user(self, uid='me'):
+    def user(self, uid='me', fields=None):
         """
+        @param uid: ユーザー ID
+        @param fields: 読み込むフィールドのリスト。指定した場合は、そのフィールドだけを読み込んだ FbUser を返します
+        @type fields: list, tuple
         @rtype: strippers.facebook.graphobject.FbUser
         """
-        return FbUser(self, {'id': uid})
+        user = FbUser(self, {'id': uid})
+        if fields:
+            user.load(fields)
+        return user
 
     @property
     def me(self):
         return self.user()
 
+    def get_objects(self, ids, fields=None, concurrency=4):
+        """
+        複数の Graph オブジェクトを ?ids= パラメータでまとめて取得します。
+        ID は URL が長くなりすぎないように分割され、分割されたリクエストは並行して送信されます。
+
+        @param ids: オブジェクト ID のリスト
+        @type ids: list, tuple
+        @param fields: 取得するフィールドのリスト。省略した場合はデフォルトのフィールドを取得します
+        @type fields: list, tuple
+        @param concurrency: 同時に送信するリクエストの最大数
+        @type concurrency: int
+        @return: オブジェクト ID をキー、オブジェクトのフィールドデータを値とする dict
+        @rtype: dict
+        """
+        chunks = self._chunk_ids(ids)
+        params = {}
+        if fields:
+            params['fields'] = ','.join(fields)
+
+        def fetch(chunk):
+            chunk_params = dict(params, ids=u','.join(chunk))
+            res = self.get(self.BASE_URL, chunk_params)
+            return json.loads(res)
+
+        if len(chunks) <= 1:
+            responses = map(fetch, chunks)
+        else:
+            pool = WorkerPool(min(concurrency, len(chunks)))
+            try:
+                responses = pool.map(fetch, chunks)
+            finally:
+                pool.shutdown(wait=False)
+
+        results = {}
+        for data in responses:
+            results.update(data)
+        return results
+
+    def _chunk_ids(self, ids):
+        chunks = []
+        chunk = []
+        length = 0
+        seen = set()
+        for id in ids:
+            id = unicode(id)
+            if id in seen:
+                continue
+            seen.add(id)
+            if chunk and (len(chunk) >= self.MAX_IDS_PER_REQUEST or length + len(id) + 1 > self.MAX_IDS_LENGTH):
+                chunks.append(chunk)
+                chunk = []
+                length = 0
+            chunk.append(id)
+            length += len(id) + 1
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
     def post(self, uid=u'me', message=None, link=None, picture=None, name=None, caption=None, description=None, actions=(), privacy=None, object_attachment=None):
         """
         指定されたユーザーのウォールに書き込みます。
@@ -383,10 +922,9 @@ class FacebookGraphAPI(object):
             params['object_attachment'] = object_attachment
 
         res = self.send_post_request(url, params)
-        data = json.loads(res)
-        return FbPost(self, data)
+        return self._then(res, lambda res: FbPost(self, json.loads(res)))
 
-    @memoized
+    @cached
     def permissions(self):
         """
         ユーザーがアプリケーションに認可しているパーミッション(スコープ)のリストを返します。
@@ -422,6 +960,7 @@ class FacebookGraphAPI(object):
     def extend_access_token_expiration(self):
         """
         Client-side OAuth や署名リクエストから取得したアクセストークンの有効期限を延長します。
+        レスポンスに有効期限が含まれている場合は expired_at を更新します。
 
         @return: 新しいアクセストークン
         @rtype: str
@@ -433,11 +972,25 @@ class FacebookGraphAPI(object):
             'fb_exchange_token': self.access_token,
             }
         params = self.encode_params(params)
-        url = TOKEN_URI + '?' + urlencode(params)
-        res = urllib2.urlopen(url)
+        url = self._token_uri() + '?' + urlencode(params)
+        try:
+            res = self._opener.open(url)
+        except urllib2.HTTPError, e:
+            self._raise_mapped_error(e)
+            raise
         res = res.read()
-        data = parse_qs(res)
-        self._access_token = data['access_token'][0]
+        if res.lstrip().startswith('{'):
+            data = json.loads(res)
+            access_token = data['access_token']
+            expires = data.get('expires_in') or data.get('expires')
+        else:
+            data = parse_qs(res)
+            access_token = data['access_token'][0]
+            expires = data.get('expires', [None])[0]
+        self._access_token = self.to_utf8(access_token)
+        if expires:
+            self.expired_at = datetime.now() + timedelta(seconds=int(expires))
+            log.debug(u"Access token expires at %s.", self.expired_at)
         return self._access_token
 
 
@@ -446,52 +999,13 @@ def get_app_token(app_id, app_secret):
     アプリケーションアクセストークン(app access token)を取得します。
     http://developers.facebook.com/docs/authentication/#applogin
 
-    @return: アプリケーションアクセストークン
-    @rtype: str
-    """
-    params = {
-        'client_id'    : app_id,
-        'client_secret': app_secret,
-        'grant_type'   : 'client_credentials',
-        }
-
-    params = FacebookGraphAPI.encode_params(params)
-    url = TOKEN_URI + '?' + urlencode(params)
-    res = urllib2.urlopen(url)
-    res = res.read()
-    data = parse_qs(res)
-    return data['access_token'][0]
-
-def get_auth_url(app_id, scopes, redirect_uri, state=None, display=None):
-    """
-    OAuth 認可ページ の URL を返します。
+    トークンは strippers.facebook.apptoken.default_provider にキャッシュされます。
+    キャッシュを使わずに取得する場合は strippers.facebook.apptoken.fetch_app_token() を使用してください。
 
-    @param app_id: Facebook アプリの App ID
-    @type app_id: str, unicode
-    @param scopes: 認可を求めるパーミッションのリスト
-    @type scopes: list, tuple
-    @param redirect_uri: 認可後のリダイレクト先 URL
-    @type redirect_uri: str, unicode
-    @param state:
-    @param display: 認可ダイアログの表示方法。'page', 'popup', 'iframe', 'touch', 'wap' のいずれか。デフォルトは 'page'
-    @type display: str, unicode
-    @return: OAuth 認可ページの URL
+    @return: アプリケーションアクセストークン
     @rtype: str
     """
-    params = {
-        'client_id'     : app_id,
-        'response_type' : 'code',
-        'redirect_uri'  : redirect_uri,
-        }
-    if state:
-        params['state'] = state
-    if display:
-        if display in ('page', 'popup', 'iframe', 'touch', 'wap'):
-            params['display'] = display
-        else:
-            raise ValueError, "'%s' is invalid for display." % display
-    params['scope'] = ','.join(scopes)
-    return AUTHORIZATION_URI + '?' + urlencode(params)
+    return apptoken.default_provider.get(app_id, app_secret)
 
 def initialze_by_auth_code(app_id, app_secret, auth_code, redirect_uri):
     """
@@ -569,44 +1083,3 @@ def initialze(app_id, app_secret, auth_code_or_cookies, redirect_uri=''):
         return initialze_by_auth_code(app_id, app_secret, str(auth_code_or_cookies), redirect_uri)
     else:
         raise TypeError
-
-def parse_signed_request(signed_request, app_secret):
-    """
-
-    https://github.com/pythonforfacebook/facebook-sdk から
-
-    Return dictionary with signed request data.
-
-    We return a dictionary containing the information in the signed_request. This will
-    include a user_id if the user has authorised your application, as well as any
-    information requested in the scope.
-
-    If the signed_request is malformed or corrupted, False is returned.
-
-    @param signed_request:
-    @type signed_request: str
-    @param app_secret:
-    @type app_secret: str
-    @rtype: dict
-    """
-    try:
-        l = signed_request.split('.', 2)
-        encoded_sig = str(l[0])
-        payload = str(l[1])
-        sig = base64.urlsafe_b64decode(encoded_sig + "=" * ((4 - len(encoded_sig) % 4) % 4))
-        data = base64.urlsafe_b64decode(payload + "=" * ((4 - len(payload) % 4) % 4))
-    except IndexError:
-        return False # raise ValueError('signed_request malformed')
-    except TypeError:
-        return False # raise ValueError('signed_request had corrupted payload')
-
-    data = json.loads(data)
-    if data.get('algorithm', '').upper() != 'HMAC-SHA256':
-        return False # raise ValueError('signed_request used unknown algorithm')
-
-    expected_sig = hmac.new(str(app_secret), msg=payload, digestmod=hashlib.sha256).digest()
-    if sig != expected_sig:
-        return False # raise ValueError('signed_request had signature mismatch')
-
-    return data
-
@@ -1,26 +1,34 @@
 # vim:fileencoding=utf-8
+import calendar
 import logging
+import sys
+import threading
+import time
 import types
 import urllib2
-from strippers.facebook.error import FacebookGraphAPIError
-from strippers.facebook.util import memoized
+from collections import deque
+from strippers.facebook.error import FacebookGraphAPIError, InvalidRequestError
+from strippers.facebook.future import WorkerPool, as_completed
+from strippers.facebook import jsoncodec as json
+from strippers.facebook.retry import RetryPolicy, RetryBudget
+from strippers.facebook.util import cached, intern_key
 from strippers.facebook.permission import PUBLISH_CHECKINS
 from strippers.facebook.error import InsufficientScopeError
 
-try:
-    import json
-except ImportError:
-    try:
-        from django.utils import simplejson as json
-    except ImportError:
-        import simplejson as json
-
 __author__ = 'otsuka'
 
 log = logging.getLogger(__name__)
 
+_NO_FIELDS = frozenset()
+
+# 暗黙のロードで API にアクセスする度に呼び出される関数。LazyLoadDetector.install() でセットされる
+_lazy_load_hook = None
+
 class FbGraphObject(dict):
 
+    # 大量のオブジェクトを保持する場合のメモリを節約するため、インスタンス属性は __slots__ に限定する
+    __slots__ = ('api', 'loaded', '_by_fql', '_fetched_fields', '_raw', '__weakref__')
+
     def __init__(self, api, data=None, by_fql=False):
         """
         @param api: FacebookGraphAPI インスタンス
@@ -35,9 +43,11 @@ class FbGraphObject(dict):
         self.api = api
         self.loaded = False
         self._by_fql = bool(by_fql)
+        self._fetched_fields = _NO_FIELDS # load(fields) で取得済みのフィールド(値がなかったものを含む)
+        self._raw = None                  # まだデコードしていないレスポンスボディと fields のタプル
         if data:
             if isinstance(data, types.DictType):
-                self.update(data)
+                self._update(data)
             else:
                 raise TypeError
 
@@ -62,22 +72,119 @@ class FbGraphObject(dict):
         """
         return self.api.BASE_URL + self.id
 
-    def load(self):
+    def load(self, fields=None):
         """
         API にアクセスして、このオブジェクトの属性データを読み込みます。
         オブジェクトの id キーに適切な値がセットされている必要があります。
+
+        fields を指定した場合は、まだ取得していないフィールドだけを読み込みます。
+        この場合、オブジェクトはロード済み(loaded)にはなりません。
+
+        api の lazy_decode が True の場合は、レスポンスボディをデコードせずに保持し、
+        最初にフィールドにアクセスした時点でデコードします。
+
+        @param fields: 読み込むフィールドのリスト。省略した場合はデフォルトのフィールドをすべて読み込みます
+        @type fields: list, tuple
         """
-        if not self.loaded:
-            log.debug(u'%sオブジェクトのデータをロードします。[%s]', self.__class__.__name__, self.uri)
-            res = self.api.get(self.uri)
-            data = json.loads(res)
-            try:
-                self.update(data)
-            except Exception, e:
-                log.exception(u"Error at load(). [uri='%s', res='%s']", self.uri, res)
-                raise
-            self._by_fql = False
+        self._load(fields)
+
+    def _load(self, fields=None, lazy_field=None):
+        """
+        load() の実装です。
+        lazy_field を指定した場合は、フィールドへのアクセスによる暗黙のロードとして、
+        実際に API にアクセスする直前に _lazy_load_hook を呼び出します。
+
+        @param fields: 読み込むフィールドのリスト
+        @type fields: list, tuple
+        @param lazy_field: 暗黙のロードのきっかけになったフィールド
+        @type lazy_field: str
+        """
+        if self.loaded:
+            return
+        params = None
+        if fields is not None:
+            fields = [ field for field in fields if field not in self._fetched_fields ]
+            if not fields:
+                return
+            params = { 'fields': ','.join(fields) }
+        log.debug(u'%sオブジェクトのデータをロードします。[%s, fields=%s]', self.__class__.__name__, self.uri, fields)
+        if lazy_field is not None and _lazy_load_hook is not None:
+            _lazy_load_hook(self, lazy_field)
+        res = self.api.get(self.uri, params)
+        if getattr(self.api, 'lazy_decode', False):
+            self._set_raw(res, fields)
+            return
+        self._decode_loaded_data(res, fields)
+
+    def _decode_loaded_data(self, res, fields=None):
+        data = json.loads(res)
+        try:
+            self._set_loaded_data(data, fields)
+        except Exception, e:
+            log.exception(u"Error at load(). [uri='%s', res='%s']", self.uri, res)
+            raise
+
+    def _set_raw(self, res, fields=None):
+        """
+        レスポンスボディをデコードせずに保持します。
+        オブジェクトのクラスは、属性へのアクセスと dict の操作の前にデコードするサブクラスに置き換えられ、
+        デコード後に元に戻ります。
+        """
+        if self._raw is not None:
+            self._decode()
+        self._raw = (res, fields)
+        if fields is None:
+            self.loaded = True
+        else:
+            self._fetched_fields = self._fetched_fields.union(fields)
+        self.__class__ = _lazy_class(self.__class__)
+
+    def _decode(self):
+        _decode_raw(self)
+
+    @property
+    def raw(self):
+        """
+        オブジェクトの JSON を返します。
+        デコードしていないレスポンスボディを保持している場合は、デコードせずにそのまま返します。
+
+        @rtype: str
+        """
+        if self._raw is not None and self._raw[1] is None and dict.__len__(self) <= 1:
+            return self._raw[0]
+        if self._raw is not None:
+            self._decode()
+        return json.dumps(self)
+
+    @property
+    def partially_loaded(self):
+        """
+        load(fields) で一部のフィールドだけを読み込んだ状態か否かを返します。
+
+        @rtype: bool
+        """
+        return not self.loaded and bool(self._fetched_fields)
+
+    def _set_loaded_data(self, data, fields=None):
+        """
+        API から取得したフィールドデータをこのオブジェクトにマージします。
+
+        @param data: API から取得したフィールドデータ
+        @type data: dict
+        @param fields: 取得したフィールドのリスト。None の場合はすべてのフィールドを取得したものとみなします
+        @type fields: list, tuple
+        """
+        self._update(data)
+        self._by_fql = False
+        if fields is None:
             self.loaded = True
+        else:
+            self._fetched_fields = self._fetched_fields.union(fields)
+
+    def _update(self, data):
+        # キーを intern して、同じフィールドを持つオブジェクト間で共有する
+        for key, value in data.iteritems():
+            dict.__setitem__(self, intern_key(key), value)
 
     def __getattr__(self, item):
         try:
@@ -86,6 +193,7 @@ class FbGraphObject(dict):
             raise AttributeError, e.args[0]
 
     def __getitem__(self, key):
+        field = key
         if self._by_fql and hasattr(self, '_GRAPH_TO_FQL_FIELD_MAPPINGS'):
             mappings = getattr(self, '_GRAPH_TO_FQL_FIELD_MAPPINGS')
             key = mappings.get(key, key)
@@ -94,11 +202,27 @@ class FbGraphObject(dict):
             return super(FbGraphObject, self).__getitem__(key)
         else:
             if self.id:
-                self.load()
-                if key in self:
-                    return super(FbGraphObject, self).__getitem__(key)
+                if self.partially_loaded:
+                    # 一部のフィールドだけを読み込んでいる場合は、足りないフィールドだけを読み込む
+                    self._load_missing_field(field)
+                else:
+                    self._load(lazy_field=field)
+                for name in (key, field):
+                    if name in self:
+                        return super(FbGraphObject, self).__getitem__(name)
         raise KeyError(u"This object does not have '%s' field." % key)
 
+    def _load_missing_field(self, field):
+        try:
+            self._load([field], field)
+        except (urllib2.HTTPError, InvalidRequestError), e:
+            if getattr(e, 'code', 400) != 400:
+                raise
+            # 存在しないフィールドを指定すると 400 になるので、すべてのフィールドを読み込んで KeyError にする
+            log.debug(u"フィールドを読み込めなかったので、すべてのフィールドを読み込みます。[%s, field=%s] %s",
+                      self.uri, field, e)
+            self._load(lazy_field=field)
+
     def get_aggressively(self, key, val=None):
         try:
             return self[key]
@@ -106,11 +230,472 @@ class FbGraphObject(dict):
             return val
 
 
+# 遅延デコード中のオブジェクトで、最初にデコードしてから元の処理を行う dict の特殊メソッド。
+# len(obj) や obj[key] などは __getattribute__ を経由しないので、個別に置き換える
+_DECODING_METHODS = ('__getitem__', '__contains__', '__iter__', '__len__', '__setitem__', '__delitem__',
+                     '__eq__', '__ne__', '__lt__', '__le__', '__gt__', '__ge__', '__cmp__', '__repr__')
+
+# 遅延デコード中のオブジェクトで、アクセスしてもデコードしない属性
+_NON_DECODING_ATTRS = frozenset(['raw', '_raw', 'api', 'loaded', '_fetched_fields', 'partially_loaded'])
+
+# デコード中のオブジェクトを他のスレッドが見ないように、デコードはこのロックの下で行う。
+# オブジェクト毎にロックを持つとメモリを消費するので、すべてのオブジェクトで共有する
+_decode_lock = threading.Lock()
+
+_raw_slot = FbGraphObject.__dict__['_raw']
+_by_fql_slot = FbGraphObject.__dict__['_by_fql']
+
+def _decode_raw(obj):
+    """
+    obj が保持しているレスポンスボディをデコードしてフィールドにセットし、クラスを元に戻します。
+    遅延デコード中のクラスの __getattribute__ からも呼ばれるので、obj の属性にはスロットを直接使ってアクセスします。
+    """
+    _decode_lock.acquire()
+    try:
+        raw = _raw_slot.__get__(obj)
+        if raw is None:
+            return
+        res, fields = raw
+        try:
+            data = json.loads(res)
+        except Exception:
+            log.exception(u"Error at load(). [id='%s', res='%s']", dict.get(obj, 'id'), res)
+            raise
+        # フィールドをセットしてからレスポンスボディを捨ててクラスを戻すので、他のスレッドが空のオブジェクトを見ることはない
+        FbGraphObject._update(obj, data)
+        _by_fql_slot.__set__(obj, False)
+        _raw_slot.__set__(obj, None)
+        obj.__class__ = type(obj)._decoded_class
+    finally:
+        _decode_lock.release()
+
+
+_lazy_classes = {}
+
+def _lazy_class(cls):
+    """
+    cls の、遅延デコード中のオブジェクトのためのサブクラスを返します。
+
+    dict(obj)、{}.update(obj)、copy.copy(obj)、pickle なども keys や __reduce_ex__ などの属性を参照するので、
+    __getattribute__ でデコードされます。ただし、f(**obj) は属性を参照せずに dict の内容を直接読むので、
+    デコードされていないフィールドは渡されません。
+    """
+    if getattr(cls, '_decoded_class', None) is not None:
+        return cls
+    lazy_cls = _lazy_classes.get(cls)
+    if lazy_cls is None:
+        def decoding(name):
+            method = getattr(cls, name)
+            def wrapper(self, *args, **kwargs):
+                _decode_raw(self)
+                for arg in args:
+                    # 比較の相手も遅延デコード中であれば、dict の内容を直接比較する前にデコードする
+                    if isinstance(arg, FbGraphObject):
+                        _decode_raw(arg)
+                return getattr(self, name)(*args, **kwargs)
+            wrapper.__name__ = name
+            wrapper.__doc__ = method.__doc__
+            return wrapper
+        def __getattribute__(self, name):
+            if name not in _NON_DECODING_ATTRS:
+                _decode_raw(self)
+            return object.__getattribute__(self, name)
+        attrs = dict((name, decoding(name)) for name in _DECODING_METHODS)
+        attrs['__getattribute__'] = __getattribute__
+        attrs['__slots__'] = ()
+        attrs['_decoded_class'] = cls
+        attrs['__module__'] = cls.__module__
+        lazy_cls = _lazy_classes.setdefault(cls, type(cls.__name__, (cls,), attrs))
+    return lazy_cls
+
+
+def load_all(objects, fields=None, concurrency=4):
+    """
+    複数の FbGraphObject の属性データを ?ids= パラメータを使ってまとめて読み込みます。
+    オブジェクト毎に load() を呼び出す代わりに使用すると、リクエスト数を大幅に減らすことができます。
+
+    friends = api.me.friends()
+    load_all(friends)
+
+    @param objects: FbGraphObject のリスト。ロード済みのオブジェクトは読み込みません
+    @type objects: list
+    @param fields: 取得するフィールドのリスト。省略した場合はデフォルトのフィールドを取得します
+    @type fields: list, tuple
+    @param concurrency: 同時に送信するリクエストの最大数
+    @type concurrency: int
+    @return: objects
+    @rtype: list
+    """
+    groups = {}
+    for obj in objects:
+        if obj.loaded or not obj.get('id'):
+            continue
+        if fields is not None and obj._fetched_fields.issuperset(fields):
+            continue
+        groups.setdefault(id(obj.api), []).append(obj)
+
+    for group in groups.values():
+        api = group[0].api
+        results = api.get_objects([ obj.id for obj in group ], fields, concurrency)
+        for obj in group:
+            data = results.get(obj.id)
+            if data is not None:
+                obj._set_loaded_data(data, fields)
+    return objects
+
+
+_MISSING = object()
+
+class CompactObjectList(object):
+    """
+    大量の Graph オブジェクトを、フィールド毎のリスト(列)で保持する読み取り専用のリストです。
+    オブジェクト毎に dict を持たないので、同じデータを FbUser のリストで保持するよりメモリ使用量が大幅に少なくなります。
+
+    要素を取り出すと、その時点で FbUser などのオブジェクトが作られます。
+    取り出したオブジェクトへの変更は、このリストには反映されません。
+
+    friends = api.me.friends(compact=True)
+    names = friends.column('name')
+    """
+
+    def __init__(self, api, cls, rows=(), by_fql=False):
+        """
+        @param api: FacebookGraphAPI インスタンス
+        @type api: FacebookGraphAPI
+        @param cls: 要素のクラス(FbUser など)
+        @type cls: type
+        @param rows: 各要素のフィールドデータの dict のイテラブル
+        @param by_fql: FQL クエリによった取得されたデータか否か
+        @type by_fql: bool
+        """
+        self.api = api
+        self.cls = cls
+        self.by_fql = bool(by_fql)
+        self._columns = {}
+        self._length = 0
+        for row in rows:
+            self._append(row)
+
+    def _append(self, row):
+        for key in row:
+            if key not in self._columns:
+                # 新しいフィールドは、それまでの要素を値なしとして列を作る
+                self._columns[intern_key(key)] = [_MISSING] * self._length
+        for key, column in self._columns.iteritems():
+            column.append(row.get(key, _MISSING))
+        self._length += 1
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ self[i] for i in xrange(*index.indices(self._length)) ]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('list index out of range')
+        return self._make(index)
+
+    def __iter__(self):
+        for i in xrange(self._length):
+            yield self._make(i)
+
+    def _make(self, index):
+        data = {}
+        for key, column in self._columns.iteritems():
+            value = column[index]
+            if value is not _MISSING:
+                data[key] = value
+        return self.cls(self.api, data, by_fql=self.by_fql) if self.by_fql else self.cls(self.api, data)
+
+    @property
+    def fields(self):
+        """
+        要素が持っているフィールドのリストを返します。
+
+        @rtype: list
+        """
+        return self._columns.keys()
+
+    def column(self, field, default=None):
+        """
+        指定されたフィールドの値を、要素の順番で並べたリストを返します。
+
+        @param field: フィールド名
+        @type field: str, unicode
+        @param default: フィールドを持たない要素の値
+        @rtype: list
+        """
+        column = self._columns.get(field)
+        if column is None:
+            return [default] * self._length
+        return [ default if value is _MISSING else value for value in column ]
+
+    def __repr__(self):
+        return '<%s of %d %s>' % (self.__class__.__name__, self._length, self.cls.__name__)
+
+
+class _PagingState(object):
+    """
+    _iter_pages() がページングを打ち切ったか否かを GraphPager に伝えるためのオブジェクトです。
+    ジェネレーターが GraphPager を参照すると循環参照になり、捨てられた GraphPager が close() されないので、これを間に挟みます。
+    """
+
+    __slots__ = ('truncated',)
+
+    def __init__(self):
+        self.truncated = False
+
+
+def _iter_pages(api, res, max_pages=None, state=None):
+    """
+    最初のページのレスポンスから paging.next をたどり、各ページの要素のリストを順番に返すジェネレーターです。
+    max_pages で打ち切った時点で次のページがある場合は、state の truncated を True にします。
+    """
+    last_uri = None
+    pages = 0
+    while True:
+        data = json.loads(res)
+        items = data.get('data') or []
+        pages += 1
+        if not items:
+            return
+        yield items
+        next_uri = _next_page_uri(data)
+        if next_uri is None or next_uri == last_uri:
+            return
+        if max_pages is not None and pages >= max_pages:
+            if state is not None:
+                state.truncated = True
+            return
+        last_uri = next_uri
+        res = api._get_page(next_uri)
+
+
+def _next_page_uri(data):
+    """
+    レスポンスの paging から次のページの URI を返します。次のページがない場合は None を返します。
+    """
+    paging = data.get('paging') or {}
+    next_uri = paging.get('next')
+    if not next_uri:
+        return None
+    if 'cursors' in paging and not (paging['cursors'] or {}).get('after'):
+        # カーソルによるページングで、次のカーソルがない
+        return None
+    return next_uri
+
+
+def _to_unixtime(value):
+    """
+    Graph API の日時(ISO 8601 形式の文字列、または Unix タイム)を Unix タイムに変換します。
+    """
+    if value is None:
+        return 0
+    if isinstance(value, (int, long, float)):
+        return int(value)
+    value = unicode(value)
+    if value.isdigit():
+        return int(value)
+    # 2012-03-04T05:06:07+0000
+    # datetime.strptime() は最初の呼び出しがスレッドセーフではない(posts_parallel() のワーカーから呼ばれる)ので使わない
+    return calendar.timegm((int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                            int(value[11:13]), int(value[14:16]), int(value[17:19])))
+
+
+class _PagePrefetcher(object):
+    """
+    バックグラウンドのスレッドで、ページを最大 depth ページ先まで取得しておきます。
+    このオブジェクトもページを生成するジェネレーターも GraphPager への参照を持たないので、
+    GraphPager が捨てられた時点で __del__() から close() され、スレッドも終了します。
+    """
+
+    THREAD_NAME = 'GraphPagerPrefetcher'
+
+    def __init__(self, pages, depth):
+        self._pages = pages
+        self._depth = depth
+        self._queue = deque() # 取得済みのページと例外の情報のタプル
+        self._closed = False
+        self._cond = threading.Condition(threading.Lock())
+        thread = threading.Thread(target=self._run, name=self.THREAD_NAME)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            self._cond.acquire()
+            try:
+                while len(self._queue) >= self._depth and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+            finally:
+                self._cond.release()
+
+            try:
+                entry = (next(self._pages, None), None)
+            except Exception:
+                entry = (None, sys.exc_info())
+
+            self._cond.acquire()
+            try:
+                self._queue.append(entry)
+                self._cond.notify_all()
+            finally:
+                self._cond.release()
+            if entry[0] is None:
+                return
+
+    def take(self):
+        """
+        次のページの要素のリストを返します。最後のページの後は None を返します。
+        """
+        self._cond.acquire()
+        try:
+            while not self._queue:
+                self._cond.wait()
+            page, exc_info = self._queue.popleft()
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return page
+
+    def close(self):
+        self._cond.acquire()
+        try:
+            self._closed = True
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+
+class GraphPager(object):
+    """
+    ページングされた Graph API の結果(data と paging を持つレスポンス)を 1 件ずつ反復するイテレータです。
+
+    paging.next の URL をたどって次のページを取得します。カーソル(paging.cursors)によるページングと
+    offset によるページングのどちらにも対応し、次のページがない場合、データが空の場合、
+    直前と同じページを指している場合に反復を終了します。
+    保持するのは取得済みで未反復のページだけなので、結果がどれだけ多くても使用するメモリは一定です。
+
+    prefetch に 1 以上を指定すると、呼び出し側が取得済みのページを処理している間に、
+    バックグラウンドのスレッドで最大 prefetch ページ先まで取得しておきます。
+
+    for post in GraphPager(api, api.BASE_URL + 'me/posts', factory=FbPost, prefetch=2):
+        print post['id']
+    """
+
+    def __init__(self, api, uri, params=None, factory=None, limit=-1, prefetch=0, max_pages=None,
+                 access_token=None):
+        """
+        @param api: FacebookGraphAPI インスタンス
+        @type api: FacebookGraphAPI
+        @param uri: 最初のページの URI
+        @type uri: str, unicode
+        @param params: 最初のページのリクエストパラメータ
+        @type params: dict
+        @param factory: api と各要素の dict を引数に取り、返す値を作る関数(FbPost など)。省略した場合は dict をそのまま返します
+        @param limit: 反復する要素の最大数。-1 の場合は上限なしとなります
+        @type limit: int
+        @param prefetch: バックグラウンドで先に取得しておくページ数。0 の場合は必要になった時点で取得します
+        @type prefetch: int
+        @param max_pages: 取得するページの最大数。None の場合は上限なしとなります
+        @type max_pages: int
+        @param access_token: 最初のページの取得に使用するアクセストークン。省略した場合は api のアクセストークン
+        @type access_token: str
+        """
+        if prefetch < 0:
+            raise TypeError
+        self.api = api
+        self.uri = uri
+        self.params = params
+        self.factory = factory
+        self.limit = int(limit)
+        self.prefetch = prefetch
+        self.max_pages = max_pages
+        self.access_token = access_token
+        self.pages = 0 # 反復を始めたページ数
+        self._state = _PagingState()
+        self._count = 0
+        self._items = deque()
+        self._closed = False
+        self._prefetcher = None
+        self._pages = None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._closed or self._count >= self.limit > -1:
+            self.close()
+            raise StopIteration
+        while not self._items:
+            page = self._take_page()
+            if page is None:
+                self.close()
+                raise StopIteration
+            self.pages += 1
+            self._items.extend(page)
+        self._count += 1
+        item = self._items.popleft()
+        if self.factory is not None:
+            return self.factory(self.api, item)
+        return item
+
+    def _take_page(self):
+        if self._pages is None:
+            # 最初のページはこのスレッドで取得する(引数やアクセストークンのエラーをすぐに送出するため)
+            if self.access_token:
+                res = self.api._send_api_request(self.uri, self.params, access_token=self.access_token)
+            else:
+                res = self.api.get(self.uri, self.params)
+            self._pages = _iter_pages(self.api, res, self.max_pages, self._state)
+            page = next(self._pages, None)
+            if page is not None and self.prefetch > 0:
+                self._prefetcher = _PagePrefetcher(self._pages, self.prefetch)
+            return page
+        try:
+            if self._prefetcher is not None:
+                return self._prefetcher.take()
+            return next(self._pages, None)
+        except Exception:
+            self.close()
+            raise
+
+    @property
+    def truncated(self):
+        """
+        max_pages で打ち切った時点で、まだ次のページがあったか否かを返します。
+
+        @rtype: bool
+        """
+        return self._state.truncated
+
+    def close(self):
+        """
+        反復を終了し、バックグラウンドでのページの取得を止めます。
+        """
+        self._closed = True
+        self._items.clear()
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+
+    def __del__(self):
+        if getattr(self, '_prefetcher', None) is not None:
+            self._prefetcher.close()
+
+
 class FbUser(FbGraphObject):
     """
     ユーザーオブジェクト
     """
 
+    __slots__ = ()
+
     _GRAPH_TO_FQL_FIELD_MAPPINGS = {
         'id'      : 'uid',
         'gender'  : 'sex',
@@ -147,7 +732,7 @@ class FbUser(FbGraphObject):
             raise TypeError
         return self.uri + '/picture?type=%s' % size
 
-    def friends_fql(self, fields=None):
+    def friends_fql(self, fields=None, compact=False):
         """
         ユーザーの友達リストを返します。
 
@@ -163,6 +748,8 @@ class FbUser(FbGraphObject):
         @todo: "friend_xxxx" のパーミッションによって、自動的に取得フィールドを増やしたい。
         と思ったけど、パーミッションのないフィールドをFQLで取得しようとすると null になるだけなのでいいや。
 
+        @param compact: True の場合は、FbUser のリストの代わりに CompactObjectList を返します
+        @type compact: bool
         @return: ユーザーの友達の FbUser オブジェクトリスト
         @rtype: list
         """
@@ -178,24 +765,26 @@ class FbUser(FbGraphObject):
         select_fields = ', '.join(fields)
         q %= select_fields
         users = self.api.fql_query(q)
-        results = []
         for user in users:
             # id フィールドをセット
             user['id'] = user['uid']
-            results.append(FbUser(self.api, user, by_fql=True))
-        return results
+        if compact:
+            return CompactObjectList(self.api, FbUser, users, by_fql=True)
+        return [ FbUser(self.api, user, by_fql=True) for user in users ]
 
-    def friends(self):
+    def friends(self, compact=False):
         """
         ユーザーの友達リストを返します。
 
+        @param compact: True の場合は、FbUser のリストの代わりに CompactObjectList を返します
+        @type compact: bool
         @return: ユーザーの友達の FbUser オブジェクトリスト
         @rtype: list
         """
         url = self.uri + '/friends'
-        res = self.api.get(url)
-        data = json.loads(res)
-        return [ FbUser(self.api, user) for user in data['data'] ]
+        if compact:
+            return CompactObjectList(self.api, FbUser, GraphPager(self.api, url))
+        return list(GraphPager(self.api, url, factory=FbUser))
 
     def friends_with_local_name(self):
         """
@@ -233,20 +822,24 @@ class FbUser(FbGraphObject):
         if isinstance(friend, FbUser):
             friend = friend.id
         url = self.uri + '/mutualfriends/%s' % friend
-        res = self.api.get(url)
-        data = json.loads(res)
-        return [ FbUser(self.api, user) for user in data['data'] ]
+        return list(GraphPager(self.api, url, factory=FbUser))
 
-    def albums(self):
+    def albums(self, limit=-1, fetch=100, prefetch=0):
         """
-        @todo: ページング
+        ユーザーのアルバムを反復するイテレータを返します。
+
+        @param limit: 取得するアルバムの件数。デフォルトの -1 の場合は、上限なしとなります
+        @type limit: int
+        @param fetch: 一度に取得するアルバムの件数。API には limit パラメータとして渡される値
+        @type fetch: int
+        @param prefetch: バックグラウンドで先に取得しておくページ数。0 の場合は必要になった時点で取得します
+        @type prefetch: int
+        @return: FbAlbum オブジェクトのイテレータ
+        @rtype: GraphPager
         """
         uri = self.uri + '/albums'
-        params = { 'limit': 100 }
-        res = self.api.get(uri, params)
-        data = json.loads(res)
-        results = [ FbAlbum(self.api, d) for d in data['data'] ]
-        return results
+        params = { 'limit': fetch }
+        return GraphPager(self.api, uri, params, factory=FbAlbum, limit=limit, prefetch=prefetch)
 
     def create_album(self, name, message=None, privacy=None):
         """
@@ -273,8 +866,7 @@ class FbUser(FbGraphObject):
             params['privacy'] = json.dumps(privacy)
         uri = self.uri + '/albums'
         res = self.api.send_post_request(uri, params)
-        data = json.loads(res)
-        return FbAlbum(self.api, data)
+        return self.api._then(res, lambda res: FbAlbum(self.api, json.loads(res)))
 
     def upload_photo(self, source, message=None):
         """
@@ -297,7 +889,7 @@ class FbUser(FbGraphObject):
         data = json.loads(res)
         return FbPhoto(self.api, data)
 
-    def posts(self, limit=-1, fetch=25, offset=0, since=None, until=None):
+    def posts(self, limit=-1, fetch=25, offset=0, since=None, until=None, prefetch=0):
         """
         ユーザーのフィードへの投稿リストを返します。
 
@@ -311,31 +903,96 @@ class FbUser(FbGraphObject):
         @type since: int
         @param until: 取得終了日時。Unix タイム
         @type until: int
-        @return: FbPost オブジェクトのジェネレーター
-        @rtype: generator
+        @param prefetch: バックグラウンドで先に取得しておくページ数。0 の場合は必要になった時点で取得します
+        @type prefetch: int
+        @return: FbPost オブジェクトのイテレータ
+        @rtype: GraphPager
         """
         uri = self.uri + '/posts'
         params = { 'limit': fetch, 'offset': offset, }
         if since: params['since'] = int(since)
         if until: params['until'] = int(until)
+        return GraphPager(self.api, uri, params, factory=FbPost, limit=limit, prefetch=prefetch)
 
-        res = self.api.get(uri, params)
-        data = json.loads(res)
-        posts = data['data']
-        count = 0
+    def posts_parallel(self, since, until=None, workers=4, slices=None, fetch=100, split_pages=4, min_slice=60):
+        """
+        ユーザーのフィードへの投稿を、期間を分割して並行して取得します。
+        長い期間の投稿をまとめて取得(バックフィル)する場合、posts() で 1 ページずつたどるより短時間で取得できます。
 
-        while len(posts) > 0:
-            next_uri = data['paging']['next']
-            for p in posts:
-                if count >= int(limit) > -1:
-                    return
-                yield FbPost(self.api, p)
-                count += 1
+        期間は slices 個の区間に分割され、workers 個のスレッドで並行して取得されます。
+        1 つの区間で split_pages ページを取得しても投稿が残っている場合は、残りの期間を 2 つに分割して取得を続けます。
+        結果は posts() と同じく新しい順に返され、区間の境界で重複した投稿は取り除かれます。
 
-            req = urllib2.Request(next_uri)
-            res = self.api.send_request(req)
-            data = json.loads(res)
-            posts = data['data']
+        @param since: 取得開始日時。Unix タイム
+        @type since: int
+        @param until: 取得終了日時。Unix タイム。省略した場合は現在時刻
+        @type until: int
+        @param workers: 同時に送信するリクエストの最大数
+        @type workers: int
+        @param slices: 最初に期間を分割する区間数。省略した場合は workers と同じ
+        @type slices: int
+        @param fetch: 一度に取得する投稿件数。API には limit パラメータとして渡される値
+        @type fetch: int
+        @param split_pages: 区間を分割するまでに 1 つの区間で取得するページ数
+        @type split_pages: int
+        @param min_slice: 分割する区間の最小の長さ(秒)。これより短い区間は分割せずに取得を続けます
+        @type min_slice: int
+        @return: FbPost オブジェクトのジェネレーター
+        @rtype: generator
+        """
+        since = int(since)
+        until = int(until) if until is not None else int(time.time())
+        if since >= until or workers < 1 or split_pages < 1:
+            raise TypeError
+        slices = max(1, min(slices or workers, (until - since) // max(1, min_slice) or 1))
+
+        pool = WorkerPool(workers)
+
+        def fetch_slice(start, end):
+            """
+            start から end までの投稿を最大 split_pages ページ取得し、
+            その区間の投稿のリストと、残りの期間を取得する Future のリストのタプルを返します。
+            """
+            params = { 'limit': fetch, 'since': start, 'until': end }
+            pager = GraphPager(self.api, self.uri + '/posts', params, prefetch=0, max_pages=split_pages)
+            posts = list(pager)
+            children = []
+            if pager.truncated and posts:
+                # split_pages ページで取得しきれなかった区間なので、まだ取得していない古い期間を分割して取得を続ける
+                # (API が 1 ページに返す件数は fetch より少ないことがあるので、件数ではなく次のページの有無で判定する)
+                oldest = min(_to_unixtime(p.get('created_time')) for p in posts)
+                rest_end = min(end, oldest + 1)
+                if rest_end - start >= min_slice * 2:
+                    middle = start + (rest_end - start) // 2
+                    log.debug(u"投稿が多い区間を分割します。[%d-%d, %d-%d]", middle, rest_end, start, middle)
+                    ranges = [(middle, rest_end), (start, middle)]
+                else:
+                    ranges = [(start, rest_end)]
+                children = [ pool.submit(fetch_slice, s, e) for s, e in ranges ]
+            return posts, children
+
+        def walk(futures):
+            # 区間は新しい順に並んでいるので、区間の順に返せば全体も新しい順になる
+            for future in futures:
+                posts, children = future.result()
+                posts.sort(key=lambda p: _to_unixtime(p.get('created_time')), reverse=True)
+                for p in posts:
+                    yield p
+                for p in walk(children):
+                    yield p
+
+        try:
+            width = (until - since) / float(slices)
+            bounds = [ since + int(round(width * i)) for i in xrange(slices + 1) ]
+            futures = [ pool.submit(fetch_slice, bounds[i - 1], bounds[i]) for i in xrange(slices, 0, -1) ]
+            seen = set()
+            for p in walk(futures):
+                if p.get('id') in seen:
+                    continue
+                seen.add(p.get('id'))
+                yield FbPost(self.api, p)
+        finally:
+            pool.shutdown(wait=False, cancel=True)
 
     def post(self, message=None, link=None, picture=None, name=None, caption=None, description=None, actions=(), privacy=None, object_attachment=None):
         """
@@ -357,7 +1014,7 @@ class FbUser(FbGraphObject):
         uid = 'me'
         return self.api.post(uid, message, link, picture, name, caption, description, actions, privacy, object_attachment)
 
-    @memoized
+    @cached
     def permissions(self):
         """
         ユーザーがアプリケーションに認可しているパーミッション(スコープ)のリストを返します。
@@ -417,8 +1074,8 @@ class FbUser(FbGraphObject):
             params['privacy'] = json.dumps(privacy)
 
         res = self.api.send_post_request(uri, params)
-        data = json.loads(res) # {u'id': u'10150583583804571'}
-        return FbCheckin(self.api, data)
+        # {u'id': u'10150583583804571'}
+        return self.api._then(res, lambda res: FbCheckin(self.api, json.loads(res)))
 
     def apprequest(self, message, data=None):
         """
@@ -438,6 +1095,9 @@ class FbPost(FbGraphObject):
     """
     投稿オブジェクト
     """
+
+    __slots__ = ()
+
     def __init__(self, api, data):
         FbGraphObject.__init__(self, api, data)
 
@@ -446,30 +1106,28 @@ class FbAlbum(FbGraphObject):
     """
     アルバムオブジェクト
     """
+
+    __slots__ = ()
+
     def __init__(self, api, data):
         FbGraphObject.__init__(self, api, data)
 
-    def photos(self, limit=25, offset=0):
+    def photos(self, limit=25, offset=0, prefetch=0):
+        """
+        このアルバムの写真を反復するイテレータを返します。
+
+        @param limit: 一度に取得する写真の枚数。API には limit パラメータとして渡される値
+        @type limit: int
+        @param offset: 取得開始位置
+        @type offset: int
+        @param prefetch: バックグラウンドで先に取得しておくページ数。0 の場合は必要になった時点で取得します
+        @type prefetch: int
+        @return: FbPhoto オブジェクトのイテレータ
+        @rtype: GraphPager
+        """
         uri = self.uri + '/photos'
         params = { 'limit': limit, 'offset': offset }
-        res = self.api.get(uri, params)
-        data = json.loads(res)
-        photo_dicts = data['data']
-
-        while len(photo_dicts) > 0:
-            if 'next' in data['paging']:
-                next_url = data['paging']['next']
-            else:
-                next_url = None
-
-            for p in photo_dicts:
-                yield FbPhoto(self.api, p)
-
-            if next_url:
-                req = urllib2.Request(next_url)
-                res = self.api.send_request(req)
-                data = json.loads(res)
-                photo_dicts = data['data']
+        return GraphPager(self.api, uri, params, factory=FbPhoto, prefetch=prefetch)
 
     def upload_photo(self, source, message=None):
         """
@@ -490,11 +1148,74 @@ class FbAlbum(FbGraphObject):
         data = json.loads(res)
         return FbPhoto(self.api, data)
 
+    def upload_photos(self, sources, messages=None, concurrency=4, retries=2):
+        """
+        このアルバムに複数の写真を並行してアップロードします。
+
+        @param sources: 画像ファイルの file オブジェクトのリスト
+        @type sources: list
+        @param messages: 各写真のメッセージのリスト。sources と同じ順番で指定します
+        @type messages: list
+        @param concurrency: 同時にアップロードする写真の最大数
+        @type concurrency: int
+        @param retries: 送信前に失敗した(接続の失敗、呼び出し回数の制限)アップロードを 1 枚あたり何回までやり直すか。
+                        5xx やタイムアウトの場合は、写真が二重に登録されないようにやり直しません
+        @type retries: int
+        @return: アップロードした写真の FbPhoto オブジェクトのリスト。sources と同じ順番です
+        @rtype: list
+        """
+        results = [None] * len(sources)
+        for index, photo in self.iter_upload_photos(sources, messages, concurrency, retries):
+            results[index] = photo
+        return results
+
+    def iter_upload_photos(self, sources, messages=None, concurrency=4, retries=2):
+        """
+        このアルバムに複数の写真を並行してアップロードし、アップロードが完了した順番に結果を返します。
+        リトライしても失敗したアップロードがあった場合は、その時点で例外を送出します。
+
+        @param sources: 画像ファイルの file オブジェクトのリスト
+        @type sources: list
+        @param messages: 各写真のメッセージのリスト。sources と同じ順番で指定します
+        @type messages: list
+        @param concurrency: 同時にアップロードする写真の最大数
+        @type concurrency: int
+        @param retries: 送信前に失敗した(接続の失敗、呼び出し回数の制限)アップロードを 1 枚あたり何回までやり直すか。
+                        5xx やタイムアウトの場合は、写真が二重に登録されないようにやり直しません
+        @type retries: int
+        @return: sources でのインデックスと FbPhoto オブジェクトのタプルのジェネレーター
+        @rtype: generator
+        """
+        sources = list(sources)
+        if messages is None:
+            messages = [None] * len(sources)
+        elif len(messages) != len(sources):
+            raise TypeError
+
+        # 写真のアップロードは冪等ではないので、サーバーが処理していないことが確実なエラーの場合だけリトライする
+        policy = RetryPolicy(max_attempts=retries + 1, retry_post=True, budget=RetryBudget(ratio=retries))
+
+        def upload(index):
+            photo, attempts = policy.call(lambda: self.upload_photo(sources[index], messages[index]), 'POST')
+            return index, photo
+
+        pool = WorkerPool(max(1, min(concurrency, len(sources))))
+        try:
+            futures = [ pool.submit(upload, index) for index in xrange(len(sources)) ]
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            # 途中で反復をやめた場合や失敗した場合は、まだ始まっていないアップロードを取り消す
+            pool.shutdown(wait=False, cancel=True)
+
 
 class FbPhoto(FbGraphObject):
     """
     写真オブジェクト
     """
+
+    __slots__ = ()
+
     def __init__(self, api, data):
         FbGraphObject.__init__(self, api, data)
 
@@ -517,6 +1238,9 @@ class FbPhoto(FbGraphObject):
         if y:
             params['y'] = float(y)
         res = self.api.send_post_request(uri, params)
+        return self.api._then(res, self._check_tagged)
+
+    def _check_tagged(self, res):
         if res == 'true':
             return self
         else:
@@ -526,6 +1250,9 @@ class FbCheckin(FbGraphObject):
     """
     チェックインオブジェクト
     """
+
+    __slots__ = ()
+
     def __init__(self, api, data):
         FbGraphObject.__init__(self, api, data)
 
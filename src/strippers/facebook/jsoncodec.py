@@ -0,0 +1,86 @@
+# vim:fileencoding=utf-8
+"""
+API のリクエストとレスポンスの JSON のエンコード・デコードに使うライブラリを選択するモジュールです。
+
+インポート時に、利用できるライブラリの中から最も速いものを選択します。
+優先順位は BACKENDS の順番で、どれも利用できない場合は標準ライブラリの json を使用します。
+
+from strippers.facebook import jsoncodec
+jsoncodec.use('simplejson')       # モジュール名で指定
+jsoncodec.use(my_codec)           # loads() と dumps() を持つオブジェクトで指定
+
+デコードに失敗した場合は、どのライブラリでも ValueError(またはそのサブクラス)が送出されます。
+"""
+import logging
+
+__author__ = 'otsuka'
+
+log = logging.getLogger(__name__)
+
+BACKENDS = ('ujson', 'simplejson', 'json', 'django.utils.simplejson')
+
+backend = None
+backend_name = None
+
+
+def _import(name):
+    module = __import__(name)
+    for part in name.split('.')[1:]:
+        module = getattr(module, part)
+    return module
+
+
+def _is_fast(name, module):
+    if name == 'simplejson':
+        # C 拡張なしの simplejson は標準ライブラリの json より遅い
+        return getattr(module, '_import_c_make_encoder', lambda: None)() is not None
+    return True
+
+
+def use(codec):
+    """
+    JSON のエンコード・デコードに使うライブラリを指定します。
+
+    @param codec: モジュール名、または loads() と dumps() を持つオブジェクト
+    @type codec: str, object
+    """
+    global backend, backend_name, loads, dumps
+    if isinstance(codec, basestring):
+        name, codec = codec, _import(codec)
+    else:
+        name = getattr(codec, '__name__', codec.__class__.__name__)
+    if not (callable(getattr(codec, 'loads', None)) and callable(getattr(codec, 'dumps', None))):
+        raise TypeError('%r does not have loads() and dumps().' % codec)
+    backend = codec
+    backend_name = name
+    # 呼び出しのオーバーヘッドをなくすため、関数をそのままモジュールの属性にする
+    loads = codec.loads
+    dumps = codec.dumps
+    log.debug(u"JSON ライブラリに %s を使用します。", name)
+
+
+def _select():
+    fallback = None
+    for name in BACKENDS:
+        try:
+            module = _import(name)
+        except ImportError:
+            continue
+        if _is_fast(name, module):
+            return name
+        if fallback is None:
+            fallback = name
+    if fallback is None:
+        raise ImportError('No JSON library is available.')
+    return fallback
+
+
+def loads(s):
+    return backend.loads(s)
+
+
+def dumps(obj):
+    return backend.dumps(obj)
+
+
+use(_select())
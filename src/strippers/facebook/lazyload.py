@@ -0,0 +1,283 @@
+# vim:fileencoding=utf-8
+"""
+FbGraphObject の暗黙のロードを記録し、N+1 問題を検出する診断ツールです。
+
+FbGraphObject は、持っていないフィールドにアクセスされると暗黙に load() を呼び出します。
+ループの中で friend.location のようにアクセスすると、要素毎に HTTP リクエストが送信されてしまいます。
+
+detector = LazyLoadDetector(threshold=5, window=2.0, action='warn')
+with detector:
+    for friend in me.friends():
+        print friend.location
+print detector.summary()
+
+同じ呼び出し元(スタックの指紋)から window 秒以内に threshold 回以上の暗黙のロードがあると、
+action に従って警告をログに出力するか、RepeatedLazyLoadError を送出します。
+summary() は、load_all() でまとめて読み込んだ場合に減らせたリクエスト数を表示します。
+"""
+import hashlib
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from strippers.facebook import graphobject
+from strippers.facebook.error import RepeatedLazyLoadError
+
+__author__ = 'otsuka'
+
+log = logging.getLogger(__name__)
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__)) + os.sep
+
+_package_files = {}
+
+def _in_package(filename):
+    try:
+        return _package_files[filename]
+    except KeyError:
+        result = _package_files[filename] = os.path.abspath(filename).startswith(_PACKAGE_DIR)
+        return result
+
+
+def call_site(depth=3, skip=0):
+    """
+    このパッケージの外側にある、呼び出し元のフレームを depth 個返します。
+
+    @param depth: 返すフレームの数
+    @type depth: int
+    @param skip: 呼び出し元から数えて、無視するフレームの数
+    @type skip: int
+    @return: (ファイル名, 行番号, 関数名) のタプルのタプル
+    @rtype: tuple
+    """
+    frame = sys._getframe(skip + 1)
+    frames = []
+    while frame is not None and len(frames) < depth:
+        code = frame.f_code
+        if not _in_package(code.co_filename):
+            frames.append((code.co_filename, frame.f_lineno, code.co_name))
+        frame = frame.f_back
+    return tuple(frames)
+
+
+class LazyLoadEvent(object):
+    """
+    暗黙のロード 1 回分の記録です。
+    """
+
+    __slots__ = ('time', 'class_name', 'object_id', 'field', 'partial', 'fingerprint', 'frames')
+
+    def __init__(self, time, class_name, object_id, field, partial, fingerprint, frames):
+        self.time = time
+        self.class_name = class_name
+        self.object_id = object_id
+        self.field = field
+        self.partial = partial          # load(fields) で足りないフィールドだけを読み込んだか否か
+        self.fingerprint = fingerprint  # 呼び出し元のスタックの指紋
+        self.frames = frames            # 呼び出し元のフレーム。call_site() を参照
+
+    def __repr__(self):
+        return '<LazyLoadEvent %s(%s).%s at %s>' % (self.class_name, self.object_id, self.field,
+                                                    _format_frame(self.frames[0]) if self.frames else '?')
+
+
+def _format_frame(frame):
+    filename, lineno, name = frame
+    return '%s:%d in %s' % (filename, lineno, name)
+
+
+class _CallSite(object):
+
+    def __init__(self, fingerprint, frames, batch_size):
+        self.fingerprint = fingerprint
+        self.frames = frames
+        self.batch_size = batch_size
+        self.loads = 0
+        self.objects = set()
+        self.classes = set()
+        self.fields = set()
+        self.recent = deque()
+        self.detected = 0   # window 内の繰り返しを検出した回数
+
+    def report(self):
+        objects = len(self.objects)
+        bulk_requests = (objects + self.batch_size - 1) // self.batch_size
+        return {
+            'fingerprint'  : self.fingerprint,
+            'call_site'    : [ _format_frame(frame) for frame in self.frames ],
+            'classes'      : sorted(self.classes),
+            'fields'       : sorted(self.fields),
+            'loads'        : self.loads,
+            'objects'      : objects,
+            'repeated'     : self.detected > 0,
+            'bulk_requests': bulk_requests,
+            'saved'        : max(0, self.loads - bulk_requests),
+        }
+
+
+class LazyLoadDetector(object):
+    """
+    FbGraphObject の暗黙のロードを記録し、同じ呼び出し元からの繰り返しを検出します。
+    install() してから uninstall() するまで(または with ブロックの中で)、すべてのスレッドの暗黙のロードを記録します。
+    呼び出し元のスタックを調べるのは暗黙のロードが発生した場合だけなので、記録中でもフィールドへのアクセスは遅くなりません。
+    """
+
+    ACTIONS = ('record', 'warn', 'raise')
+
+    def __init__(self, threshold=3, window=1.0, action='warn', depth=3, max_events=1000, callback=None):
+        """
+        @param threshold: 同じ呼び出し元から window 秒以内にこの回数の暗黙のロードがあれば、繰り返しとみなします
+        @type threshold: int
+        @param window: 繰り返しを判定する期間(秒)
+        @type window: int, float
+        @param action: 繰り返しを検出した場合の動作。
+                       'record' は記録だけ、'warn' は呼び出し元毎に 1 回警告をログに出力、
+                       'raise' はロードせずに RepeatedLazyLoadError を送出します
+        @type action: str
+        @param depth: 呼び出し元の指紋に使う、このパッケージの外側のフレームの数
+        @type depth: int
+        @param max_events: events に保持する LazyLoadEvent の最大数
+        @type max_events: int
+        @param callback: 繰り返しを検出した場合に、LazyLoadEvent と呼び出し元の report() の dict を引数に呼び出す関数
+        """
+        if action not in self.ACTIONS:
+            raise TypeError('action must be one of %s.' % ', '.join(self.ACTIONS))
+        if threshold < 2:
+            raise ValueError('threshold must be greater than 1.')
+        self.threshold = threshold
+        self.window = window
+        self.action = action
+        self.depth = depth
+        self.callback = callback
+        self.events = deque(maxlen=max_events)
+        self._sites = {}
+        self._lock = threading.Lock()
+        self._previous_hook = None
+        self._installed = False
+
+    def install(self):
+        """
+        暗黙のロードの記録を開始します。
+        """
+        if self._installed:
+            return
+        self._previous_hook = graphobject._lazy_load_hook
+        graphobject._lazy_load_hook = self._on_lazy_load
+        self._installed = True
+
+    def uninstall(self):
+        """
+        暗黙のロードの記録を終了します。記録した内容は残ります。
+        """
+        if not self._installed:
+            return
+        graphobject._lazy_load_hook = self._previous_hook
+        self._previous_hook = None
+        self._installed = False
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.uninstall()
+
+    def _on_lazy_load(self, obj, field):
+        # 外側の検出器にも記録させる
+        if self._previous_hook is not None:
+            self._previous_hook(obj, field)
+
+        frames = call_site(self.depth, 1)
+        fingerprint = hashlib.md5(repr(frames)).hexdigest()[:12]
+        now = time.time()
+        event = LazyLoadEvent(now, obj.__class__.__name__, obj.get('id'), field, obj.partially_loaded,
+                              fingerprint, frames)
+        self._lock.acquire()
+        try:
+            self.events.append(event)
+            site = self._sites.get(fingerprint)
+            if site is None:
+                site = self._sites[fingerprint] = _CallSite(
+                    fingerprint, frames, getattr(obj.api, 'MAX_IDS_PER_REQUEST', 50))
+            site.loads += 1
+            site.objects.add(event.object_id)
+            site.classes.add(event.class_name)
+            site.fields.add(field)
+            recent = site.recent
+            recent.append(now)
+            while recent and recent[0] < now - self.window:
+                recent.popleft()
+            repeated = len(recent) >= self.threshold
+            if repeated:
+                site.detected += 1
+                first = site.detected == 1
+                report = site.report()
+        finally:
+            self._lock.release()
+
+        if not repeated:
+            return
+        if self.callback is not None:
+            self.callback(event, report)
+        message = u"同じ呼び出し元から %d 件のオブジェクトを 1 件ずつロードしています(%s.%s)。" \
+                  u"load_all() でまとめて読み込んでください。[%s]" % (
+                      report['loads'], event.class_name, field,
+                      _format_frame(frames[0]) if frames else '?')
+        if self.action == 'raise':
+            raise RepeatedLazyLoadError(message, frames, report)
+        if self.action == 'warn' and first:
+            log.warning(message)
+
+    def report(self, repeated_only=False):
+        """
+        呼び出し元毎の記録を、暗黙のロードの多い順に返します。
+        各要素の dict には、呼び出し元のフレーム、クラス名、フィールド名、ロードの回数、オブジェクトの数、
+        load_all() でまとめて読み込んだ場合のリクエスト数(bulk_requests)と減らせたリクエスト数(saved)が含まれます。
+
+        @param repeated_only: 繰り返しを検出した呼び出し元だけを返すか否か
+        @type repeated_only: bool
+        @rtype: list
+        """
+        self._lock.acquire()
+        try:
+            reports = [ site.report() for site in self._sites.values() ]
+        finally:
+            self._lock.release()
+        if repeated_only:
+            reports = [ report for report in reports if report['repeated'] ]
+        reports.sort(key=lambda report: (-report['loads'], report['fingerprint']))
+        return reports
+
+    def summary(self):
+        """
+        繰り返しを検出した呼び出し元と、まとめて読み込んだ場合に減らせたリクエスト数を文字列で返します。
+
+        @rtype: unicode
+        """
+        reports = self.report(repeated_only=True)
+        total = sum(report['loads'] for report in self.report())
+        if not reports:
+            return u"暗黙のロード: %d 回。繰り返しは検出されませんでした。" % total
+        loads = sum(report['loads'] for report in reports)
+        saved = sum(report['saved'] for report in reports)
+        lines = [ u"暗黙のロード: %d 回。%d 箇所の呼び出し元で繰り返しを検出しました。"
+                  u"まとめて読み込めば %d 回のリクエストを %d 回にできます(%d 回削減)。"
+                  % (total, len(reports), loads, loads - saved, saved) ]
+        for report in reports:
+            lines.append(u"  %s  %s.%s  %d 回(%d オブジェクト) -> %d 回" % (
+                report['call_site'][0] if report['call_site'] else '?', '/'.join(report['classes']),
+                ','.join(report['fields']), report['loads'], report['objects'], report['bulk_requests']))
+        return u'\n'.join(lines)
+
+    def reset(self):
+        """
+        記録した内容を破棄します。
+        """
+        self._lock.acquire()
+        try:
+            self.events.clear()
+            self._sites = {}
+        finally:
+            self._lock.release()
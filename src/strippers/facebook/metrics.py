@@ -0,0 +1,484 @@
+# vim:fileencoding=utf-8
+"""
+Graph API リクエストの計測値を受け取るシンクと、集計・出力のためのクラスです。
+
+api = FacebookGraphAPI(access_token, metrics=MetricsAggregator())
+...
+print api.metrics.snapshot()['GET /{id}/posts']['total']['p99']
+
+FacebookGraphAPI は HTTP リクエストを 1 回送信する度に(リトライも 1 回と数えます)、
+RequestMetrics をシンクの record() に渡します。metrics を指定しない場合は何も計測しません。
+"""
+import bisect
+import logging
+import re
+import random
+import socket
+import threading
+
+__author__ = 'otsuka'
+
+log = logging.getLogger(__name__)
+
+
+_ID_SEGMENT = re.compile(r'^\d+(_\d+)*$')
+
+
+def normalize_endpoint(path):
+    """
+    リクエストのパスから数値の ID を取り除き、エンドポイント毎に集計できる形にします。
+
+    normalize_endpoint('1234567/posts?limit=25') => '/{id}/posts'
+    normalize_endpoint('1234_5678/likes')        => '/{id}/likes'
+
+    @param path: BASE_URL からの相対パス、または URL
+    @type path: str
+    @rtype: str
+    """
+    path = path.split('?', 1)[0].split('#', 1)[0]
+    if '://' in path:
+        path = path.split('://', 1)[1]
+    segments = [ '{id}' if _ID_SEGMENT.match(segment) else segment for segment in path.split('/') if segment ]
+    return '/' + '/'.join(segments)
+
+
+class RequestMetrics(object):
+    """
+    HTTP リクエスト 1 回分の計測値です。時間の単位は秒です。
+
+    method               -- HTTP メソッド
+    endpoint             -- ID を取り除いたパス(normalize_endpoint() を参照)
+    status               -- HTTP ステータスコード。レスポンスを受信できなかった場合は None
+    connect_time         -- 新しいコネクションの接続にかかった時間。keep-alive コネクションを再利用した場合は 0
+    first_byte_time      -- リクエストの送信開始からレスポンスヘッダを受信するまでの時間
+    total_time           -- リクエストの送信開始からレスポンスボディを読み終わるまでの時間(コネクションの待ち時間を含む)
+    request_bytes        -- リクエストボディのバイト数
+    response_bytes       -- 受信したレスポンスボディのバイト数(展開前)
+    decoded_bytes        -- 展開後のレスポンスボディのバイト数
+    attempt              -- 何回目の試行か。リトライの場合は 2 以上
+    error                -- 失敗した場合は例外のクラス名(FacebookGraphAPIError のサブクラスに変換された後の名前)
+    """
+
+    __slots__ = ('method', 'endpoint', 'status', 'connect_time', 'first_byte_time', 'total_time',
+                 'request_bytes', 'response_bytes', 'decoded_bytes', 'attempt', 'error')
+
+    def __init__(self, method, endpoint, status=None, connect_time=0.0, first_byte_time=0.0, total_time=0.0,
+                 request_bytes=0, response_bytes=0, decoded_bytes=0, attempt=1, error=None):
+        self.method = method
+        self.endpoint = endpoint
+        self.status = status
+        self.connect_time = connect_time
+        self.first_byte_time = first_byte_time
+        self.total_time = total_time
+        self.request_bytes = request_bytes
+        self.response_bytes = response_bytes
+        self.decoded_bytes = decoded_bytes
+        self.attempt = attempt
+        self.error = error
+
+    @property
+    def retry(self):
+        """
+        リトライのリクエストか否か
+        """
+        return self.attempt > 1
+
+    def __repr__(self):
+        return '<RequestMetrics %s %s status=%s total=%.1fms attempt=%d error=%s>' % (
+            self.method, self.endpoint, self.status, self.total_time * 1000, self.attempt, self.error)
+
+
+class MetricsSink(object):
+    """
+    計測値を受け取るシンクの基底クラスです。record() をオーバーライドしてください。
+    record() は複数のスレッドから同時に呼び出されることがあります。
+    """
+
+    def record(self, metrics):
+        """
+        @param metrics: HTTP リクエスト 1 回分の計測値
+        @type metrics: RequestMetrics
+        """
+        raise NotImplementedError
+
+
+class CallbackSink(MetricsSink):
+    """
+    関数をシンクとして使用します。
+
+    api = FacebookGraphAPI(access_token, metrics=CallbackSink(lambda m: log.info('%r', m)))
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def record(self, metrics):
+        self.callback(metrics)
+
+
+class MultiSink(MetricsSink):
+    """
+    同じ計測値を複数のシンクに渡します。
+
+    aggregator = MetricsAggregator()
+    api = FacebookGraphAPI(access_token, metrics=MultiSink(aggregator, StatsdSink(prefix='myapp.fb')))
+    """
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def record(self, metrics):
+        for sink in self.sinks:
+            try:
+                sink.record(metrics)
+            except Exception:
+                log.exception(u"計測値の記録に失敗しました。[%r]", sink)
+
+
+def _default_bounds():
+    # 0.1 ミリ秒から 100 秒まで、1 桁を 10 分割したバケット。Prometheus のデフォルトのバケットの境界もすべて含む
+    bounds = []
+    for exponent in xrange(-4, 3):
+        for mantissa in (1, 1.25, 1.5, 2, 2.5, 3, 4, 5, 6, 7.5):
+            bounds.append(round(mantissa * 10 ** exponent, 6))
+    return tuple(bounds)
+
+
+class Histogram(object):
+    """
+    固定の境界を持つバケットで値の分布を数えるヒストグラムです。
+    値を保持しないので、記録する値の数に関わらずメモリ使用量は一定です。
+    パーセンタイルはバケット内を線形補間して求めるので、誤差はバケットの幅(既定では 25% 程度)以内です。
+    スレッドセーフではないので、MetricsAggregator のロック内で使用します。
+    """
+
+    DEFAULT_BOUNDS = _default_bounds()
+
+    def __init__(self, bounds=None):
+        """
+        @param bounds: バケットの上限値の昇順のシーケンス。これを超える値は最後の(上限のない)バケットに入ります
+        @type bounds: tuple
+        """
+        self.bounds = tuple(bounds or self.DEFAULT_BOUNDS)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        @param p: パーセンタイル(0 から 100)
+        @type p: int, float
+        @return: 値が記録されていない場合は None
+        @rtype: float
+        """
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else self.max
+                value = lower + (upper - lower) * (rank - seen) / count
+                return min(max(value, self.min), self.max)
+            seen += count
+        return self.max
+
+    def cumulative(self, bounds):
+        """
+        指定した境界以下の値の累積数を返します。指定する境界はこのヒストグラムの境界に含まれている必要があります。
+
+        @rtype: list
+        """
+        results = []
+        for bound in bounds:
+            i = bisect.bisect_left(self.bounds, bound)
+            results.append(sum(self.counts[:i + 1]))
+        return results
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum'  : self.sum,
+            'min'  : self.min,
+            'max'  : self.max,
+            'p50'  : self.percentile(50),
+            'p90'  : self.percentile(90),
+            'p99'  : self.percentile(99),
+        }
+
+
+class _EndpointStats(object):
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.connections = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.decoded_bytes = 0
+        self.statuses = {}
+        self.errors = {}
+        self.total = Histogram()
+        self.first_byte = Histogram()
+        self.connect = Histogram()
+
+
+class MetricsAggregator(MetricsSink):
+    """
+    計測値をプロセス内で、HTTP メソッドとエンドポイントの組毎に集計するシンクです。
+    レイテンシはヒストグラムで集計するので、p50/p90/p99 を取得できます。
+    複数の FacebookGraphAPI インスタンスで共有することができます。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, metrics):
+        key = (metrics.method, metrics.endpoint)
+        self._lock.acquire()
+        try:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = _EndpointStats()
+            stats.requests += 1
+            if metrics.attempt > 1:
+                stats.retries += 1
+            stats.request_bytes += metrics.request_bytes
+            stats.response_bytes += metrics.response_bytes
+            stats.decoded_bytes += metrics.decoded_bytes
+            stats.statuses[metrics.status] = stats.statuses.get(metrics.status, 0) + 1
+            if metrics.error is not None:
+                stats.errors[metrics.error] = stats.errors.get(metrics.error, 0) + 1
+            stats.total.add(metrics.total_time)
+            if metrics.status is not None:
+                stats.first_byte.add(metrics.first_byte_time)
+            if metrics.connect_time:
+                stats.connections += 1
+                stats.connect.add(metrics.connect_time)
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """
+        集計結果を 'METHOD /endpoint' をキーとする dict で返します。
+
+        {'GET /{id}/posts': {'requests': 120, 'retries': 2, 'connections': 3,
+                             'request_bytes': 0, 'response_bytes': 81234, 'decoded_bytes': 402311,
+                             'statuses': {200: 118, 500: 2}, 'errors': {'HTTPError': 2},
+                             'total': {'count': 120, 'sum': ..., 'min': ..., 'max': ...,
+                                       'p50': ..., 'p90': ..., 'p99': ...},
+                             'first_byte': {...}, 'connect': {...}}}
+
+        @rtype: dict
+        """
+        self._lock.acquire()
+        try:
+            results = {}
+            for (method, endpoint), stats in self._stats.items():
+                results['%s %s' % (method, endpoint)] = {
+                    'requests'      : stats.requests,
+                    'retries'       : stats.retries,
+                    'connections'   : stats.connections,
+                    'request_bytes' : stats.request_bytes,
+                    'response_bytes': stats.response_bytes,
+                    'decoded_bytes' : stats.decoded_bytes,
+                    'statuses'      : dict(stats.statuses),
+                    'errors'        : dict(stats.errors),
+                    'total'         : stats.total.summary(),
+                    'first_byte'    : stats.first_byte.summary(),
+                    'connect'       : stats.connect.summary(),
+                }
+            return results
+        finally:
+            self._lock.release()
+
+    def _collect(self, func):
+        """
+        ロックを取得した状態で、(method, endpoint, _EndpointStats) のリストに func を適用した結果を返します。
+        """
+        self._lock.acquire()
+        try:
+            return func(sorted((method, endpoint, stats) for (method, endpoint), stats in self._stats.items()))
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        """
+        集計結果を破棄します。
+        """
+        self._lock.acquire()
+        try:
+            self._stats = {}
+        finally:
+            self._lock.release()
+
+
+class StatsdSink(MetricsSink):
+    """
+    計測値を UDP で statsd に送信するシンクです。
+    HTTP リクエスト 1 回毎に、次のメトリクスを 1 つのパケットにまとめて送信します。
+
+    <prefix>.<method>.<endpoint>.requests      -- カウンタ
+    <prefix>.<method>.<endpoint>.status.<code> -- カウンタ
+    <prefix>.<method>.<endpoint>.retries       -- カウンタ(リトライの場合のみ)
+    <prefix>.<method>.<endpoint>.errors.<name> -- カウンタ(失敗した場合のみ)
+    <prefix>.<method>.<endpoint>.time          -- タイマー(total_time)
+    <prefix>.<method>.<endpoint>.first_byte    -- タイマー
+    <prefix>.<method>.<endpoint>.bytes_in      -- カウンタ(展開前のレスポンスボディのバイト数)
+    <prefix>.<method>.<endpoint>.bytes_out     -- カウンタ(リクエストボディのバイト数)
+
+    endpoint の '/' は '.' に、'{id}' は 'id' に置き換えます。送信に失敗しても例外は送出しません。
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='facebook.graph', sample_rate=1.0):
+        """
+        @param host: statsd のホスト名
+        @type host: str
+        @param port: statsd のポート番号
+        @type port: int
+        @param prefix: メトリクス名の接頭辞
+        @type prefix: str
+        @param sample_rate: 送信する割合(0 から 1)。リクエスト数が多い場合に送信量を減らします
+        @type sample_rate: float
+        """
+        self.address = (host, port)
+        self.prefix = prefix
+        self.sample_rate = sample_rate
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(0)
+
+    @staticmethod
+    def _metric_name(value):
+        return re.sub(r'[^A-Za-z0-9_\-]+', '_', value.replace('{id}', 'id')).strip('_') or 'root'
+
+    def format(self, metrics):
+        """
+        計測値を statsd の行の形式に変換します。
+
+        @rtype: list
+        """
+        name = '%s.%s.%s' % (self.prefix, metrics.method.lower(),
+                             '.'.join([ self._metric_name(segment) for segment in metrics.endpoint.split('/')[1:] ])
+                             or 'root')
+        rate = '' if self.sample_rate >= 1 else '|@%s' % self.sample_rate
+        lines = [
+            '%s.requests:1|c%s' % (name, rate),
+            '%s.status.%s:1|c%s' % (name, metrics.status or 'none', rate),
+            '%s.time:%.3f|ms%s' % (name, metrics.total_time * 1000, rate),
+            '%s.bytes_in:%d|c%s' % (name, metrics.response_bytes, rate),
+            '%s.bytes_out:%d|c%s' % (name, metrics.request_bytes, rate),
+        ]
+        if metrics.status is not None:
+            lines.append('%s.first_byte:%.3f|ms%s' % (name, metrics.first_byte_time * 1000, rate))
+        if metrics.attempt > 1:
+            lines.append('%s.retries:1|c%s' % (name, rate))
+        if metrics.error is not None:
+            lines.append('%s.errors.%s:1|c%s' % (name, self._metric_name(metrics.error), rate))
+        return lines
+
+    def record(self, metrics):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        try:
+            self._socket.sendto('\n'.join(self.format(metrics)), self.address)
+        except socket.error, e:
+            log.debug(u"statsd への送信に失敗しました。%s", e)
+
+    def close(self):
+        self._socket.close()
+
+
+class PrometheusExporter(object):
+    """
+    MetricsAggregator の集計結果を Prometheus のテキスト形式で出力します。
+    アプリケーションの /metrics ハンドラで render() の結果を返してください。
+
+    exporter = PrometheusExporter(aggregator)
+    response = HttpResponse(exporter.render(), content_type=PrometheusExporter.CONTENT_TYPE)
+    """
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, aggregator, namespace='facebook_graph'):
+        """
+        @param aggregator: 出力する集計結果
+        @type aggregator: MetricsAggregator
+        @param namespace: メトリクス名の接頭辞
+        @type namespace: str
+        """
+        self.aggregator = aggregator
+        self.namespace = namespace
+
+    @staticmethod
+    def _labels(**labels):
+        return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                 for key, value in sorted(labels.items()))
+
+    @staticmethod
+    def _format_value(value):
+        return repr(float(value)) if isinstance(value, float) else str(value)
+
+    def render(self):
+        """
+        @rtype: str
+        """
+        return self.aggregator._collect(self._render)
+
+    def _render(self, rows):
+        ns = self.namespace
+        lines = []
+
+        def header(name, type, help):
+            lines.append('# HELP %s_%s %s' % (ns, name, help))
+            lines.append('# TYPE %s_%s %s' % (ns, name, type))
+
+        def histogram(name, help, attr):
+            header(name, 'histogram', help)
+            for method, endpoint, stats in rows:
+                h = getattr(stats, attr)
+                if not h.count:
+                    continue
+                for bound, count in zip(self.BUCKETS, h.cumulative(self.BUCKETS)):
+                    lines.append('%s_%s_bucket%s %d' % (ns, name, self._labels(method=method, endpoint=endpoint,
+                                                                               le=self._format_value(float(bound))), count))
+                lines.append('%s_%s_bucket%s %d' % (ns, name, self._labels(method=method, endpoint=endpoint, le='+Inf'),
+                                                    h.count))
+                lines.append('%s_%s_sum%s %r' % (ns, name, self._labels(method=method, endpoint=endpoint), h.sum))
+                lines.append('%s_%s_count%s %d' % (ns, name, self._labels(method=method, endpoint=endpoint), h.count))
+
+        def counter(name, help, values):
+            header(name, 'counter', help)
+            for method, endpoint, stats in rows:
+                for labels, value in values(stats):
+                    lines.append('%s_%s%s %d' % (ns, name, self._labels(method=method, endpoint=endpoint, **labels),
+                                                 value))
+
+        counter('requests_total', 'HTTP requests sent to the Graph API.',
+                lambda s: [ ({'status': status or 'none'}, n) for status, n in sorted(s.statuses.items()) ])
+        counter('retries_total', 'Requests that were retries of a failed request.',
+                lambda s: [ ({}, s.retries) ])
+        counter('errors_total', 'Failed requests by error class.',
+                lambda s: [ ({'error': error}, n) for error, n in sorted(s.errors.items()) ])
+        counter('request_bytes_total', 'Bytes of request bodies.',
+                lambda s: [ ({}, s.request_bytes) ])
+        counter('response_bytes_total', 'Bytes of response bodies before and after decompression.',
+                lambda s: [ ({'encoding': 'raw'}, s.response_bytes), ({'encoding': 'decoded'}, s.decoded_bytes) ])
+        histogram('request_duration_seconds', 'Time until the response body was read.', 'total')
+        histogram('first_byte_seconds', 'Time until the response headers were received.', 'first_byte')
+        histogram('connect_seconds', 'Time to open a new connection.', 'connect')
+        return '\n'.join(lines) + '\n'
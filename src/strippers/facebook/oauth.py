@@ -0,0 +1,293 @@
+# vim:fileencoding=utf-8
+"""
+OAuth 認可と signed_request の処理。
+
+urllib2 などの重いモジュールに依存しないので、FacebookGraphAPI を使わずに
+認可ページの URL の作成や signed_request の検証だけを行う場合は、このモジュールだけで済みます。
+"""
+import base64
+import hashlib
+import hmac
+import logging
+import threading
+import time
+from strippers.facebook import jsoncodec as json
+
+__author__ = 'otsuka'
+
+log = logging.getLogger(__name__)
+
+AUTHORIZATION_URI = 'https://www.facebook.com/dialog/oauth'
+TOKEN_URI         = 'https://graph.facebook.com/oauth/access_token'
+
+def get_auth_url(app_id, scopes, redirect_uri, state=None, display=None):
+    """
+    OAuth 認可ページ の URL を返します。
+
+    @param app_id: Facebook アプリの App ID
+    @type app_id: str, unicode
+    @param scopes: 認可を求めるパーミッションのリスト
+    @type scopes: list, tuple
+    @param redirect_uri: 認可後のリダイレクト先 URL
+    @type redirect_uri: str, unicode
+    @param state:
+    @param display: 認可ダイアログの表示方法。'page', 'popup', 'iframe', 'touch', 'wap' のいずれか。デフォルトは 'page'
+    @type display: str, unicode
+    @return: OAuth 認可ページの URL
+    @rtype: str
+    """
+    params = {
+        'client_id'     : app_id,
+        'response_type' : 'code',
+        'redirect_uri'  : redirect_uri,
+        }
+    if state:
+        params['state'] = state
+    if display:
+        if display in ('page', 'popup', 'iframe', 'touch', 'wap'):
+            params['display'] = display
+        else:
+            raise ValueError, "'%s' is invalid for display." % display
+    params['scope'] = ','.join(scopes)
+    from urllib import urlencode # urllib は読み込みに時間がかかるので、使う時に読み込む
+    return AUTHORIZATION_URI + '?' + urlencode(params)
+
+def _constant_time_compare(a, b):
+    """
+    2 つの文字列を、一致しない位置に関わらず一定の時間で比較します。hmac.compare_digest のない Python 用です。
+    """
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+compare_digest = getattr(hmac, 'compare_digest', _constant_time_compare)
+
+
+def _urlsafe_b64decode(value):
+    return base64.urlsafe_b64decode(value + '=' * ((4 - len(value) % 4) % 4))
+
+
+_TRANS_5C = ''.join(chr(x ^ 0x5C) for x in xrange(256))
+_TRANS_36 = ''.join(chr(x ^ 0x36) for x in xrange(256))
+
+
+class SignedRequestVerifier(object):
+    """
+    App Secret を固定して signed_request を検証します。
+    リクエスト毎に signed_request を検証するキャンバスやログインのエンドポイントでは、
+    parse_signed_request() の代わりにアプリケーション全体で 1 つのインスタンスを共有してください。
+
+    - App Secret で初期化した HMAC-SHA256 の内側と外側のハッシュの状態を保持し、検証の度にコピーして使います
+    - JSON をデコードする前に署名を検証するので、不正な signed_request のデコードにコストがかかりません
+    - 署名は一定時間で比較します
+    - 検証済みの signed_request をキャッシュに保持し、同じ signed_request の検証を省略します。
+      キャッシュするのは JSON の文字列で、返す dict は呼び出し毎に作り直すので、呼び出し側で変更しても構いません
+
+    verifier = SignedRequestVerifier(app_secret, max_age=3600)
+    data = verifier.verify(request.POST['signed_request'])
+    if not data:
+        ...
+    """
+
+    ALGORITHM = 'HMAC-SHA256'
+
+    def __init__(self, app_secret, cache_size=1024, max_age=None):
+        """
+        @param app_secret: Facebook アプリの App Secret
+        @type app_secret: str
+        @param cache_size: 検証済みの signed_request を保持する数。0 の場合はキャッシュしません
+        @type cache_size: int
+        @param max_age: issued_at からこの秒数が経過した signed_request は無効とします。
+                        キャッシュしたものも、この秒数が経過すると破棄されます。None の場合は確認しません
+        @type max_age: int, float
+        """
+        # hmac.HMAC.copy() は Python で実装されていて遅いので、鍵を適用したハッシュの状態を自分で保持する
+        key = str(app_secret)
+        block_size = hashlib.sha256().block_size
+        if len(key) > block_size:
+            key = hashlib.sha256(key).digest()
+        key += '\x00' * (block_size - len(key))
+        self._inner = hashlib.sha256(key.translate(_TRANS_36))
+        self._outer = hashlib.sha256(key.translate(_TRANS_5C))
+        self.cache_size = cache_size
+        self.max_age = max_age
+        # LRU の近似として、新しい世代が cache_size の半分に達したら古い世代を捨てる 2 世代のキャッシュを使う。
+        # 古い世代でヒットしたものは新しい世代に移す。
+        self._cache = {}     # signed_request -> (JSON の文字列, 有効期限)
+        self._previous = {}
+        self._stats = {
+            'verified': 0,
+            'hits'    : 0,
+            'rejected': 0,
+        }
+
+    def verify(self, signed_request):
+        """
+        signed_request の署名を検証し、デコードしたデータを返します。
+        signed_request が不正な場合、署名が一致しない場合、issued_at が max_age より古い場合は False を返します。
+
+        @param signed_request: signed_request パラメータの値
+        @type signed_request: str
+        @return: signed_request のデータ
+        @rtype: dict
+        """
+        return self._check(signed_request)[0]
+
+    def verify_many(self, signed_requests):
+        """
+        複数の signed_request を検証します。アクセスログの再処理などに使用します。
+
+        @param signed_requests: signed_request のシーケンス
+        @type signed_requests: iterable
+        @return: verify() の戻り値のリスト
+        @rtype: list
+        """
+        check = self._check
+        verified = {} # 同じ signed_request が何度も含まれる場合は、キャッシュも参照せずに JSON をデコードし直す
+        results = []
+        for signed_request in signed_requests:
+            decoded = verified.get(signed_request)
+            if decoded is None:
+                data, decoded = check(signed_request)
+                verified[signed_request] = decoded if data is not False else False
+            elif decoded is False:
+                data = False
+            else:
+                data = json.loads(decoded)
+            results.append(data)
+        return results
+
+    def _check(self, signed_request):
+        """
+        signed_request を検証し、データと、デコードする前の JSON の文字列のタプルを返します。
+        無効な場合は (False, None) を返します。
+        """
+        # 呼び出し毎のロックを避けるため、キャッシュと統計は GIL の下でアトミックな dict の操作だけで更新する。
+        # 同時に呼び出された場合に統計の値がわずかにずれることがある
+        stats = self._stats
+        if self.cache_size:
+            entry = self._cache.get(signed_request) or self._lookup_previous(signed_request)
+            if entry is not None and (entry[1] is None or time.time() <= entry[1]):
+                stats['hits'] += 1
+                # 呼び出し側がデータ(入れ子の dict を含む)を変更してもキャッシュに影響しないように、毎回デコードする
+                return json.loads(entry[0]), entry[0]
+        data, decoded = self._verify(signed_request)
+        if data is False:
+            stats['rejected'] += 1
+            return False, None
+        stats['verified'] += 1
+        if self.cache_size:
+            self._store(signed_request, decoded, data.get('issued_at'))
+        return data, decoded
+
+    def _verify(self, signed_request):
+        try:
+            parts = str(signed_request).split('.', 2)
+            encoded_sig, payload = parts[0], parts[1]
+            sig = _urlsafe_b64decode(encoded_sig)
+        except (IndexError, TypeError, UnicodeError):
+            return False, None # signed_request malformed
+
+        inner = self._inner.copy()
+        inner.update(payload)
+        outer = self._outer.copy()
+        outer.update(inner.digest())
+        if not compare_digest(outer.digest(), sig):
+            return False, None # signed_request had signature mismatch
+
+        try:
+            decoded = _urlsafe_b64decode(payload)
+            data = json.loads(decoded)
+        except (ValueError, TypeError):
+            return False, None # signed_request had corrupted payload
+        if not isinstance(data, dict) or str(data.get('algorithm', '')).upper() != self.ALGORITHM:
+            return False, None # signed_request used unknown algorithm
+        if self.max_age is not None:
+            issued_at = data.get('issued_at')
+            if not isinstance(issued_at, (int, long, float)) or time.time() - issued_at > self.max_age:
+                return False, None # signed_request expired
+        return data, decoded
+
+    def _lookup_previous(self, signed_request):
+        entry = self._previous.pop(signed_request, None)
+        if entry is not None:
+            self._cache[signed_request] = entry
+        return entry
+
+    def _store(self, signed_request, decoded, issued_at):
+        expires = None
+        if self.max_age is not None:
+            expires = issued_at + self.max_age
+        if len(self._cache) >= max(1, self.cache_size // 2):
+            self._previous, self._cache = self._cache, {}
+        self._cache[signed_request] = (decoded, expires)
+
+    def stats(self):
+        """
+        署名を検証した数、キャッシュにヒットした数、無効とした数を返します。
+
+        @rtype: dict
+        """
+        return dict(self._stats)
+
+    def clear(self):
+        """
+        検証済みの signed_request のキャッシュを破棄します。
+        """
+        self._cache, self._previous = {}, {}
+
+
+MAX_VERIFIERS = 16
+
+_verifiers = {}
+_verifiers_lock = threading.Lock()
+
+def get_verifier(app_secret):
+    """
+    App Secret 毎に共有する SignedRequestVerifier を返します。
+
+    @param app_secret: Facebook アプリの App Secret
+    @type app_secret: str
+    @rtype: SignedRequestVerifier
+    """
+    verifier = _verifiers.get(app_secret)
+    if verifier is not None:
+        return verifier
+    _verifiers_lock.acquire()
+    try:
+        verifier = _verifiers.get(app_secret)
+        if verifier is None:
+            if len(_verifiers) >= MAX_VERIFIERS:
+                _verifiers.clear()
+            verifier = _verifiers[app_secret] = SignedRequestVerifier(app_secret)
+        return verifier
+    finally:
+        _verifiers_lock.release()
+
+
+def parse_signed_request(signed_request, app_secret):
+    """
+
+    https://github.com/pythonforfacebook/facebook-sdk から
+
+    Return dictionary with signed request data.
+
+    We return a dictionary containing the information in the signed_request. This will
+    include a user_id if the user has authorised your application, as well as any
+    information requested in the scope.
+
+    If the signed_request is malformed or corrupted, False is returned.
+
+    App Secret 毎に共有する SignedRequestVerifier で検証します。issued_at を確認する場合は
+    SignedRequestVerifier を max_age を指定して作成してください。
+
+    @param signed_request:
+    @type signed_request: str
+    @param app_secret:
+    @type app_secret: str
+    @rtype: dict
+    """
+    return get_verifier(app_secret).verify(signed_request)
@@ -0,0 +1,227 @@
+# vim:fileencoding=utf-8
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+__author__ = 'otsuka'
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """
+    トークンバケット方式でリクエストの送信ペースを制御します。
+
+    rate の速度でトークンが補充され、リクエストを送信する度にトークンを 1 つ消費します。
+    API からスロットリングのエラーが返された場合は rate を下げ、成功するたびに少しずつ元の rate に戻します。
+    """
+
+    def __init__(self, rate, capacity=None, min_rate=None, recovery=0.05):
+        """
+        @param rate: 1 秒あたりに補充するトークン数
+        @type rate: int, float
+        @param capacity: バケットに貯められるトークンの最大数(バースト)。省略した場合は rate と同じ
+        @type capacity: int, float
+        @param min_rate: スロットリングされた場合に下げる rate の下限。省略した場合は rate の 1/10
+        @type min_rate: int, float
+        @param recovery: リクエストが成功する度に rate に加算する値の、元の rate に対する割合
+        @type recovery: float
+        """
+        if rate <= 0:
+            raise ValueError('rate must be greater than 0.')
+        self.base_rate = float(rate)
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.min_rate = float(min_rate if min_rate is not None else rate / 10.0)
+        self.recovery = recovery
+        self._tokens = self.capacity
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated = now
+
+    def acquire(self, tokens=1, block=True, timeout=None):
+        """
+        トークンを消費します。トークンが足りない場合は、補充されるまで待ちます。
+
+        @param tokens: 消費するトークン数
+        @type tokens: int, float
+        @param block: トークンが足りない場合に待つか否か
+        @type block: bool
+        @param timeout: 待つ最大秒数。None の場合はトークンが補充されるまで待ちます
+        @type timeout: int, float
+        @return: トークンを消費できた場合は True
+        @rtype: bool
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            self._lock.acquire()
+            try:
+                now = time.time()
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return True
+                wait = (tokens - self._tokens) / self.rate
+            finally:
+                self._lock.release()
+            if not block:
+                return False
+            if deadline is not None:
+                if now + wait > deadline:
+                    return False
+            time.sleep(wait)
+
+    def release(self, tokens=1):
+        """
+        acquire() で消費したトークンを、リクエストを送信しなかったので返却します。
+        """
+        self._lock.acquire()
+        try:
+            self._tokens = min(self.capacity, self._tokens + tokens)
+        finally:
+            self._lock.release()
+
+    def throttled(self, factor=0.5):
+        """
+        API からスロットリングのエラーが返されたことを通知します。
+        rate を factor 倍に下げ、貯まっているトークンを捨てます。
+        """
+        self._lock.acquire()
+        try:
+            self.rate = max(self.min_rate, self.rate * factor)
+            self._tokens = 0.0
+            self._updated = time.time()
+            log.info(u"スロットリングされたので送信レートを下げます。[rate=%.3f/s]", self.rate)
+        finally:
+            self._lock.release()
+
+    def succeeded(self):
+        """
+        リクエストが成功したことを通知します。下げていた rate を少しずつ元に戻します。
+        """
+        if self.rate < self.base_rate:
+            self._lock.acquire()
+            try:
+                self.rate = min(self.base_rate, self.rate + self.base_rate * self.recovery)
+            finally:
+                self._lock.release()
+
+
+class RateLimiter(object):
+    """
+    アクセストークン毎とアプリ毎のトークンバケットで、API リクエストの送信ペースを制御します。
+
+    アクセストークン毎のバケットは、ユーザーのアクセストークンとアプリケーションアクセストークン
+    (send_post_request_for_app() や TestUserAPI のリクエスト)のそれぞれに作られます。
+    アプリ毎のバケットは、そのアプリのすべてのリクエストで共有されます。
+
+    limiter = RateLimiter(token_rate=5, app_rate=100)
+    api = FacebookGraphAPI(access_token, app_id, app_secret, rate_limiter=limiter)
+    """
+
+    APP_LIMIT_ERROR_CODES  = (4,)  # アプリ単位の制限
+    USER_LIMIT_ERROR_CODES = (17,) # ユーザー単位の制限
+
+    def __init__(self, token_rate=None, token_burst=None, app_rate=None, app_burst=None,
+                 timeout=None, max_buckets=10000):
+        """
+        @param token_rate: アクセストークン毎の 1 秒あたりのリクエスト数。None の場合は制限しません
+        @type token_rate: int, float
+        @param token_burst: アクセストークン毎に連続して送信できるリクエスト数
+        @type token_burst: int, float
+        @param app_rate: アプリ毎の 1 秒あたりのリクエスト数。None の場合は制限しません
+        @type app_rate: int, float
+        @param app_burst: アプリ毎に連続して送信できるリクエスト数
+        @type app_burst: int, float
+        @param timeout: 送信できるようになるまで待つ最大秒数。None の場合は送信できるまで待ちます
+        @type timeout: int, float
+        @param max_buckets: 保持するアクセストークン毎のバケットの最大数。超えた場合は最も長く使われていないものから捨てます
+        @type max_buckets: int
+        """
+        self.token_rate = token_rate
+        self.token_burst = token_burst
+        self.app_rate = app_rate
+        self.app_burst = app_burst
+        self.timeout = timeout
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _bucket(self, key, rate, burst):
+        self._lock.acquire()
+        try:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                bucket = TokenBucket(rate, burst)
+            self._buckets[key] = bucket
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+            return bucket
+        finally:
+            self._lock.release()
+
+    def buckets(self, access_token=None, app_id=None):
+        """
+        リクエストに適用されるトークンバケットのリストを返します。
+
+        @rtype: list
+        """
+        buckets = []
+        if self.token_rate is not None and access_token:
+            key = ('token', hashlib.sha1(access_token).hexdigest())
+            buckets.append(self._bucket(key, self.token_rate, self.token_burst))
+        if self.app_rate is not None and app_id:
+            buckets.append(self._bucket(('app', str(app_id)), self.app_rate, self.app_burst))
+        return buckets
+
+    def acquire(self, access_token=None, app_id=None):
+        """
+        リクエストを送信できるようになるまで待ちます。
+
+        @param access_token: リクエストに使用するアクセストークン
+        @type access_token: str
+        @param app_id: リクエストを送信するアプリの App ID
+        @type app_id: str
+        @return: 待たずに送信できた場合、または timeout までに送信できるようになった場合は True
+        @rtype: bool
+        """
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        acquired = []
+        for bucket in self.buckets(access_token, app_id):
+            timeout = None if deadline is None else max(0, deadline - time.time())
+            if not bucket.acquire(timeout=timeout):
+                # 送信しないので、先に消費した他のバケットのトークンを返却する
+                for other in acquired:
+                    other.release()
+                return False
+            acquired.append(bucket)
+        return True
+
+    def throttled(self, access_token=None, app_id=None, code=None):
+        """
+        API からスロットリングのエラーが返されたことを通知します。
+        エラーコードからアプリ単位の制限かユーザー単位の制限か分かる場合は、該当するバケットだけ送信レートを下げます。
+
+        @param code: API が返したエラーコード
+        @type code: int
+        """
+        if code in self.APP_LIMIT_ERROR_CODES and self.app_rate is not None:
+            access_token = None
+        elif code in self.USER_LIMIT_ERROR_CODES and self.token_rate is not None:
+            app_id = None
+        for bucket in self.buckets(access_token, app_id):
+            bucket.throttled()
+
+    def succeeded(self, access_token=None, app_id=None):
+        """
+        リクエストが成功したことを通知します。
+        """
+        for bucket in self.buckets(access_token, app_id):
+            bucket.succeeded()
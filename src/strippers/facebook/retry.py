@@ -0,0 +1,199 @@
+# vim:fileencoding=utf-8
+import logging
+import random
+import threading
+import time
+from strippers.facebook.error import is_transient_error, is_unsent_error
+
+__author__ = 'otsuka'
+
+log = logging.getLogger(__name__)
+
+
+class RetryBudget(object):
+    """
+    リトライの回数を、通常のリクエスト数に対する割合で制限します。
+    障害時にリトライがリクエスト数を何倍にも増やして、障害を悪化させるのを防ぎます。
+
+    リクエストを送信する度に ratio だけ残高が増え、リトライする度に 1 減ります。
+    リクエストが少ない場合のために、1 秒あたり min_per_second の残高が補充されます。
+    残高は reserve 秒分の補充量から始まります。
+    """
+
+    def __init__(self, ratio=0.2, min_per_second=1.0, max_balance=100.0, reserve=10):
+        """
+        @param ratio: リクエスト 1 回あたりに許可するリトライの回数
+        @type ratio: float
+        @param min_per_second: リクエスト数に関わらず、1 秒あたりに許可するリトライの回数
+        @type min_per_second: float
+        @param max_balance: 貯めておけるリトライの回数の上限
+        @type max_balance: float
+        @param reserve: 残高の初期値を、min_per_second の何秒分にするか
+        @type reserve: int, float
+        """
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_balance = max_balance
+        self._balance = min(max_balance, min_per_second * reserve)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self._balance = min(self.max_balance, self._balance + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def deposit(self):
+        """
+        リクエストを 1 回送信したことを記録します。
+        """
+        self._lock.acquire()
+        try:
+            self._refill()
+            self._balance = min(self.max_balance, self._balance + self.ratio)
+        finally:
+            self._lock.release()
+
+    def withdraw(self):
+        """
+        リトライを 1 回行えるか判定し、行える場合は残高を減らします。
+
+        @return: リトライしてよい場合は True
+        @rtype: bool
+        """
+        self._lock.acquire()
+        try:
+            self._refill()
+            if self._balance >= 1:
+                self._balance -= 1
+                return True
+            return False
+        finally:
+            self._lock.release()
+
+
+class RetryPolicy(object):
+    """
+    一時的なエラー(コネクションの切断、タイムアウト、5xx エラー)で失敗したリクエストを、
+    指数バックオフとジッターを入れた間隔でリトライします。
+
+    冪等な HTTP メソッドのリクエストだけをリトライします。retry_post=True を指定すると、POST リクエストも
+    サーバーが処理していないことが確実なエラー(接続の失敗と呼び出し回数の制限)の場合に限りリトライします。
+
+    api = FacebookGraphAPI(access_token, retry_policy=RetryPolicy(max_attempts=5))
+    """
+
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+    def __init__(self, max_attempts=3, backoff=0.5, max_backoff=30.0, jitter=True,
+                 retry_post=False, budget=None):
+        """
+        @param max_attempts: 1 回目を含む最大の試行回数。1 の場合はリトライしません
+        @type max_attempts: int
+        @param backoff: 1 回目のリトライまでの待ち時間(秒)。リトライする度に 2 倍になります
+        @type backoff: float
+        @param max_backoff: リトライまでの待ち時間の上限(秒)
+        @type max_backoff: float
+        @param jitter: 待ち時間を 0 からバックオフ時間の間でランダムにするか否か
+        @type jitter: bool
+        @param retry_post: 冪等でない POST リクエストも、送信前に失敗した場合(接続の失敗、呼び出し回数の制限)は
+                           リトライするか否か。5xx やタイムアウトでは、二重に処理されないようにリトライしません
+        @type retry_post: bool
+        @param budget: リトライの回数を制限する RetryBudget。省略した場合はデフォルトの RetryBudget を使用します
+        @type budget: RetryBudget
+        """
+        if max_attempts < 1:
+            raise ValueError('max_attempts must be greater than 0.')
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_post = retry_post
+        self.budget = budget if budget is not None else RetryBudget()
+        self._lock = threading.Lock()
+        self._stats = {
+            'requests'        : 0,
+            'retries'         : 0,
+            'budget_exhausted': 0,
+        }
+
+    def is_retryable(self, method, error):
+        """
+        @param method: リクエストの HTTP メソッド
+        @type method: str
+        @param error: リクエストで発生した例外
+        @type error: Exception
+        @return: リトライしてよいエラーであれば True
+        @rtype: bool
+        """
+        if method.upper() in self.IDEMPOTENT_METHODS:
+            return is_transient_error(error)
+        return self.retry_post and is_unsent_error(error)
+
+    def delay(self, attempt):
+        """
+        attempt 回目の試行が失敗した後、次の試行までに待つ秒数を返します。
+
+        @param attempt: 失敗した試行の回数(1 から)
+        @type attempt: int
+        @rtype: float
+        """
+        delay = min(self.max_backoff, self.backoff * (2 ** (attempt - 1)))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def call(self, func, method='GET', max_attempts=None):
+        """
+        func を呼び出し、一時的なエラーで失敗した場合はリトライします。
+
+        @param func: 引数なしで呼び出す関数
+        @param method: リクエストの HTTP メソッド
+        @type method: str
+        @param max_attempts: この呼び出しでの最大の試行回数。省略した場合は self.max_attempts
+        @type max_attempts: int
+        @return: func の戻り値と試行回数のタプル
+        @rtype: tuple
+        """
+        if max_attempts is None:
+            max_attempts = self.max_attempts
+        self._count('requests')
+        self.budget.deposit()
+        attempt = 1
+        while True:
+            try:
+                return func(), attempt
+            except Exception, e:
+                if attempt >= max_attempts or not self.is_retryable(method, e):
+                    e.attempts = attempt
+                    raise
+                if not self.budget.withdraw():
+                    log.warning(u"リトライの上限に達しているので、リトライしません。%s", e)
+                    self._count('budget_exhausted')
+                    e.attempts = attempt
+                    raise
+                delay = self.delay(attempt)
+                log.info(u"リクエストに失敗したので、%.2f 秒後にリトライします。[%d/%d] %s",
+                         delay, attempt, max_attempts - 1, e)
+                self._count('retries')
+                time.sleep(delay)
+                attempt += 1
+
+    def _count(self, name):
+        self._lock.acquire()
+        try:
+            self._stats[name] += 1
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        リクエスト数、リトライ数、予算不足でリトライしなかった回数を返します。
+
+        @rtype: dict
+        """
+        self._lock.acquire()
+        try:
+            return dict(self._stats)
+        finally:
+            self._lock.release()
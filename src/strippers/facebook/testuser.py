@@ -1,13 +1,8 @@
 # vim:fileencoding=utf-8
 import logging
-try:
-    import json
-except ImportError:
-    try:
-        from django.utils import simplejson as json
-    except ImportError:
-        import simplejson as json
 from strippers.facebook.graphapi import FacebookGraphAPI, get_app_token
+from strippers.facebook.graphobject import GraphPager
+from strippers.facebook import jsoncodec as json
 
 __author__ = 'otsuka'
 
@@ -16,10 +11,19 @@ log = logging.getLogger(__name__)
 
 class TestUserAPI(object):
 
-    def __init__(self, app_id, app_secret):
+    def __init__(self, app_id, app_secret, app_token_provider=None):
+        """
+        @param app_id: Facebook アプリの App ID
+        @type app_id: str
+        @param app_secret: Facebook アプリの App Secret
+        @type app_secret: str
+        @param app_token_provider: アプリケーションアクセストークンを取得する AppTokenProvider。
+                                   省略した場合は、プロセス内で共有する既定の AppTokenProvider を使用します
+        @type app_token_provider: strippers.facebook.apptoken.AppTokenProvider
+        """
         self._app_id = app_id
         self._app_secret = app_secret
-        self._api = FacebookGraphAPI('', app_id, app_secret)
+        self._api = FacebookGraphAPI('', app_id, app_secret, app_token_provider=app_token_provider)
 
     def create_test_user(self, name, installed=True, permissions=()):
         """
@@ -57,10 +61,7 @@ class TestUserAPI(object):
         @rtype: list
         """
         uri = u"%s%s/accounts/test-users" % (self._api.BASE_URL, self._app_id)
-        params = { 'access_token': self._api.app_token }
-        res = self._api._send_api_request(uri, params, access_token=self._api.app_token)
-        data = json.loads(res)
-        return data['data']
+        return list(GraphPager(self._api, uri, access_token=self._api.app_token))
 
     def become_friends(self, test_user_id, test_user_token, test_user2_id, test_user2_token):
         """
@@ -0,0 +1,478 @@
+# vim:fileencoding=utf-8
+"""
+多数のユーザーのアクセストークンを管理し、有効期限が近づいたものをバックグラウンドで延長します。
+
+manager = TokenManager(app_id, app_secret, store=MyDatabaseTokenStore())
+manager.start()
+manager.add(user_id, api.access_token, api.expired_at)
+...
+api = manager.api_for(user_id)   # 延長済みのトークンを持つ FacebookGraphAPI
+api.me.feed()
+
+リクエストの処理中にトークンの延長を待つことはありません。
+延長に失敗したトークン(ユーザーが認可を取り消した場合など)は管理から外し、on_invalid を呼び出します。
+"""
+import heapq
+import logging
+import threading
+import time
+from datetime import datetime
+from strippers.facebook.connection import ConnectionPool
+from strippers.facebook.error import InvalidTokenError
+from strippers.facebook.future import WorkerPool
+from strippers.facebook.graphapi import FacebookGraphAPI
+
+__author__ = 'otsuka'
+
+log = logging.getLogger(__name__)
+
+
+def _to_timestamp(expired_at):
+    """
+    有効期限を UNIX 時刻に変換します。FacebookGraphAPI.expired_at と同じく、datetime はローカル時刻とみなします。
+    """
+    if expired_at is None:
+        return None
+    if isinstance(expired_at, datetime):
+        return time.mktime(expired_at.timetuple()) + expired_at.microsecond / 1e6
+    return float(expired_at)
+
+
+class TokenStore(object):
+    """
+    アクセストークンを永続化するストアの基底クラスです。
+    データベースなどに保存する場合は、このクラスを継承して各メソッドをオーバーライドしてください。
+    各メソッドは TokenManager のワーカースレッドから同時に呼び出されることがあります。
+    """
+
+    def load(self, user_id):
+        """
+        @param user_id: ユーザー ID
+        @return: アクセストークンと有効期限(datetime または None)のタプル。保存されていない場合は None
+        @rtype: tuple
+        """
+        raise NotImplementedError
+
+    def save(self, user_id, access_token, expired_at):
+        """
+        @param user_id: ユーザー ID
+        @param access_token: アクセストークン
+        @type access_token: str
+        @param expired_at: 有効期限。期限がない場合は None
+        @type expired_at: datetime
+        """
+        raise NotImplementedError
+
+    def delete(self, user_id):
+        """
+        @param user_id: ユーザー ID
+        """
+        raise NotImplementedError
+
+    def items(self):
+        """
+        保存されているすべてのトークンを返します。TokenManager.load_store() で使用します。
+
+        @return: (ユーザー ID, アクセストークン, 有効期限) のタプルの iterable
+        """
+        raise NotImplementedError
+
+
+class MemoryTokenStore(TokenStore):
+    """
+    プロセスのメモリにトークンを保持するストアです。テストや、永続化が不要な場合に使用します。
+    """
+
+    def __init__(self):
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def load(self, user_id):
+        self._lock.acquire()
+        try:
+            return self._tokens.get(user_id)
+        finally:
+            self._lock.release()
+
+    def save(self, user_id, access_token, expired_at):
+        self._lock.acquire()
+        try:
+            self._tokens[user_id] = (access_token, expired_at)
+        finally:
+            self._lock.release()
+
+    def delete(self, user_id):
+        self._lock.acquire()
+        try:
+            self._tokens.pop(user_id, None)
+        finally:
+            self._lock.release()
+
+    def items(self):
+        self._lock.acquire()
+        try:
+            return [ (user_id, token, expired_at) for user_id, (token, expired_at) in self._tokens.items() ]
+        finally:
+            self._lock.release()
+
+
+class TokenManager(object):
+    """
+    ユーザー毎のアクセストークンと有効期限を管理し、有効期限の refresh_before 秒前になったトークンを
+    バックグラウンドのワーカースレッドで延長します(FacebookGraphAPI.extend_access_token_expiration())。
+
+    - 同時に延長するトークンの数は workers 個までです
+    - 延長したトークンは store に保存され、以後の api_for() で返される FacebookGraphAPI に使われます
+    - api_for() が返す FacebookGraphAPI は、コネクションプールなどを共有します
+    - 一時的なエラーで延長に失敗した場合は retry_delay 秒後にやり直します
+    - トークンが無効になっていた場合は管理から外し、on_invalid(user_id, error) を呼び出します
+    """
+
+    def __init__(self, app_id, app_secret, store=None, refresh_before=7 * 24 * 60 * 60, workers=4,
+                 retry_delay=5 * 60, on_invalid=None, api_class=FacebookGraphAPI, **api_kwargs):
+        """
+        @param app_id: Facebook アプリの App ID
+        @type app_id: str
+        @param app_secret: Facebook アプリの App Secret
+        @type app_secret: str
+        @param store: トークンを永続化するストア。省略した場合は MemoryTokenStore
+        @type store: TokenStore
+        @param refresh_before: 有効期限のこの秒数前にトークンを延長します
+        @type refresh_before: int, float
+        @param workers: 同時に延長するトークンの最大数
+        @type workers: int
+        @param retry_delay: 一時的なエラーで延長に失敗した場合に、やり直すまでの秒数
+        @type retry_delay: int, float
+        @param on_invalid: 延長できない無効なトークンを見つけた場合に、ユーザー ID と例外を引数に呼び出す関数
+        @param api_class: api_for() で作成するクラス
+        @type api_class: type
+        @param api_kwargs: api_class に渡すキーワード引数。connection_pool を省略した場合は共有のプールを作成します
+        """
+        self.app_id = app_id
+        self.app_secret = app_secret
+        self.store = store if store is not None else MemoryTokenStore()
+        self.refresh_before = refresh_before
+        self.workers = workers
+        self.retry_delay = retry_delay
+        self.on_invalid = on_invalid
+        self.api_class = api_class
+        if 'connection_pool' not in api_kwargs:
+            api_kwargs['connection_pool'] = ConnectionPool(api_kwargs.pop('pool_size', 10))
+        self.api_kwargs = api_kwargs
+        self._tokens = {}        # user_id -> (アクセストークン, 有効期限の datetime, 延長する UNIX 時刻)
+        self._schedule = []      # (延長する UNIX 時刻, user_id) のヒープ。古くなった要素は取り出した時に捨てる
+        self._refreshing = set() # 延長中の user_id
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+        self._pool = None
+        self._stopped = False
+        self._stats = {
+            'refreshed': 0,
+            'retried'  : 0,
+            'invalid'  : 0,
+        }
+
+    # トークンの登録と取得
+
+    def add(self, user_id, access_token, expired_at=None, save=True):
+        """
+        ユーザーのアクセストークンを登録します。有効期限がある場合は延長の予定に追加します。
+
+        @param user_id: ユーザー ID
+        @param access_token: アクセストークン
+        @type access_token: str
+        @param expired_at: 有効期限。FacebookGraphAPI.expired_at と同じ datetime、または UNIX 時刻
+        @type expired_at: datetime, int, float
+        @param save: store に保存するか否か
+        @type save: bool
+        """
+        if expired_at is not None and not isinstance(expired_at, datetime):
+            expired_at = datetime.fromtimestamp(expired_at)
+        if save:
+            self.store.save(user_id, access_token, expired_at)
+        self._set(user_id, access_token, expired_at)
+
+    def add_api(self, user_id, api):
+        """
+        FacebookGraphAPI のアクセストークンと有効期限を登録します。
+
+        api = initialze_by_auth_code(app_id, app_secret, code, redirect_uri)
+        manager.add_api(api.me.id, api)
+
+        @param user_id: ユーザー ID
+        @param api: アクセストークンを取得した FacebookGraphAPI
+        @type api: FacebookGraphAPI
+        """
+        self.add(user_id, api.access_token, api.expired_at)
+
+    def _set(self, user_id, access_token, expired_at):
+        expires = _to_timestamp(expired_at)
+        refresh_at = expires - self.refresh_before if expires is not None else None
+        self._cond.acquire()
+        try:
+            self._tokens[user_id] = (access_token, expired_at, refresh_at)
+            if refresh_at is not None:
+                heapq.heappush(self._schedule, (refresh_at, user_id))
+                self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def load_store(self):
+        """
+        store に保存されているすべてのトークンを登録します。起動時に呼び出してください。
+
+        @return: 登録したトークンの数
+        @rtype: int
+        """
+        count = 0
+        for user_id, access_token, expired_at in self.store.items():
+            self._set(user_id, access_token, expired_at)
+            count += 1
+        return count
+
+    def remove(self, user_id):
+        """
+        ユーザーのトークンを管理から外し、store から削除します。
+        """
+        self._cond.acquire()
+        try:
+            self._tokens.pop(user_id, None)
+        finally:
+            self._cond.release()
+        self.store.delete(user_id)
+
+    def token_for(self, user_id):
+        """
+        ユーザーの現在のアクセストークンと有効期限のタプルを返します。
+        登録されていない場合は store から読み込み、store にもない場合は None を返します。
+
+        @rtype: tuple
+        """
+        entry = self._tokens.get(user_id)
+        if entry is None:
+            stored = self.store.load(user_id)
+            if stored is None:
+                return None
+            self._set(user_id, stored[0], stored[1])
+            return stored[0], stored[1]
+        return entry[0], entry[1]
+
+    def api_for(self, user_id):
+        """
+        ユーザーの現在のアクセストークンを持つ FacebookGraphAPI を返します。
+        トークンの延長を待つことはありません。
+
+        @param user_id: ユーザー ID
+        @return: FacebookGraphAPI。トークンが登録されていない場合は None
+        @rtype: FacebookGraphAPI
+        """
+        entry = self.token_for(user_id)
+        if entry is None:
+            return None
+        api = self.api_class(entry[0], self.app_id, self.app_secret, **self.api_kwargs)
+        api.expired_at = entry[1]
+        return api
+
+    def __len__(self):
+        return len(self._tokens)
+
+    # バックグラウンドでの延長
+
+    def start(self):
+        """
+        バックグラウンドでの延長を開始します。
+        """
+        self._cond.acquire()
+        try:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._pool = WorkerPool(self.workers)
+            self._thread = threading.Thread(target=self._run, name='TokenManager')
+            self._thread.daemon = True
+            self._thread.start()
+        finally:
+            self._cond.release()
+
+    def stop(self, wait=True):
+        """
+        バックグラウンドでの延長を終了します。延長中のトークンは、wait が True の場合は完了を待ちます。
+        """
+        self._cond.acquire()
+        try:
+            thread, self._thread = self._thread, None
+            pool, self._pool = self._pool, None
+            self._stopped = True
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+        if thread is not None and wait:
+            thread.join()
+        if pool is not None:
+            pool.shutdown(wait)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _run(self):
+        self._cond.acquire()
+        try:
+            while not self._stopped:
+                user_id = self._next_due()
+                if user_id is None:
+                    continue
+                self._refreshing.add(user_id)
+                self._pool.submit(self._refresh, user_id)
+        finally:
+            self._cond.release()
+
+    def _next_due(self):
+        """
+        延長する時刻になったユーザー ID を返します。なければ次の予定まで待って None を返します。
+        ロックを取得した状態で呼び出します。
+        """
+        if len(self._refreshing) >= self.workers:
+            self._cond.wait()
+            return None
+        while self._schedule:
+            refresh_at, user_id = self._schedule[0]
+            entry = self._tokens.get(user_id)
+            if entry is None or entry[2] != refresh_at or user_id in self._refreshing:
+                # 延長済み、削除済み、または延長中のユーザーの古い予定
+                heapq.heappop(self._schedule)
+                continue
+            delay = refresh_at - time.time()
+            if delay > 0:
+                self._cond.wait(delay)
+                return None
+            heapq.heappop(self._schedule)
+            return user_id
+        self._cond.wait()
+        return None
+
+    def refresh(self, user_id):
+        """
+        ユーザーのトークンをすぐに延長します。呼び出したスレッドで延長を行います。
+
+        @return: 延長できた場合は True
+        @rtype: bool
+        """
+        self._cond.acquire()
+        try:
+            if user_id in self._refreshing:
+                return False
+            self._refreshing.add(user_id)
+        finally:
+            self._cond.release()
+        return self._refresh(user_id)
+
+    def _refresh(self, user_id):
+        try:
+            entry = self._tokens.get(user_id)
+            if entry is None:
+                return False
+            api = self.api_class(entry[0], self.app_id, self.app_secret, **self.api_kwargs)
+            try:
+                access_token = api.extend_access_token_expiration()
+            except Exception, e:
+                if not self._is_invalid(e):
+                    log.warning(u"アクセストークンの延長に失敗したので、%d 秒後にやり直します。[user_id=%s] %s",
+                                self.retry_delay, user_id, e)
+                    self._count('retried')
+                    self._reschedule(user_id, entry, time.time() + self.retry_delay)
+                    return False
+                if not self._remove_entry(user_id, entry):
+                    # 延長中に remove() や set() で置き換えられたトークンは削除しない
+                    return False
+                log.warning(u"アクセストークンを延長できないので、管理から外します。[user_id=%s] %s", user_id, e)
+                self._count('invalid')
+                self.store.delete(user_id)
+                if self.on_invalid is not None:
+                    self.on_invalid(user_id, e)
+                return False
+
+            expired_at = api.expired_at # 有効期限が返されなかった場合は None
+            self.store.save(user_id, access_token, expired_at)
+            self._count('refreshed')
+            self._cond.acquire()
+            try:
+                # 延長中に remove() されていなければ更新する
+                if user_id in self._tokens:
+                    expires = _to_timestamp(expired_at)
+                    refresh_at = expires - self.refresh_before if expires is not None else None
+                    if refresh_at is not None and refresh_at <= time.time():
+                        # 延長しても refresh_before より短い期限しか得られない場合は、期限の直前まで延長しない
+                        refresh_at = max(time.time() + self.retry_delay, expires - self.retry_delay)
+                    self._tokens[user_id] = (access_token, expired_at, refresh_at)
+                    if refresh_at is not None:
+                        heapq.heappush(self._schedule, (refresh_at, user_id))
+            finally:
+                self._cond.release()
+            log.debug(u"アクセストークンを延長しました。[user_id=%s, expired_at=%s]", user_id, expired_at)
+            return True
+        finally:
+            self._cond.acquire()
+            try:
+                self._refreshing.discard(user_id)
+                self._cond.notify_all()
+            finally:
+                self._cond.release()
+
+    @staticmethod
+    def _is_invalid(e):
+        """
+        延長をやり直しても成功しないエラーか否かを判定します。
+        トークンが無効(エラーコード 190)の場合だけで、それ以外の 4xx のエラーはやり直します。
+        """
+        return isinstance(e, InvalidTokenError) # ExpiredTokenError を含む
+
+    def _remove_entry(self, user_id, entry):
+        """
+        ユーザーのトークンが entry のままであれば管理から外します。
+
+        @return: 管理から外した場合は True
+        @rtype: bool
+        """
+        self._cond.acquire()
+        try:
+            if self._tokens.get(user_id) is not entry:
+                return False
+            del self._tokens[user_id]
+            return True
+        finally:
+            self._cond.release()
+
+    def _reschedule(self, user_id, entry, refresh_at):
+        self._cond.acquire()
+        try:
+            if self._tokens.get(user_id) is entry:
+                self._tokens[user_id] = (entry[0], entry[1], refresh_at)
+                heapq.heappush(self._schedule, (refresh_at, user_id))
+        finally:
+            self._cond.release()
+
+    def _count(self, name):
+        self._cond.acquire()
+        try:
+            self._stats[name] += 1
+        finally:
+            self._cond.release()
+
+    def stats(self):
+        """
+        管理しているトークンの数、延長中の数、延長した数、やり直した数、無効だった数を返します。
+
+        @rtype: dict
+        """
+        self._cond.acquire()
+        try:
+            stats = dict(self._stats)
+            stats['tokens'] = len(self._tokens)
+            stats['refreshing'] = len(self._refreshing)
+            return stats
+        finally:
+            self._cond.release()
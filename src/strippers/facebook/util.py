@@ -1,15 +1,48 @@
 # vim:fileencoding=utf-8
 import functools
 import logging
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict
 
 __author__ = 'otsuka'
 
 log = logging.getLogger(__name__)
 
+MAX_INTERNED_KEYS = 10000
+
+_interned_keys = {}
+
+def intern_key(key):
+    """
+    dict のキーに使う文字列を intern します。
+    JSON をデコードするとオブジェクト毎に同じキーの文字列が作られるので、共有してメモリを節約します。
+    組み込みの intern() は unicode を扱えないので、独自のテーブルを使います。
+    テーブルが MAX_INTERNED_KEYS に達した後は、新しいキーは intern しません。
+
+    @param key: キー
+    @type key: str, unicode
+    @return: intern されたキー
+    @rtype: str, unicode
+    """
+    try:
+        return _interned_keys[key]
+    except KeyError:
+        if len(_interned_keys) >= MAX_INTERNED_KEYS:
+            return key
+        return _interned_keys.setdefault(key, key)
+    except TypeError:
+        return key
+
 class memoized(object):
     """Decorator that caches a function's return value each time it is called.
     If called later with the same arguments, the cached value is returned, and
     not re-evaluated.
+
+    The cache is shared by all instances and never expires. Use cached for
+    instance methods.
     """
     def __init__(self, func):
         self.func = func
@@ -31,3 +64,203 @@ class memoized(object):
     def __get__(self, obj, objtype):
         """Support instance methods."""
         return functools.partial(self.__call__, obj)
+
+
+class _Flight(object):
+    """
+    計算中の値を、同じ値を要求した他のスレッドと共有するためのオブジェクトです。
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+
+class _InstanceCache(object):
+    """
+    1 つのインスタンスのキャッシュ。
+    """
+
+    def __init__(self, ref):
+        self.ref = ref
+        self.entries = OrderedDict() # 引数のタプル -> (値, 有効期限)
+        self.generation = 0          # invalidate() される度に増える
+
+
+class cached(object):
+    """
+    インスタンスメソッドの戻り値を、インスタンス毎にキャッシュするデコレーターです。
+
+    キャッシュはインスタンスへの弱参照で管理されるので、インスタンスが捨てられるとキャッシュも削除されます。
+    ttl を指定すると、その秒数が経過した値は再計算されます。maxsize を超えた場合は、最も長く使われていない値から捨てます。
+    複数のスレッドが同時に同じ値を要求した場合、計算は 1 回だけ行われ、他のスレッドはその結果を待ちます。
+
+    class Foo(object):
+        @cached(ttl=300)
+        def permissions(self):
+            ...
+
+    foo.permissions.invalidate()     # foo のキャッシュを削除
+    Foo.permissions.invalidate()     # すべてのインスタンスのキャッシュを削除
+
+    property と組み合わせる場合は、property の内側に指定します。
+    キャッシュの削除には Foo.token.fget.invalidate(foo) を使用します。
+    """
+
+    def __new__(cls, func=None, ttl=None, maxsize=128):
+        if func is None:
+            # @cached(ttl=...) の形式
+            return lambda func: cls(func, ttl, maxsize)
+        return super(cached, cls).__new__(cls)
+
+    def __init__(self, func, ttl=None, maxsize=128):
+        """
+        @param func: キャッシュするインスタンスメソッド
+        @param ttl: キャッシュの有効期間(秒)。None の場合は無期限
+        @type ttl: int, float
+        @param maxsize: インスタンス毎にキャッシュする値の最大数。None の場合は無制限
+        @type maxsize: int
+        """
+        functools.update_wrapper(self, func)
+        self.func = func
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._instances = {} # id(インスタンス) -> _InstanceCache
+        self._flights = {}   # (id(インスタンス), 引数のタプル) -> _Flight
+        self._dead = []      # 捨てられたインスタンスの id と弱参照のタプル
+        self._lock = threading.Lock()
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return _BoundCachedMethod(self, obj)
+
+    def __call__(self, obj, *args):
+        try:
+            hash(args)
+        except TypeError:
+            # リストなど、キャッシュのキーにできない引数
+            return self.func(obj, *args)
+
+        self._lock.acquire()
+        try:
+            self._purge()
+            cache = self._instance_cache(obj)
+            if cache is None:
+                return self.func(obj, *args)
+            entry = cache.entries.pop(args, None)
+            if entry is not None and (entry[1] is None or entry[1] > time.time()):
+                cache.entries[args] = entry
+                return entry[0]
+            key = (id(obj), args)
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                generation = cache.generation
+        finally:
+            self._lock.release()
+
+        if not leader:
+            flight.event.wait()
+            if flight.exc_info is not None:
+                raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+            return flight.value
+
+        try:
+            flight.value = self.func(obj, *args)
+        except BaseException:
+            # KeyboardInterrupt などで中断された場合も、値を None としてキャッシュせずに待っているスレッドに伝える
+            flight.exc_info = sys.exc_info()
+            raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._flights[key]
+                if flight.exc_info is None and cache.generation == generation:
+                    expires = time.time() + self.ttl if self.ttl is not None else None
+                    cache.entries[args] = (flight.value, expires)
+                    while self.maxsize is not None and len(cache.entries) > self.maxsize:
+                        cache.entries.popitem(last=False)
+            finally:
+                self._lock.release()
+            flight.event.set()
+        return flight.value
+
+    def _instance_cache(self, obj):
+        cache = self._instances.get(id(obj))
+        if cache is not None and cache.ref() is obj:
+            return cache
+        try:
+            ref = weakref.ref(obj, lambda ref, key=id(obj): self._dead.append((key, ref)))
+        except TypeError:
+            # 弱参照を作れないオブジェクトはキャッシュしない
+            return None
+        cache = self._instances[id(obj)] = _InstanceCache(ref)
+        return cache
+
+    def _purge(self):
+        # 弱参照のコールバックはロックを取らずに _dead に追加するだけなので、ここで削除する
+        while self._dead:
+            key, ref = self._dead.pop()
+            cache = self._instances.get(key)
+            if cache is not None and cache.ref is ref:
+                del self._instances[key]
+
+    def invalidate(self, obj=None, *args):
+        """
+        キャッシュを削除します。
+
+        @param obj: キャッシュを削除するインスタンス。省略した場合はすべてのインスタンスのキャッシュを削除します
+        @param args: 削除する値の引数。省略した場合は obj のすべての値を削除します
+        """
+        self._lock.acquire()
+        try:
+            self._purge()
+            if obj is None:
+                caches = self._instances.values()
+            else:
+                cache = self._instances.get(id(obj))
+                caches = [cache] if cache is not None and cache.ref() is obj else []
+            for cache in caches:
+                cache.generation += 1
+                if args:
+                    cache.entries.pop(args, None)
+                else:
+                    cache.entries.clear()
+        finally:
+            self._lock.release()
+
+    def cache_size(self):
+        """
+        キャッシュしている値の数を返します。
+
+        @rtype: int
+        """
+        self._lock.acquire()
+        try:
+            self._purge()
+            return sum(len(cache.entries) for cache in self._instances.values())
+        finally:
+            self._lock.release()
+
+
+class _BoundCachedMethod(object):
+    """
+    インスタンスに束縛された cached メソッド。
+    """
+
+    def __init__(self, method, obj):
+        self._method = method
+        self._obj = obj
+        self.__doc__ = method.__doc__
+
+    def __call__(self, *args):
+        return self._method(self._obj, *args)
+
+    def invalidate(self, *args):
+        """
+        このインスタンスのキャッシュを削除します。
+        """
+        self._method.invalidate(self._obj, *args)
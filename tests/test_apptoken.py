@@ -0,0 +1,62 @@
+# vim:fileencoding=utf-8
+"""
+アプリケーションアクセストークンの取得のテストです。benchmarks/fakegraph.py のサーバーに対して実行します。
+
+    python tests/test_apptoken.py
+"""
+import os
+import sys
+import unittest
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(_ROOT, 'src'))
+sys.path.insert(0, os.path.join(_ROOT, 'benchmarks'))
+
+import fakegraph
+from strippers.facebook.apptoken import AppTokenProvider
+from strippers.facebook.graphapi import FacebookGraphAPI
+from strippers.facebook.metrics import CallbackSink
+from strippers.facebook.retry import RetryPolicy
+
+__author__ = 'otsuka'
+
+
+class AppTokenTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakegraph.FakeGraphServer(payload=10)
+        self.server.start()
+        self.metrics = []
+        self.api = self.create_api(AppTokenProvider())
+
+    def tearDown(self):
+        self.api.connection_pool.clear()
+        self.server.stop()
+
+    def create_api(self, provider):
+        api = FacebookGraphAPI('token', '123', 'secret', app_token_provider=provider,
+                               retry_policy=RetryPolicy(backoff=0.01), metrics=CallbackSink(self.metrics.append))
+        api.BASE_URL = self.server.base_url
+        return api
+
+    def test_fetched_with_api_connection_pool(self):
+        self.assertEqual(self.api.app_token, '123|fakeapptoken')
+        self.assertEqual(self.api.app_token, '123|fakeapptoken')
+        self.assertEqual(self.server.stats()['requests'], 1)
+        self.assertEqual(self.api.connection_stats()['requests'], 1)
+        self.assertEqual([ (m.endpoint, m.status) for m in self.metrics ], [('/oauth/access_token', 200)])
+
+    def test_fetch_is_retried(self):
+        self.server.fail_next(1, 503, 'oauth/')
+        self.assertEqual(self.api.app_token, '123|fakeapptoken')
+        self.assertEqual(self.server.stats()['requests'], 2)
+        self.assertEqual([ m.attempt for m in self.metrics ], [1, 2])
+
+    def test_provider_fetch_takes_precedence(self):
+        api = self.create_api(AppTokenProvider(fetch=lambda app_id, app_secret: ('custom', None)))
+        self.assertEqual(api.app_token, 'custom')
+        self.assertEqual(self.server.stats()['requests'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
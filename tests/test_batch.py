@@ -0,0 +1,71 @@
+# vim:fileencoding=utf-8
+"""
+GraphBatch のテストです。benchmarks/fakegraph.py のサーバーに対して実行します。
+
+    python tests/test_batch.py
+"""
+import os
+import sys
+import unittest
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(_ROOT, 'src'))
+sys.path.insert(0, os.path.join(_ROOT, 'benchmarks'))
+
+import fakegraph
+from strippers.facebook import jsoncodec as json
+from strippers.facebook.error import ExpiredTokenError, InvalidTokenError, RateLimitExceededError
+from strippers.facebook.graphapi import FacebookGraphAPI
+from strippers.facebook.graphobject import FbAlbum, FbPhoto, FbUser
+
+__author__ = 'otsuka'
+
+
+class GraphBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakegraph.FakeGraphServer(payload=10)
+        self.server.start()
+        self.api = FacebookGraphAPI('token')
+        self.api.BASE_URL = self.server.base_url
+
+    def tearDown(self):
+        self.api.connection_pool.clear()
+        self.server.stop()
+
+    def test_split_into_chunks(self):
+        ids = [ str(200000 + i) for i in xrange(120) ]
+        with self.api.batch() as batch:
+            futures = [ batch.get(self.api.BASE_URL + id) for id in ids ]
+        # MAX_BATCH_SIZE(50)件ずつ 3 回に分けて送信する
+        self.assertEqual(self.server.stats()['requests'], 3)
+        self.assertEqual([ json.loads(future.result())['id'] for future in futures ], ids)
+
+    def test_errors_are_mapped_per_item(self):
+        base_url = self.api.BASE_URL
+        with self.api.batch() as batch:
+            me = batch.get(base_url + 'me')
+            throttled = batch.get(base_url + 'error/17')
+            invalid = batch.get(base_url + 'error/190')
+            expired = batch._send_api_request(base_url + 'me', access_token='expired-token')
+            post = batch.send_post_request(base_url + 'me/feed', { 'message': 'hello' })
+        self.assertEqual(self.server.stats()['requests'], 1)
+        # 失敗したリクエストは、単独で送信した場合と同じ例外になり、他のリクエストには影響しない
+        self.assertEqual(json.loads(me.result())['id'], '100001')
+        self.assertRaises(RateLimitExceededError, throttled.result)
+        self.assertRaises(InvalidTokenError, invalid.result)
+        self.assertRaises(ExpiredTokenError, expired.result)
+        self.assertTrue(json.loads(post.result())['id'])
+
+    def test_object_methods_are_batched(self):
+        photos = [ FbPhoto(self.api, { 'id': str(300000 + i) }) for i in xrange(3) ]
+        with self.api.batch() as batch:
+            tagged = [ FbPhoto(batch, photo).tag('200001') for photo in photos ]
+            album = FbUser(batch, { 'id': 'me' }).create_album(u'album')
+        self.assertEqual(self.server.stats()['requests'], 1)
+        self.assertEqual([ future.result()['id'] for future in tagged ], [ photo['id'] for photo in photos ])
+        self.assertTrue(isinstance(album.result(), FbAlbum))
+
+
+if __name__ == '__main__':
+    unittest.main()
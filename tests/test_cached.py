@@ -0,0 +1,105 @@
+# vim:fileencoding=utf-8
+"""
+cached デコレーターのテストです。一部は benchmarks/fakegraph.py のサーバーに対して実行します。
+
+    python tests/test_cached.py
+"""
+import os
+import sys
+import threading
+import time
+import unittest
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(_ROOT, 'src'))
+sys.path.insert(0, os.path.join(_ROOT, 'benchmarks'))
+
+import fakegraph
+from strippers.facebook.graphapi import FacebookGraphAPI
+from strippers.facebook.util import cached
+
+__author__ = 'otsuka'
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.error = None
+
+    @cached(ttl=0.05, maxsize=2)
+    def value(self, key):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return (key, self.calls)
+
+
+class CachedTest(unittest.TestCase):
+
+    def test_value_is_cached_per_instance(self):
+        a, b = Counter(), Counter()
+        self.assertEqual(a.value('x'), ('x', 1))
+        self.assertEqual(a.value('x'), ('x', 1))
+        self.assertEqual(b.value('x'), ('x', 1))
+        a.value.invalidate()
+        self.assertEqual(a.value('x'), ('x', 2))
+        self.assertEqual(b.value('x'), ('x', 1))
+
+    def test_ttl(self):
+        counter = Counter()
+        counter.value('x')
+        time.sleep(0.1)
+        self.assertEqual(counter.value('x'), ('x', 2))
+
+    def test_least_recently_used_value_is_evicted(self):
+        counter = Counter()
+        counter.value('x')
+        counter.value('y')
+        counter.value('x')
+        counter.value('z') # maxsize=2 なので、最も長く使われていない y を捨てる
+        self.assertEqual(counter.value('x'), ('x', 1))
+        self.assertEqual(counter.value('y'), ('y', 4))
+
+    def test_interrupted_call_is_not_cached(self):
+        counter = Counter()
+        counter.error = KeyboardInterrupt()
+        self.assertRaises(KeyboardInterrupt, counter.value, 'x')
+        counter.error = None
+        self.assertEqual(counter.value('x'), ('x', 2))
+
+    def test_cache_is_dropped_with_instance(self):
+        counter = Counter()
+        counter.value('x')
+        size = Counter.value.cache_size()
+        del counter
+        self.assertEqual(Counter.value.cache_size(), size - 1)
+
+
+class CachedPermissionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakegraph.FakeGraphServer(latency=0.1, payload=10)
+        self.server.start()
+        self.api = FacebookGraphAPI('token')
+        self.api.BASE_URL = self.server.base_url
+
+    def tearDown(self):
+        self.api.connection_pool.clear()
+        self.server.stop()
+
+    def test_concurrent_calls_share_one_request(self):
+        results = []
+        threads = [ threading.Thread(target=lambda: results.append(self.api.permissions())) for i in xrange(5) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.server.stats()['requests'], 1)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len(set(results)), 1)
+        self.assertTrue('publish_stream' in results[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+# vim:fileencoding=utf-8
+"""
+GraphPager のテストです。benchmarks/fakegraph.py のサーバーに対して実行します。
+
+    python tests/test_graphpager.py
+"""
+import gc
+import os
+import sys
+import threading
+import time
+import unittest
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(_ROOT, 'src'))
+sys.path.insert(0, os.path.join(_ROOT, 'benchmarks'))
+
+import fakegraph
+from strippers.facebook.graphapi import FacebookGraphAPI
+from strippers.facebook.graphobject import FbUser, GraphPager, _PagePrefetcher
+
+__author__ = 'otsuka'
+
+
+class GraphPagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakegraph.FakeGraphServer(total=200, payload=10)
+        self.server.start()
+        self.api = FacebookGraphAPI('token')
+        self.api.BASE_URL = self.server.base_url
+        self.user = FbUser(self.api, { 'id': 'me' })
+
+    def tearDown(self):
+        self.api.connection_pool.clear()
+        self.server.stop()
+
+    def prefetch_threads(self):
+        return [ t for t in threading.enumerate() if t.name == _PagePrefetcher.THREAD_NAME ]
+
+    def wait_prefetch_threads(self, timeout=5.0):
+        deadline = time.time() + timeout
+        while self.prefetch_threads() and time.time() < deadline:
+            time.sleep(0.02)
+        return len(self.prefetch_threads())
+
+    def test_iterates_all_pages(self):
+        for prefetch in (0, 2):
+            posts = list(self.user.posts(fetch=30, prefetch=prefetch))
+            self.assertEqual(len(posts), 200)
+
+    def test_max_pages_sets_truncated(self):
+        pager = GraphPager(self.api, self.user.uri + '/posts', { 'limit': 30 }, max_pages=2)
+        self.assertEqual(len(list(pager)), 60)
+        self.assertTrue(pager.truncated)
+        pager = GraphPager(self.api, self.user.uri + '/posts', { 'limit': 100 }, max_pages=3)
+        self.assertEqual(len(list(pager)), 200)
+        self.assertFalse(pager.truncated)
+
+    def test_abandoned_prefetching_pager_stops_thread(self):
+        self.assertEqual(self.wait_prefetch_threads(), 0)
+        for i in xrange(5):
+            pager = self.user.posts(fetch=10, prefetch=2)
+            pager.next()
+        self.assertTrue(self.prefetch_threads())
+        del pager
+        gc.collect()
+        self.assertEqual(self.wait_prefetch_threads(), 0)
+
+    def test_abandoned_pager_is_collected(self):
+        gc.collect()
+        garbage = len(gc.garbage)
+        for i in xrange(5):
+            pager = self.user.posts(fetch=10, prefetch=0)
+            pager.next()
+        del pager
+        gc.collect()
+        self.assertEqual(len(gc.garbage), garbage)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+# vim:fileencoding=utf-8
+"""
+LazyLoadDetector のテストです。benchmarks/fakegraph.py のサーバーに対して実行します。
+
+    python tests/test_lazyload.py
+"""
+import os
+import sys
+import unittest
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(_ROOT, 'src'))
+sys.path.insert(0, os.path.join(_ROOT, 'benchmarks'))
+
+import fakegraph
+from strippers.facebook.graphapi import FacebookGraphAPI
+from strippers.facebook.graphobject import FbUser
+from strippers.facebook.error import RepeatedLazyLoadError
+from strippers.facebook.lazyload import LazyLoadDetector
+
+__author__ = 'otsuka'
+
+
+class LazyLoadDetectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakegraph.FakeGraphServer(payload=10)
+        self.server.start()
+        self.api = FacebookGraphAPI('token')
+        self.api.BASE_URL = self.server.base_url
+
+    def tearDown(self):
+        self.api.connection_pool.clear()
+        self.server.stop()
+
+    def user(self, id):
+        return FbUser(self.api, { 'id': id })
+
+    def test_records_only_sent_requests(self):
+        user = self.user('200001')
+        with LazyLoadDetector(action='record') as detector:
+            self.assertEqual(user['gender'], 'male')
+            # ロード済みのオブジェクトに無いフィールドは、リクエストを送信せずに KeyError になる
+            self.assertRaises(KeyError, user.__getitem__, 'location')
+        self.assertEqual(len(detector.events), 1)
+        self.assertEqual(self.server.stats()['requests'], 1)
+        self.assertEqual(detector.events[0].field, 'gender')
+        self.assertFalse(detector.events[0].partial)
+
+    def test_records_missing_field_of_partially_loaded_object(self):
+        user = self.user('200001')
+        with LazyLoadDetector(action='record') as detector:
+            user.load(['name'])
+            self.assertEqual(user['name'], 'User 200001')
+            self.assertEqual(user['gender'], 'male')
+        # 明示的な load() と取得済みのフィールドへのアクセスは記録しない
+        self.assertEqual([ event.field for event in detector.events ], ['gender'])
+        self.assertTrue(detector.events[0].partial)
+
+    def test_raise_reports_call_site(self):
+        users = [ self.user(str(200001 + i)) for i in xrange(3) ]
+        detector = LazyLoadDetector(threshold=3, action='raise')
+        try:
+            with detector:
+                for user in users:
+                    user['gender']
+        except RepeatedLazyLoadError, e:
+            filename, lineno, name = e.call_site[0]
+            self.assertEqual(os.path.basename(filename), 'test_lazyload.py')
+            self.assertEqual(name, 'test_raise_reports_call_site')
+            self.assertEqual(e.report['loads'], 3)
+            self.assertEqual(e.report['fields'], ['gender'])
+        else:
+            self.fail('RepeatedLazyLoadError was not raised.')
+        # 繰り返しを検出したロードは送信しない
+        self.assertEqual(self.server.stats()['requests'], 2)
+        self.assertFalse(users[2].loaded)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+# vim:fileencoding=utf-8
+"""
+FbUser.posts_parallel() のテストです。benchmarks/fakegraph.py のサーバーに対して実行します。
+
+    python tests/test_posts_parallel.py
+"""
+import os
+import sys
+import unittest
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(_ROOT, 'src'))
+sys.path.insert(0, os.path.join(_ROOT, 'benchmarks'))
+
+import fakegraph
+from strippers.facebook.graphapi import FacebookGraphAPI
+from strippers.facebook.graphobject import FbUser
+
+__author__ = 'otsuka'
+
+
+class PostsParallelTest(unittest.TestCase):
+
+    TOTAL = 1200
+
+    def setUp(self):
+        # 1 ページの件数を limit より少なく切り詰めるサーバー
+        self.server = fakegraph.FakeGraphServer(total=self.TOTAL, payload=10, max_limit=60)
+        self.server.start()
+        self.api = FacebookGraphAPI('token')
+        self.api.BASE_URL = self.server.base_url
+        self.user = FbUser(self.api, { 'id': 'me' })
+        self.since = fakegraph.EPOCH
+        self.until = fakegraph.EPOCH + (self.TOTAL + 1) * 60
+
+    def tearDown(self):
+        self.api.connection_pool.clear()
+        self.server.stop()
+
+    def ids(self, posts):
+        return [ post['id'] for post in posts ]
+
+    def test_same_as_posts(self):
+        expected = self.ids(self.user.posts(fetch=100, since=self.since, until=self.until, prefetch=0))
+        self.assertEqual(len(expected), self.TOTAL)
+        actual = self.ids(self.user.posts_parallel(self.since, self.until, workers=4, fetch=100, split_pages=4))
+        self.assertEqual(actual, expected)
+
+    def test_short_pages_are_split(self):
+        # 1 ページが fetch 件に満たなくても、split_pages ページで取得しきれなかった区間は分割して取得を続ける
+        posts = self.user.posts_parallel(self.since, self.until, workers=4, slices=1, fetch=100, split_pages=4)
+        self.assertEqual(len(set(self.ids(posts))), self.TOTAL)
+
+
+if __name__ == '__main__':
+    unittest.main()
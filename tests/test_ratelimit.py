@@ -0,0 +1,89 @@
+# vim:fileencoding=utf-8
+"""
+RateLimiter のテストです。benchmarks/fakegraph.py のサーバーに対して実行します。
+
+    python tests/test_ratelimit.py
+"""
+import os
+import sys
+import unittest
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(_ROOT, 'src'))
+sys.path.insert(0, os.path.join(_ROOT, 'benchmarks'))
+
+import fakegraph
+from strippers.facebook.apptoken import AppTokenProvider
+from strippers.facebook.error import RateLimitExceededError
+from strippers.facebook.graphapi import FacebookGraphAPI
+from strippers.facebook.ratelimit import RateLimiter
+from strippers.facebook.retry import RetryPolicy
+
+__author__ = 'otsuka'
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakegraph.FakeGraphServer(payload=10)
+        self.server.start()
+        self.apis = []
+
+    def tearDown(self):
+        for api in self.apis:
+            api.connection_pool.clear()
+        self.server.stop()
+
+    def create_api(self, limiter):
+        api = FacebookGraphAPI('token', '123', 'secret', rate_limiter=limiter, app_token_provider=AppTokenProvider(),
+                               retry_policy=RetryPolicy(max_attempts=1))
+        api.BASE_URL = self.server.base_url
+        self.apis.append(api)
+        return api
+
+    def test_throttling_error_lowers_rate(self):
+        limiter = RateLimiter(token_rate=100)
+        api = self.create_api(limiter)
+        self.assertRaises(RateLimitExceededError, api.get, api.BASE_URL + 'error/17')
+        bucket = limiter.buckets('token')[0]
+        self.assertEqual(bucket.rate, 50)
+        # 成功する度に元の rate の recovery(5%)ずつ戻す
+        api.get(api.BASE_URL + 'me')
+        self.assertEqual(bucket.rate, 55)
+
+    def test_http_429_lowers_rate(self):
+        limiter = RateLimiter(token_rate=100)
+        api = self.create_api(limiter)
+        self.server.fail_next(1, 429)
+        self.assertRaises(RateLimitExceededError, api.get, api.BASE_URL + 'me')
+        self.assertEqual(limiter.buckets('token')[0].rate, 50)
+
+    def test_app_limit_lowers_only_app_bucket(self):
+        limiter = RateLimiter(token_rate=100, app_rate=100)
+        api = self.create_api(limiter)
+        self.assertRaises(RateLimitExceededError, api.get, api.BASE_URL + 'error/4')
+        token_bucket, app_bucket = limiter.buckets('token', '123')
+        self.assertEqual(token_bucket.rate, 100)
+        self.assertEqual(app_bucket.rate, 50)
+
+    def test_unsent_request_refunds_tokens(self):
+        # アプリ毎のバケットが空で送信できない場合は、先に消費したアクセストークン毎のトークンを返却する
+        limiter = RateLimiter(token_rate=1, token_burst=5, app_rate=0.01, app_burst=1, timeout=0)
+        api = self.create_api(limiter)
+        api.get(api.BASE_URL + 'me')
+        token_bucket = limiter.buckets('token')[0]
+        tokens = token_bucket._tokens
+        self.assertRaises(RateLimitExceededError, api.get, api.BASE_URL + 'me')
+        self.assertTrue(tokens <= token_bucket._tokens < tokens + 0.5)
+        self.assertEqual(self.server.stats()['requests'], 1)
+
+    def test_app_requests_use_app_token_bucket(self):
+        limiter = RateLimiter(token_rate=100)
+        api = self.create_api(limiter)
+        api.send_post_request_for_app(api.BASE_URL + 'me/feed', { 'message': 'hello' })
+        self.assertEqual(limiter.buckets('token')[0]._tokens, 100)
+        self.assertTrue(limiter.buckets('123|fakeapptoken')[0]._tokens < 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# vim:fileencoding=utf-8
+"""
+FacebookGraphAPI の response_cache のテストです。benchmarks/fakegraph.py のサーバーに対して実行します。
+
+    python tests/test_response_cache.py
+"""
+import os
+import sys
+import time
+import unittest
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(_ROOT, 'src'))
+sys.path.insert(0, os.path.join(_ROOT, 'benchmarks'))
+
+import fakegraph
+from strippers.facebook.cache import ResponseCache
+from strippers.facebook.graphapi import FacebookGraphAPI
+
+__author__ = 'otsuka'
+
+OWNER_ID = '100001' # fakegraph の me の ID
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakegraph.FakeGraphServer(total=10, payload=10, etag=True)
+        self.server.start()
+        self.cache = ResponseCache(ttls=[(r'^stale', 0.05)])
+        self.api = self.create_api('token')
+
+    def tearDown(self):
+        self.api.connection_pool.clear()
+        self.server.stop()
+
+    def create_api(self, access_token):
+        api = FacebookGraphAPI(access_token, response_cache=self.cache)
+        api.BASE_URL = self.server.base_url
+        return api
+
+    def requests(self):
+        return self.server.stats()['requests']
+
+    def is_cached(self, path, api=None):
+        """path の GET がキャッシュから返されたか否か"""
+        api = api or self.api
+        before = self.requests()
+        api.get(api.BASE_URL + path)
+        return self.requests() == before
+
+    def test_get_is_cached(self):
+        self.assertFalse(self.is_cached('200001'))
+        self.assertTrue(self.is_cached('200001'))
+
+    def test_stale_entry_is_revalidated(self):
+        body = self.api.get(self.api.BASE_URL + 'stale')
+        time.sleep(0.1)
+        # 期限切れのエントリは If-None-Match で再検証し、304 であればキャッシュしたボディを返す
+        bytes_out = self.server.stats()['bytes_out']
+        self.assertFalse(self.is_cached('stale'))
+        self.assertEqual(self.server.stats()['bytes_out'], bytes_out)
+        self.assertEqual(self.cache.stats()['revalidations'], 1)
+        self.assertEqual(self.api.get(self.api.BASE_URL + 'stale'), body)
+        # 再検証したエントリは、また ttl の間は新しい
+        self.assertTrue(self.is_cached('stale'))
+
+    def test_changed_entry_is_replaced(self):
+        body = self.api.get(self.api.BASE_URL + 'stale')
+        time.sleep(0.1)
+        self.server.app.payload = 20
+        changed = self.api.get(self.api.BASE_URL + 'stale')
+        self.assertNotEqual(changed, body)
+        self.assertEqual(self.cache.stats()['revalidations'], 0)
+        self.assertTrue(self.is_cached('stale'))
+        self.assertEqual(self.api.get(self.api.BASE_URL + 'stale'), changed)
+
+    def test_write_by_id_invalidates_me(self):
+        self.is_cached('me/feed')
+        self.api.send_post_request(self.api.BASE_URL + OWNER_ID + '/feed', { 'message': 'hello' })
+        self.assertFalse(self.is_cached('me/feed'))
+
+    def test_write_to_me_invalidates_owner_id(self):
+        self.is_cached(OWNER_ID + '/feed')
+        self.api.send_post_request(self.api.BASE_URL + 'me/feed', { 'message': 'hello' })
+        self.assertFalse(self.is_cached(OWNER_ID + '/feed'))
+
+    def test_write_to_other_object_keeps_me(self):
+        self.is_cached('me')
+        self.is_cached('me/feed')
+        self.api.send_post_request(self.api.BASE_URL + '200001/feed', { 'message': 'hello' })
+        # /me を取得済みなので、所有者の ID を調べるリクエストは送信しない
+        self.assertTrue(self.is_cached('me/feed'))
+
+    def test_write_to_me_keeps_other_tokens_me(self):
+        other = self.create_api('token2')
+        self.is_cached('me/feed', other)
+        self.api.send_post_request(self.api.BASE_URL + 'me/feed', { 'message': 'hello' })
+        self.assertTrue(self.is_cached('me/feed', other))
+        other.connection_pool.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
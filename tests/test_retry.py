@@ -0,0 +1,86 @@
+# vim:fileencoding=utf-8
+"""
+RetryPolicy によるリトライのテストです。benchmarks/fakegraph.py のサーバーに対して実行します。
+
+    python tests/test_retry.py
+"""
+import os
+import socket
+import sys
+import unittest
+import urllib2
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(_ROOT, 'src'))
+sys.path.insert(0, os.path.join(_ROOT, 'benchmarks'))
+
+import fakegraph
+from strippers.facebook.error import RateLimitExceededError
+from strippers.facebook.graphapi import FacebookGraphAPI
+from strippers.facebook.retry import RetryPolicy
+
+__author__ = 'otsuka'
+
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakegraph.FakeGraphServer(payload=10)
+        self.server.start()
+        self.api = self.create_api(retry_post=True)
+
+    def tearDown(self):
+        self.api.connection_pool.clear()
+        self.server.stop()
+
+    def create_api(self, retry_post):
+        api = FacebookGraphAPI('token', retry_policy=RetryPolicy(backoff=0.01, retry_post=retry_post))
+        api.BASE_URL = self.server.base_url
+        return api
+
+    def post(self, api=None):
+        api = api or self.api
+        return api.send_post_request(api.BASE_URL + 'me/feed', { 'message': 'hello' })
+
+    def requests(self):
+        return self.server.stats()['requests']
+
+    def test_get_is_retried_after_server_error(self):
+        self.server.fail_next(2, 503)
+        self.api.get(self.api.BASE_URL + 'me')
+        self.assertEqual(self.requests(), 3)
+        self.assertEqual(self.api.last_attempt_count, 3)
+
+    def test_post_is_retried_when_throttled(self):
+        # 呼び出し回数の制限で拒否されたリクエストは処理されていないので、POST でもリトライする
+        self.server.fail_next(1, 429)
+        self.post()
+        self.assertEqual(self.requests(), 2)
+        self.assertEqual(self.api.last_attempt_count, 2)
+
+    def test_post_is_not_retried_after_server_error(self):
+        # 5xx はサーバーが処理した後のエラーかもしれないので、二重に投稿しないようにリトライしない
+        self.server.fail_next(1, 500)
+        self.assertRaises(urllib2.HTTPError, self.post)
+        self.assertEqual(self.requests(), 1)
+        self.assertEqual(self.api.last_attempt_count, 1)
+
+    def test_post_is_retried_when_connection_refused(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        self.api.BASE_URL = 'http://127.0.0.1:%d/' % port
+        self.assertRaises(urllib2.URLError, self.post)
+        self.assertEqual(self.api.last_attempt_count, 3)
+
+    def test_post_is_not_retried_without_retry_post(self):
+        api = self.create_api(retry_post=False)
+        self.server.fail_next(1, 429)
+        self.assertRaises(RateLimitExceededError, self.post, api)
+        self.assertEqual(self.requests(), 1)
+        api.connection_pool.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# vim:fileencoding=utf-8
+"""
+SignedRequestVerifier と parse_signed_request() のテストです。
+
+    python tests/test_signed_request.py
+"""
+import base64
+import hashlib
+import hmac
+import os
+import sys
+import time
+import unittest
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(_ROOT, 'src'))
+
+from strippers.facebook import jsoncodec as json
+from strippers.facebook.oauth import SignedRequestVerifier, _constant_time_compare, parse_signed_request
+
+__author__ = 'otsuka'
+
+APP_SECRET = 'e8c3b3f3a54d4e0c9a1b2c3d4e5f6a7b'
+
+
+def sign(data, secret=APP_SECRET):
+    payload = base64.urlsafe_b64encode(json.dumps(data)).rstrip('=')
+    sig = hmac.new(secret, msg=payload, digestmod=hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(sig).rstrip('=') + '.' + payload
+
+def request_data(**kwargs):
+    data = {
+        'algorithm': 'HMAC-SHA256',
+        'issued_at': int(time.time()),
+        'user_id'  : '100001',
+        'user'     : { 'country': 'jp', 'locale': 'ja_JP' },
+    }
+    data.update(kwargs)
+    return data
+
+
+class SignedRequestVerifierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.verifier = SignedRequestVerifier(APP_SECRET)
+
+    def test_valid_request(self):
+        data = request_data()
+        self.assertEqual(self.verifier.verify(sign(data)), data)
+
+    def test_long_secret(self):
+        # ブロック長より長い App Secret は、ハッシュ値を鍵にする(hmac モジュールと同じ結果になる)
+        secret = 's' * 100
+        data = request_data()
+        self.assertEqual(SignedRequestVerifier(secret).verify(sign(data, secret)), data)
+
+    def test_invalid_requests_are_rejected(self):
+        signed_request = sign(request_data())
+        sig, payload = signed_request.split('.', 1)
+        forged = sign(request_data(user_id='200001'), 'other secret').split('.', 1)[0] + '.' + payload
+        tampered = sig + '.' + sign(request_data(user_id='200001')).split('.', 1)[1]
+        for invalid in (forged, tampered, payload, 'x.y', '', sign(request_data(algorithm='HMAC-SHA1'))):
+            self.assertTrue(self.verifier.verify(invalid) is False, invalid)
+        self.assertEqual(self.verifier.stats()['rejected'], 6)
+        self.assertEqual(self.verifier.stats()['verified'], 0)
+
+    def test_constant_time_compare(self):
+        self.assertTrue(_constant_time_compare('abc', 'abc'))
+        self.assertFalse(_constant_time_compare('abc', 'abd'))
+        self.assertFalse(_constant_time_compare('abc', 'xbc'))
+        self.assertFalse(_constant_time_compare('abc', 'abcd'))
+        self.assertTrue(_constant_time_compare('', ''))
+
+    def test_cached_data_is_not_shared(self):
+        signed_request = sign(request_data())
+        first = self.verifier.verify(signed_request)
+        first['user']['country'] = 'us'
+        first['injected'] = True
+        second = self.verifier.verify(signed_request)
+        self.assertEqual(second, request_data(issued_at=second['issued_at']))
+        self.assertEqual(self.verifier.stats()['hits'], 1)
+        # verify_many() で同じ signed_request が繰り返し含まれる場合も、別の dict を返す
+        results = self.verifier.verify_many([signed_request, signed_request])
+        self.assertFalse(results[0] is results[1])
+        self.assertFalse(results[0]['user'] is results[1]['user'])
+
+    def test_max_age(self):
+        verifier = SignedRequestVerifier(APP_SECRET, max_age=60)
+        self.assertTrue(verifier.verify(sign(request_data(issued_at=int(time.time()) - 120))) is False)
+        self.assertTrue(verifier.verify(sign(request_data(issued_at=None))) is False)
+        # キャッシュしたものも、max_age を過ぎると無効になる
+        signed_request = sign(request_data(issued_at=time.time() - 59.9))
+        self.assertTrue(verifier.verify(signed_request))
+        time.sleep(0.2)
+        self.assertTrue(verifier.verify(signed_request) is False)
+
+    def test_cache_is_per_secret(self):
+        signed_request = sign(request_data())
+        self.assertTrue(parse_signed_request(signed_request, APP_SECRET))
+        self.assertTrue(parse_signed_request(signed_request, 'other secret') is False)
+
+
+if __name__ == '__main__':
+    unittest.main()
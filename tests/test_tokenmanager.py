@@ -0,0 +1,100 @@
+# vim:fileencoding=utf-8
+"""
+TokenManager のテストです。benchmarks/fakegraph.py のサーバーに対して実行します。
+
+    python tests/test_tokenmanager.py
+"""
+import os
+import sys
+import time
+import unittest
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(_ROOT, 'src'))
+sys.path.insert(0, os.path.join(_ROOT, 'benchmarks'))
+
+import fakegraph
+from strippers.facebook.error import InvalidTokenError
+from strippers.facebook.graphapi import FacebookGraphAPI
+from strippers.facebook.tokenmanager import TokenManager
+
+__author__ = 'otsuka'
+
+DAY = 24 * 60 * 60
+
+
+class TokenManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakegraph.FakeGraphServer(payload=10)
+        self.server.start()
+        self.invalid = []
+        self.manager = self.create_manager()
+
+    def tearDown(self):
+        self.manager.stop()
+        self.manager.api_kwargs['connection_pool'].clear()
+        self.server.stop()
+
+    def create_manager(self, api_class=FacebookGraphAPI):
+        api_class = type(api_class.__name__, (api_class,), { 'BASE_URL': self.server.base_url })
+        return TokenManager('123', 'secret', refresh_before=7 * DAY, retry_delay=60, api_class=api_class,
+                            on_invalid=lambda user_id, e: self.invalid.append((user_id, e)))
+
+    def test_refresh(self):
+        self.manager.add('u1', 'token1', time.time() + DAY)
+        self.assertTrue(self.manager.refresh('u1'))
+        access_token, expired_at = self.manager.token_for('u1')
+        self.assertTrue(access_token.startswith('fake'))
+        self.assertEqual(self.manager.store.load('u1'), (access_token, expired_at))
+        self.assertEqual(self.manager.stats()['refreshed'], 1)
+
+    def test_expiring_token_is_refreshed_in_background(self):
+        self.manager.add('u1', 'token1', time.time() + DAY)
+        self.manager.add('u2', 'token2', time.time() + 30 * DAY)
+        self.manager.start()
+        deadline = time.time() + 5
+        while self.manager.stats()['refreshed'] < 1 and time.time() < deadline:
+            time.sleep(0.02)
+        time.sleep(0.1)
+        # 有効期限が refresh_before より先のトークンは延長しない
+        self.assertEqual(self.manager.stats()['refreshed'], 1)
+        self.assertNotEqual(self.manager.token_for('u1')[0], 'token1')
+        self.assertEqual(self.manager.token_for('u2')[0], 'token2')
+
+    def test_invalid_token_is_removed(self):
+        self.manager.add('u1', 'invalid-token', time.time() + DAY)
+        self.assertFalse(self.manager.refresh('u1'))
+        self.assertEqual(self.manager.token_for('u1'), None)
+        self.assertEqual([ user_id for user_id, e in self.invalid ], ['u1'])
+        self.assertTrue(isinstance(self.invalid[0][1], InvalidTokenError))
+
+    def test_other_client_error_is_retried(self):
+        # トークンが無効であること(エラーコード 190)を示さない 4xx のエラーでは、管理から外さずにやり直す
+        self.server.fail_next(1, 400, 'oauth/')
+        self.manager.add('u1', 'token1', time.time() + DAY)
+        self.assertFalse(self.manager.refresh('u1'))
+        self.assertEqual(self.manager.token_for('u1')[0], 'token1')
+        self.assertEqual(self.manager.stats()['retried'], 1)
+        self.assertEqual(self.invalid, [])
+        self.assertTrue(self.manager.refresh('u1'))
+
+    def test_token_replaced_during_refresh_is_kept(self):
+        manager = self.manager
+
+        class ReplacingAPI(FacebookGraphAPI):
+            def extend_access_token_expiration(self):
+                # 延長中に、ユーザーがログインし直して新しいトークンが登録された
+                manager.add('u1', 'token2', time.time() + 30 * DAY)
+                return FacebookGraphAPI.extend_access_token_expiration(self)
+
+        manager.api_class = self.create_manager(ReplacingAPI).api_class
+        manager.add('u1', 'invalid-token', time.time() + DAY)
+        self.assertFalse(manager.refresh('u1'))
+        self.assertEqual(manager.token_for('u1')[0], 'token2')
+        self.assertEqual(manager.store.load('u1')[0], 'token2')
+        self.assertEqual(self.invalid, [])
+
+
+if __name__ == '__main__':
+    unittest.main()